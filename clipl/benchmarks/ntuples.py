@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast generation of synthetic inputs for benchmarks
+
+The values of all events are generated at once with NumPy, written to a temporary text file
+and read into a tree by ROOT.TTree.ReadFile, which avoids loops over the events in Python.
+The variables var<i> follow correlated Gaussian distributions. Every tree additionally contains
+the event number and a category (0-9), such that friend trees can be matched and selections
+can be applied. The generation is reproducible for a given seed.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import array
+import os
+import tempfile
+
+import numpy
+
+import ROOT
+
+import clipl.utility.tfilecontextmanager as tfilecontextmanager
+
+
+def branch_names(n_branches):
+	return ["var{index:d}".format(index=index) for index in xrange(n_branches)]
+
+
+def gaussian_parameters(random_state, n_variables):
+	"""
+	Return random (means, widths, mixing matrix) of correlated Gaussian distributions
+	"""
+	means = random_state.uniform(-5.0, 5.0, n_variables)
+	sigmas = random_state.uniform(1.0, 5.0, n_variables)
+	mixing = numpy.eye(n_variables) + 0.3 * random_state.uniform(-1.0, 1.0, (n_variables, n_variables))
+	mixing /= numpy.sqrt((mixing**2).sum(axis=0))
+	return means, sigmas, mixing
+
+
+def correlated_gaussians(random_state, n_events, parameters):
+	"""
+	Return an array (events x variables) of Gaussian random numbers for the given parameters (see gaussian_parameters)
+	"""
+	means, sigmas, mixing = parameters
+	return random_state.standard_normal((n_events, len(means))).dot(mixing) * sigmas + means
+
+
+def write_tree(file_name, tree_name, columns, branch_descriptors):
+	"""
+	Write a tree with the given columns (list of arrays) and branch descriptors (e.g. "var0/F") to a new ROOT file
+	"""
+	tmp_file_descriptor, tmp_file_name = tempfile.mkstemp(prefix=".tmp_", suffix=".txt", dir=os.path.dirname(os.path.abspath(file_name)))
+	try:
+		with os.fdopen(tmp_file_descriptor, "w") as tmp_file:
+			numpy.savetxt(tmp_file, numpy.column_stack(columns), fmt=["%d" if descriptor.endswith("/I") else "%.7g" for descriptor in branch_descriptors])
+		with tfilecontextmanager.TFileContextManager(file_name, "RECREATE") as root_file:
+			tree = ROOT.TTree(tree_name, tree_name)
+			n_entries = tree.ReadFile(tmp_file_name, ":".join(branch_descriptors))
+			if n_entries != len(columns[0]):
+				raise IOError("Read {n_entries:d} instead of {n_events:d} events into the tree \"{tree_name}\" in \"{file_name}\"!".format(
+						n_entries=n_entries, n_events=len(columns[0]), tree_name=tree_name, file_name=file_name
+				))
+			tree.Write(tree_name)
+	finally:
+		os.remove(tmp_file_name)
+
+
+def generate_ntuples(output_dir, n_files=1, n_events=10000, n_branches=10, n_friend_branches=2, tree_name="ntuple", friend_tree_name="friend", seed=0):
+	"""
+	Generate n_files files with a tree of n_events events each and corresponding files with friend trees
+
+	The friend trees contain the branches weight and friend_var<i>.
+
+	Returns a dict with the lists of "files" and "friend_files", the tree names and the branch names.
+	"""
+	if not os.path.exists(output_dir):
+		os.makedirs(output_dir)
+
+	names = branch_names(n_branches)
+	friend_names = ["weight"] + ["friend_" + name for name in branch_names(n_friend_branches)]
+	ntuples = {
+		"files" : [],
+		"friend_files" : [],
+		"tree_name" : tree_name,
+		"friend_tree_name" : friend_tree_name,
+		"branches" : names,
+		"friend_branches" : friend_names,
+	}
+	# all files contain the same distributions
+	parameters = gaussian_parameters(numpy.random.RandomState(seed), n_branches)
+	friend_parameters = gaussian_parameters(numpy.random.RandomState(seed), n_friend_branches)
+	for file_index in xrange(n_files):
+		random_state = numpy.random.RandomState(seed + file_index + 1)
+		events = numpy.arange(file_index * n_events, (file_index+1) * n_events)
+		categories = random_state.randint(0, 10, n_events)
+
+		file_name = os.path.join(output_dir, "ntuple_{index:d}.root".format(index=file_index))
+		values = correlated_gaussians(random_state, n_events, parameters)
+		write_tree(file_name, tree_name, [events, categories] + list(values.T), ["event/I", "category/I"] + [name+"/F" for name in names])
+		ntuples["files"].append(file_name)
+
+		friend_file_name = os.path.join(output_dir, "friend_{index:d}.root".format(index=file_index))
+		weights = random_state.gamma(4.0, 0.25, n_events)
+		friend_values = correlated_gaussians(random_state, n_events, friend_parameters)
+		write_tree(friend_file_name, friend_tree_name, [events, weights] + list(friend_values.T), ["event/I"] + [name+"/F" for name in friend_names])
+		ntuples["friend_files"].append(friend_file_name)
+
+	log.debug("Generated {n_files:d} files with {n_events:d} events and {n_branches:d} branches each in \"{output_dir}\".".format(
+			n_files=n_files, n_events=n_events, n_branches=n_branches, output_dir=output_dir
+	))
+	return ntuples
+
+
+def fill_histogram(root_histogram, values, weights=None):
+	"""
+	Fill a TH1/TH2 with the given values (array of events x dimensions) at once via numpy.histogramdd
+	"""
+	dimension = root_histogram.GetDimension()
+	axes = [root_histogram.GetXaxis(), root_histogram.GetYaxis()][:dimension]
+	# under- and overflow bins are included
+	bin_edges = [[-numpy.inf] + [axis.GetBinLowEdge(bin_index) for bin_index in xrange(1, axis.GetNbins()+2)] + [numpy.inf] for axis in axes]
+	contents, edges = numpy.histogramdd(values[:, :dimension], bins=bin_edges, weights=weights)
+	sumw2 = contents if weights is None else numpy.histogramdd(values[:, :dimension], bins=bin_edges, weights=weights**2)[0]
+
+	# the ROOT global bin numbering runs fastest along the x-axis
+	root_histogram.SetContent(array.array("d", contents.flatten(order="F")))
+	root_histogram.Sumw2()
+	root_histogram.GetSumw2().Set(len(sumw2.flatten()), array.array("d", sumw2.flatten(order="F")))
+	root_histogram.SetEntries(len(values))
+	return root_histogram
+
+
+def generate_histogram_files(output_dir, n_files=1, n_histograms=4, n_bins=100, directory="histograms", seed=0):
+	"""
+	Generate n_files files with n_histograms one-dimensional histograms (h_<i>) in the given directory
+
+	Returns a dict with the list of "files" and the paths of the histograms in the files.
+	"""
+	if not os.path.exists(output_dir):
+		os.makedirs(output_dir)
+
+	histogram_files = {
+		"files" : [],
+		"histograms" : [os.path.join(directory, "h_{index:d}".format(index=index)) for index in xrange(n_histograms)],
+	}
+	parameters = gaussian_parameters(numpy.random.RandomState(seed), n_histograms)
+	for file_index in xrange(n_files):
+		values = correlated_gaussians(numpy.random.RandomState(seed + file_index + 1), 10 * n_bins, parameters)
+
+		file_name = os.path.join(output_dir, "histograms_{index:d}.root".format(index=file_index))
+		with tfilecontextmanager.TFileContextManager(file_name, "RECREATE") as root_file:
+			root_directory = root_file.mkdir(directory)
+			root_directory.cd()
+			for histogram_index, path in enumerate(histogram_files["histograms"]):
+				root_histogram = ROOT.TH1D(os.path.basename(path), "", n_bins, -20.0, 20.0)
+				fill_histogram(root_histogram, values[:, histogram_index:histogram_index+1])
+				root_histogram.Write()
+		histogram_files["files"].append(file_name)
+	return histogram_files
+
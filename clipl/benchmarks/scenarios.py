@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark scenarios for the performance critical parts of harry
+
+Every scenario is a function registered with the scenario decorator. It receives the
+synthetic inputs of a data size (see Dataset) and a working directory and returns the
+function to be timed, such that the preparation does not enter the measurement. The
+benchmarks are run by run_benchmarks, which records the wall and CPU times of several
+repetitions together with the parameters of the data size and the environment in a
+machine-readable (JSON) result.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import collections
+import datetime
+import json
+import os
+import pipes
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy
+
+import ROOT
+
+import clipl.benchmarks.ntuples as ntuples
+import clipl.core as harrycore
+import clipl.harry as harry
+import clipl.utility.executor as executor
+import clipl.utility.rootcache as rootcache
+import clipl.utility.roottools as roottools
+
+
+# increase in case the content of the results changes
+RESULTS_VERSION = 1
+
+# numbers of events and files are per data size
+SIZES = collections.OrderedDict([
+	("small", {"n_files" : 2, "n_events" : 10000, "n_branches" : 10, "n_histograms" : 4, "n_bins" : 50}),
+	("medium", {"n_files" : 10, "n_events" : 100000, "n_branches" : 50, "n_histograms" : 8, "n_bins" : 200}),
+	("large", {"n_files" : 50, "n_events" : 200000, "n_branches" : 100, "n_histograms" : 16, "n_bins" : 1000}),
+])
+
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(name):
+	"""
+	Decorator registering a scenario function (dataset, work_dir) -> function to be timed
+	"""
+	def decorator(function):
+		SCENARIOS[name] = function
+		return function
+	return decorator
+
+
+class Dataset(object):
+	"""
+	Synthetic inputs of a data size, which are generated only once per working directory and seed
+	"""
+	def __init__(self, data_dir, parameters, seed=0):
+		self.data_dir = data_dir
+		self.parameters = parameters
+		self.seed = seed
+
+		manifest_file = os.path.join(data_dir, "dataset.json")
+		manifest = None
+		if os.path.exists(manifest_file):
+			with open(manifest_file) as dataset_file:
+				manifest = json.load(dataset_file)
+			if (manifest["parameters"] != parameters) or (manifest["seed"] != seed) or (not all([os.path.exists(file_name) for file_name in manifest["ntuples"]["files"]])):
+				manifest = None
+
+		if manifest is None:
+			log.info("Generating inputs in \"{data_dir}\"...".format(data_dir=data_dir))
+			if os.path.exists(data_dir):
+				shutil.rmtree(data_dir)
+			manifest = {
+				"parameters" : parameters,
+				"seed" : seed,
+				"ntuples" : ntuples.generate_ntuples(
+						data_dir, n_files=parameters["n_files"], n_events=parameters["n_events"],
+						n_branches=parameters["n_branches"], seed=seed
+				),
+				"histogram_files" : ntuples.generate_histogram_files(
+						data_dir, n_files=parameters["n_files"], n_histograms=parameters["n_histograms"],
+						n_bins=parameters["n_bins"], seed=seed
+				),
+			}
+			with open(manifest_file, "w") as dataset_file:
+				json.dump(manifest, dataset_file, indent=1, sort_keys=True)
+
+		self.ntuples = manifest["ntuples"]
+		self.histogram_files = manifest["histogram_files"]
+
+
+def _harry_args(dataset, work_dir, args):
+	"""
+	Return the arguments of a plot with the settings common to all benchmarks (no caching, no progress bars)
+	"""
+	return " ".join([
+			args,
+			"--metadata-index-dir", pipes.quote(os.path.join(work_dir, "metadata")),
+			"--output-dir", pipes.quote(os.path.join(work_dir, "plots")),
+			"--filename benchmark --export-json False --hide-progressbar --redo-cache",
+			"--log-level", logging.getLevelName(logging.getLogger().getEffectiveLevel()).lower(),
+	])
+
+
+def _plot(harry_args):
+	return harrycore.HarryCore(args_from_script=harry_args).run()
+
+
+def _tree_inputs(dataset, n_expressions):
+	files = pipes.quote(" ".join(dataset.ntuples["files"]))
+	friend_files = pipes.quote(" ".join(dataset.ntuples["friend_files"]))
+	branches = dataset.ntuples["branches"][:n_expressions]
+	return "-i {files} -f {tree} --friend-files {friend_files} --friend-folders {friend_tree} --friend-aliases friend -x {expressions} --x-bins 100,-30,30 -w {weight}".format(
+			files=files, tree=dataset.ntuples["tree_name"],
+			friend_files=friend_files, friend_tree=dataset.ntuples["friend_tree_name"],
+			expressions=" ".join(branches), weight=pipes.quote("friend.weight*(category<5)"),
+	)
+
+
+@scenario("inputroot_tree_fill")
+def inputroot_tree_fill(dataset, work_dir):
+	"""
+	Fill a histogram per branch (up to 10) from the chained trees with friends, one loop per input
+	"""
+	harry_args = _harry_args(dataset, work_dir, _tree_inputs(dataset, 10) + " --plot-modules ExportRoot")
+	return lambda: _plot(harry_args)
+
+
+@scenario("inputroot_tree_fill_batched")
+def inputroot_tree_fill_batched(dataset, work_dir):
+	"""
+	Fill a histogram per branch (up to 10) from the chained trees with friends in one loop
+	"""
+	harry_args = _harry_args(dataset, work_dir, _tree_inputs(dataset, 10) + " --batched-fill --plot-modules ExportRoot")
+	return lambda: _plot(harry_args)
+
+
+@scenario("histogram_from_file_merging")
+def histogram_from_file_merging(dataset, work_dir):
+	"""
+	Merge a histogram from all histogram files
+	"""
+	files = dataset.histogram_files["files"]
+	path = dataset.histogram_files["histograms"][0]
+	return lambda: roottools.RootTools.histogram_from_file(files, [path], name="merged")
+
+
+def _cache_kwargs(dataset, variable_expression):
+	return {
+		"root_file_names" : dataset.ntuples["files"],
+		"path_to_trees" : [dataset.ntuples["tree_name"]],
+		"friend_files" : None,
+		"friend_folders" : None,
+		"friend_aliases" : None,
+		"root_histogram" : None,
+		"variable_expression" : variable_expression,
+		"name" : "cached",
+		"binning" : "",
+		"weight_selection" : "1",
+		"option" : "",
+		"proxy_prefix" : "",
+		"scan" : None,
+	}
+
+
+def _root_file_cache(dataset, work_dir, memory_max_size):
+	cache_dir = os.path.join(work_dir, "cache")
+	if os.path.exists(cache_dir):
+		shutil.rmtree(cache_dir)
+	root_histogram = roottools.RootTools.histogram_from_file(dataset.histogram_files["files"][:1], dataset.histogram_files["histograms"][:1], name="to_be_cached")
+	root_histogram.SetDirectory(0)
+	cache = rootcache.RootFileCache(cache_dir, memory_max_size=memory_max_size)
+	return cache, cache(lambda **kwargs: (None, root_histogram, []))
+
+
+@scenario("rootfilecache_miss")
+def rootfilecache_miss(dataset, work_dir):
+	"""
+	Look up and store 100 different objects in a RootFileCache
+	"""
+	cache, cached_function = _root_file_cache(dataset, work_dir, memory_max_size=0)
+	repetition = [0]
+	def run():
+		repetition[0] += 1
+		for index in xrange(100):
+			cached_function(**_cache_kwargs(dataset, "var0+{repetition:d}.{index:d}".format(repetition=repetition[0], index=index)))
+	return run
+
+
+@scenario("rootfilecache_hit")
+def rootfilecache_hit(dataset, work_dir):
+	"""
+	Load 100 objects from the files of a RootFileCache
+	"""
+	cache, cached_function = _root_file_cache(dataset, work_dir, memory_max_size=0)
+	list_of_kwargs = [_cache_kwargs(dataset, "var0+{index:d}".format(index=index)) for index in xrange(100)]
+	for kwargs in list_of_kwargs:
+		cached_function(**kwargs)
+	return lambda: [cached_function(**kwargs) for kwargs in list_of_kwargs]
+
+
+@scenario("rootfilecache_memory_hit")
+def rootfilecache_memory_hit(dataset, work_dir):
+	"""
+	Load 100 objects kept in memory by a RootFileCache
+	"""
+	cache, cached_function = _root_file_cache(dataset, work_dir, memory_max_size=256*1024*1024)
+	list_of_kwargs = [_cache_kwargs(dataset, "var0+{index:d}".format(index=index)) for index in xrange(100)]
+	for kwargs in list_of_kwargs:
+		cached_function(**kwargs)
+	return lambda: [cached_function(**kwargs) for kwargs in list_of_kwargs]
+
+
+@scenario("rebin_root_histogram")
+def rebin_root_histogram(dataset, work_dir):
+	"""
+	Rebin a two-dimensional histogram (n_bins x n_bins) to variable bin widths
+	"""
+	n_bins = dataset.parameters["n_bins"]
+	root_histogram = ROOT.TH2D("to_be_rebinned", "", n_bins, -20.0, 20.0, n_bins, -20.0, 20.0)
+	root_histogram.SetDirectory(0)
+	values = ntuples.correlated_gaussians(numpy.random.RandomState(dataset.seed), 100 * n_bins, ntuples.gaussian_parameters(numpy.random.RandomState(dataset.seed), 2))
+	ntuples.fill_histogram(root_histogram, values)
+
+	# every second bin edge of the first half and every fifth of the second half
+	bin_edges = [root_histogram.GetXaxis().GetBinLowEdge(bin_index) for bin_index in xrange(1, n_bins+2)]
+	target_bin_edges = bin_edges[:n_bins//2:2] + bin_edges[n_bins//2::5]
+	if target_bin_edges[-1] != bin_edges[-1]:
+		target_bin_edges.append(bin_edges[-1])
+	return lambda: roottools.RootTools.rebin_root_histogram(root_histogram, rebinningX=target_bin_edges, rebinningY=target_bin_edges, name="rebinned")
+
+
+def _histogram_inputs(dataset):
+	files = pipes.quote(" ".join(dataset.histogram_files["files"]))
+	histograms = dataset.histogram_files["histograms"]
+	return "-i {files} -x {histograms} --nicks {nicks}".format(
+			files=files, histograms=" ".join(histograms),
+			nicks=" ".join(["h{index:d}".format(index=index) for index in xrange(len(histograms))]),
+	)
+
+
+@scenario("analysis_modules")
+def analysis_modules(dataset, work_dir):
+	"""
+	Run a chain of analysis modules on the merged histograms
+	"""
+	harry_args = _harry_args(dataset, work_dir, _histogram_inputs(dataset) + " " + " ".join([
+			"--analysis-modules NormalizeToUnity CumulativeDistribution Ratio",
+			"--ratio-numerator-nicks h1 --ratio-denominator-nicks h0 --ratio-result-nicks ratio",
+			"--plot-modules ExportRoot",
+	]))
+	return lambda: _plot(harry_args)
+
+
+@scenario("plotroot_save")
+def plotroot_save(dataset, work_dir):
+	"""
+	Draw the merged histograms with PlotRoot and save them as PNG, PDF and ROOT file
+	"""
+	harry_args = _harry_args(dataset, work_dir, _histogram_inputs(dataset) + " --plot-modules PlotRoot --formats png pdf root")
+	return lambda: _plot(harry_args)
+
+
+@scenario("plotmpl_save")
+def plotmpl_save(dataset, work_dir):
+	"""
+	Draw the merged histograms with PlotMpl and save them as PNG and PDF
+	"""
+	harry_args = _harry_args(dataset, work_dir, _histogram_inputs(dataset) + " --plot-modules PlotMpl --formats png pdf")
+	return lambda: _plot(harry_args)
+
+
+def _cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+
+def _median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	return values[middle] if len(values) % 2 == 1 else 0.5 * (values[middle-1] + values[middle])
+
+
+def run_scenario(name, dataset, work_dir, n_repetitions=5, n_warmup=1):
+	"""
+	Run a scenario and return a dict with the wall and CPU times of all repetitions
+	"""
+	result = {
+		"scenario" : name,
+		"description" : (SCENARIOS[name].__doc__ or "").strip(),
+		"parameters" : dataset.parameters,
+		"n_repetitions" : n_repetitions,
+		"wall_times" : [],
+		"cpu_times" : [],
+		"error" : None,
+	}
+	scenario_dir = os.path.join(work_dir, name)
+	if not os.path.exists(scenario_dir):
+		os.makedirs(scenario_dir)
+	try:
+		function = SCENARIOS[name](dataset, scenario_dir)
+		for repetition in xrange(n_warmup + n_repetitions):
+			start_wall_time, start_cpu_time = time.time(), _cpu_time()
+			function()
+			if repetition >= n_warmup:
+				result["wall_times"].append(time.time() - start_wall_time)
+				result["cpu_times"].append(_cpu_time() - start_cpu_time)
+	except (Exception, SystemExit):
+		result["error"] = traceback.format_exc()
+		log.error("Benchmark \"{name}\" failed:\n{error}".format(name=name, error=result["error"]))
+
+	if len(result["wall_times"]) > 0:
+		result.update({
+			"min_wall_time" : min(result["wall_times"]),
+			"median_wall_time" : _median(result["wall_times"]),
+			"median_cpu_time" : _median(result["cpu_times"]),
+		})
+	result["rss"] = executor.get_rss()
+	return result
+
+
+def _git_revision():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w")).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run_benchmarks(work_dir, scenarios=None, sizes=None, n_repetitions=5, n_warmup=1, seed=0):
+	"""
+	Run the given scenarios (default: all) for the given data sizes (default: all) and return the results
+
+	The results contain the environment (host, versions, revision) and a list of the results per scenario and size.
+	"""
+	harry.prepare_root()
+	ROOT.gROOT.SetBatch(True)
+
+	# the inputs are read every time, but the caches of the plots are kept separate from the common ones
+	roottools.RootTools.tree_draw_cache.cache_dir = os.path.join(work_dir, "tree_draw_cache")
+
+	results = {
+		"version" : RESULTS_VERSION,
+		"date" : datetime.datetime.now().isoformat(),
+		"host" : socket.gethostname(),
+		"platform" : platform.platform(),
+		"python_version" : platform.python_version(),
+		"root_version" : ROOT.gROOT.GetVersion(),
+		"git_revision" : _git_revision(),
+		"command" : " ".join(sys.argv),
+		"seed" : seed,
+		"results" : [],
+	}
+	for size in (sizes or SIZES.keys()):
+		dataset = Dataset(os.path.join(work_dir, "data", size), SIZES[size], seed=seed)
+		for name in (scenarios or SCENARIOS.keys()):
+			log.info("Running benchmark \"{name}\" ({size})...".format(name=name, size=size))
+			result = run_scenario(name, dataset, os.path.join(work_dir, "runs", size), n_repetitions=n_repetitions, n_warmup=n_warmup)
+			result["size"] = size
+			results["results"].append(result)
+			if not result["error"]:
+				log.info("\t{median:.3f} s (median), {minimum:.3f} s (minimum), {cpu:.3f} s CPU (median)".format(
+						median=result["median_wall_time"], minimum=result["min_wall_time"], cpu=result["median_cpu_time"]
+				))
+	return results
+
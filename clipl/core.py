@@ -3,21 +3,14 @@
 """
 """
 import os
-import fnmatch
 import shlex
 import sys
-import imp
-import inspect
 import copy
 import logging
 import clipl.utility.logger as logger
 log = logging.getLogger(__name__)
 
 
-import ROOT
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-ROOT.gErrorIgnoreLevel = ROOT.kError
-
 import clipl.harryparser as harryparser
 import clipl.plotdata as plotdata
 
@@ -26,8 +19,10 @@ from clipl.inputbase import InputBase
 from clipl.plotbase import PlotBase
 
 import clipl.processor as processor
+import clipl.processorregistry as processorregistry
 
 from clipl.utility.jsonTools import JsonDict
+import clipl.utility.profiling as profiling
 import clipl.utility.tools as tools
 
 JsonDict.COMMENT_DELIMITER = "@"
@@ -44,6 +39,10 @@ class HarryCore(object):
 		self.available_processors = {}
 		# List of active processors
 		self.processors = []
+		# Plot data of the last run
+		self.plot_data = None
+		# (plot data, exported arguments, number of prepared processors) of a run in plan mode
+		self._planned_run = None
 
 		# First time parsing of cmd arguments
 		if parser == None:
@@ -76,35 +75,84 @@ class HarryCore(object):
 			self.register_modules_dir(directory)
 
 	def _detect_available_processors(self):
-		"""Detect all valid processors in modules_dirs and add them to avalaible processors."""
-
-		modules_dirs = self._modules_dirs
-		# Loop over all possible module files
-		matches = []
-		for module_dir in modules_dirs:
-			for root, dirnames, filenames in os.walk(module_dir):
-				for filename in fnmatch.filter(filenames, '*.py'):
-					matches.append(os.path.join(root, filename))
-
-		for filename in matches:
-			try:
-				log.debug("Importing modules from path {0}.".format(filename))
-				module_name = os.path.splitext(os.path.basename(filename))[0]
-				module = imp.load_source(module_name, filename)
-				for name, obj in inspect.getmembers(module):
-					if inspect.isclass(obj):
-						if (issubclass(obj, AnalysisBase) or issubclass(obj, InputBase) or
-						    issubclass(obj, PlotBase)):
-							#log.debug("Adding module {0} to available processors.".format(obj.name()))
-							self.available_processors[obj.name()] = obj
-			except ImportError as e:
-				log.warning("Failed to import module {0} from {1}.".format(module_name, filename))
-				log.warning("Error message {0}.".format(e))
-				pass
-
-	def run(self):
+		"""Detect all valid processors in modules_dirs and add them to avalaible processors.
+		   The modules are only imported when the processors are used (see processorregistry).
+		"""
+		registered_processors = self.available_processors
+		self.available_processors = processorregistry.get_processor_registry(self._modules_dirs)
+		for name, processor in registered_processors.items():
+			self.available_processors[name] = processor
+
+	def run(self, plan=False):
 		"""Add all requested processors, then reparse all command line arguments.
 		   Finally prepare and run all processors.
+		   In plan mode, only the input processors are prepared and their fill tasks are returned.
+		   A following run continues with the prepared processors instead of preparing them again.
+		"""
+		if self._planned_run is None:
+			plotData, export_args = self._prepare_run()
+			n_prepared_processors = 0
+		else:
+			plotData, export_args, n_prepared_processors = self._planned_run
+			self._planned_run = None
+
+		if plotData.plotdict["profile"]:
+			profiling.enable(plotData.plotdict["profile"])
+		else:
+			profiling.disable()
+
+		# general ROOT settings
+		# ROOT is imported not before here, such that listing the modules does not need to load it
+		import ROOT
+		ROOT.PyConfig.IgnoreCommandLineOptions = True
+		ROOT.gErrorIgnoreLevel = ROOT.kError
+		log.debug("Setting ROOT TH1 DefaultSumw2 to True.")
+		ROOT.TH1.SetDefaultSumw2(True)
+		ROOT.gROOT.SetBatch(True)
+
+		# prepare aguments for all processors before running them
+		fill_tasks = []
+		for index, processor in enumerate(self.processors):
+			if plan and not isinstance(processor, InputBase):
+				break
+			processor_category = "input" if isinstance(processor, InputBase) else ("analysis" if isinstance(processor, AnalysisBase) else "plot")
+			if index >= n_prepared_processors:
+				with profiling.profile(processor.name()+".prepare_args", processor_category):
+					processor.prepare_args(self.parser, plotData)
+				n_prepared_processors = index+1
+			if plan:
+				fill_tasks.extend(processor.plan_fills(plotData))
+			elif not plotData.plotdict["dry_run"]:
+				with profiling.profile(processor.name()+".run", processor_category):
+					processor.run(plotData)
+		if plan:
+			self._planned_run = (plotData, export_args, n_prepared_processors)
+			return fill_tasks
+
+		# export arguments into JSON file
+		output_filenames = []
+		if plotData.plotdict["export_json"] != "default" and plotData.plotdict["export_json"] not in [False, "False", None, "None"]:
+			if self.args["no_overwrite"] and os.path.isfile(plotData.plotdict["export_json"]):
+				plotData.plotdict["export_json"], suffix = tools.get_checked_and_renamed(plotData.plotdict["export_json"])
+				add_suff = lambda x: '.'.join(x.split('.')[:-1]) + suffix + '.' + x.split('.')[-1]
+				plotData.plotdict["output_filenames"] = [add_suff(x) for x in plotData.plotdict["output_filenames"]]
+
+			json_filename = plotData.plotdict["export_json"]
+			export_args.save(json_filename, indent=4)
+			log.info("Created config \"%s\"." % json_filename)
+			if plotData.plotdict["dry_run"]:
+				output_filenames = [json_filename]
+		else:
+			plotData.plotdict["export_json"] = None
+
+		# save plots
+		if not plotData.plotdict["dry_run"]:
+			output_filenames = plotData.save()
+		return output_filenames
+
+	def _prepare_run(self):
+		"""Add all requested processors, reparse all command line arguments and create the plot data.
+		   Returns the plot data and the arguments to be exported into JSON files.
 		"""
 		# Detect all valid processors
 		self._detect_available_processors()
@@ -112,7 +160,7 @@ class HarryCore(object):
 		json_default_initialisation = None
 		if self.args["json_defaults"] is not None:
 			json_default_initialisation = self.args["json_defaults"]
-			json_defaults = JsonDict(self.args["json_defaults"]).doIncludes().doComments()
+			json_defaults = JsonDict.resolve(self.args["json_defaults"])
 			#set_defaults will overwrite/ignore the json_default argument. Cannot be used.
 			no_default_args = dict((k,v) for (k,v) in self.args.items() if not self.parser.get_default(k) == self.args[k] )
 			self.args.update(dict(json_defaults.items() + no_default_args.items()))
@@ -166,12 +214,13 @@ class HarryCore(object):
 
 		# overwrite defaults by defaults from json files
 		if self.args["json_defaults"] != None:
-			self.parser.set_defaults(**(JsonDict(self.args["json_defaults"]).doIncludes().doComments()))
+			self.parser.set_defaults(**(JsonDict.resolve(self.args["json_defaults"])))
 
 		log.debug("Second parsing of arguments...")
 		self.args = vars(self.parser.parse_args(self._args_from_script))
 		log.debug("\tdone.")
 		plotData = plotdata.PlotData(self.args)
+		self.plot_data = plotData
 
 		# print the final processor chain
 		log.debug('Processors will be run in the following order')
@@ -180,52 +229,21 @@ class HarryCore(object):
 		if not plotData.plotdict['no_logo']:
 			self._logo()
 
-		# general ROOT settings
-		log.debug("Setting ROOT TH1 DefaultSumw2 to True.")
-		ROOT.TH1.SetDefaultSumw2(True)
-		ROOT.gROOT.SetBatch(True)
-
 		# export arguments into JSON file (1)
 		# remove entries from dictionary that are not meant to be exported
 		export_args = JsonDict(copy.deepcopy(plotData.plotdict))
-		for arg in ["quantities", "export_json", "live", "dry_run", "userpc", "json_defaults"]:
+		for arg in ["quantities", "export_json", "live", "dry_run", "userpc", "json_defaults", "profile", "record_plot_timings"]:
 			export_args.pop(arg, None)
 		# remove defaults
+		json_defaults_keys = [] if self.args.get("json_defaults", None) is None else JsonDict.resolve(self.args["json_defaults"]).keys()
 		for key in export_args.keys():
 			if (key in self.args and self.parser.get_default(key) == export_args[key]
-						and (self.args.get("json_defaults", None) is None or
-						key not in JsonDict(self.args["json_defaults"]).doIncludes().doComments())):
+						and key not in json_defaults_keys):
 				export_args.pop(key, None)
 
 		if plotData.plotdict["export_json"] == "update":
 			plotData.plotdict["export_json"] = "default" if plotData.plotdict["json_defaults"] is None else plotData.plotdict["json_defaults"][0]
-
-		# prepare aguments for all processors before running them
-		for processor in self.processors:
-			processor.prepare_args(self.parser, plotData)
-			if not plotData.plotdict["dry_run"]:
-				processor.run(plotData)
-
-		# export arguments into JSON file
-		output_filenames = []
-		if plotData.plotdict["export_json"] != "default" and plotData.plotdict["export_json"] not in [False, "False", None, "None"]:
-			if self.args["no_overwrite"] and os.path.isfile(plotData.plotdict["export_json"]):
-				plotData.plotdict["export_json"], suffix = tools.get_checked_and_renamed(plotData.plotdict["export_json"])
-				add_suff = lambda x: '.'.join(x.split('.')[:-1]) + suffix + '.' + x.split('.')[-1]
-				plotData.plotdict["output_filenames"] = [add_suff(x) for x in plotData.plotdict["output_filenames"]]
-
-			json_filename = plotData.plotdict["export_json"]
-			export_args.save(json_filename, indent=4)
-			log.info("Created config \"%s\"." % json_filename)
-			if plotData.plotdict["dry_run"]:
-				output_filenames = [json_filename]
-		else:
-			plotData.plotdict["export_json"] = None
-
-		# save plots
-		if not plotData.plotdict["dry_run"]:
-			output_filenames = plotData.save()
-		return output_filenames
+		return plotData, export_args
 
 	def register_processor(self, processor):
 		"""Add processor to list of available processors."""
@@ -264,17 +282,16 @@ class HarryCore(object):
 	def _print_available_modules(self):
 		"""Prints all available modules to stdout."""
 		title_strings = ["Input modules:", "Analysis modules:", "Plot modules:"]
-		baseclasses = [InputBase, AnalysisBase, PlotBase]
-		for index, (title_string, baseclass) in enumerate(zip(title_strings, baseclasses)):
+		for index, (title_string, processor_type) in enumerate(zip(title_strings, processorregistry.PROCESSOR_TYPES)):
 			log.info(("\n" if index > 0 else "")+tools.get_colored_string(title_string, "yellow"))
-			self._print_module_list(sorted([module for module in self.available_processors if issubclass(self.available_processors[module], baseclass)]))
+			self._print_module_list(sorted([module for module in self.available_processors if self.available_processors.processor_type(module) == processor_type]))
 
 	def _print_module_list(self, module_list):
 		"""Print a list of modules (name and docstring)"""
 		for module in module_list:
 			log.info("\t"+tools.get_colored_string("{}".format(module), "green"))
-			if inspect.getdoc(self.available_processors[module]):
-				log.info(tools.get_indented_text("\t\t", inspect.getdoc(self.available_processors[module])))
+			if self.available_processors.docstring(module):
+				log.info(tools.get_indented_text("\t\t", self.available_processors.docstring(module)))
 
 
 	def _logo(self):
@@ -12,44 +12,95 @@ import shlex
 import string
 import sys
 import tempfile
+import time
 import traceback
 
-import ROOT
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-ROOT.gErrorIgnoreLevel = ROOT.kError
-for root_type in [
-		ROOT.TFile, ROOT.TDirectory, ROOT.TDirectoryFile,
-		ROOT.TTree, ROOT.TChain, ROOT.TNtuple,
-		ROOT.TH1, ROOT.TH1F, ROOT.TH1D,
-		ROOT.TH2, ROOT.TH2F, ROOT.TH2D,
-		ROOT.TH3, ROOT.TH3F, ROOT.TH3D,
-		ROOT.TProfile, ROOT.TProfile2D,
-		ROOT.TGraph, ROOT.TGraphErrors, ROOT.TGraphAsymmErrors,
-		ROOT.TGraph2D, ROOT.TGraph2DErrors,
-		ROOT.TF1, ROOT.TF2, ROOT.TF3,
-		ROOT.TCanvas, ROOT.TPad, ROOT.TLegend,
-]:
-	root_type.__init__._creates = True # https://root.cern.ch/phpBB3/viewtopic.php?t=9786
-
+import clipl.utility.executor as executor
 import clipl.utility.jsonTools as jsonTools
+import clipl.utility.profiling as profiling
+import clipl.utility.staging as staging
 import clipl.utility.tools as tools
 import clipl.core as harrycore
+import clipl.harryserver as harryserver
+
+
+_root_prepared = False
+
+# HarryCores prepared by HarryPlotter.plan_inputs (plot index -> (harry args, HarryCore)),
+# which are inherited by the processes creating the plots. The HarryCores are released as
+# soon as their plots have been started, see release_planned_harry_core.
+_planned_harry_cores = {}
+
+def release_planned_harry_core(event, plot_index, process_executor):
+	# the worker process creating the plot has inherited the HarryCore already
+	if event == executor.STARTED_EVENT:
+		_planned_harry_cores.pop(plot_index, None)
+
+def prepare_root():
+	"""
+	Import and configure ROOT (only once per process)
+
+	ROOT is not imported at module level, such that e.g. listing the available modules does not need to load it.
+	"""
+	global _root_prepared
+	if _root_prepared:
+		return
+
+	import ROOT
+	ROOT.PyConfig.IgnoreCommandLineOptions = True
+	ROOT.gErrorIgnoreLevel = ROOT.kError
+	for root_type in [
+			ROOT.TFile, ROOT.TDirectory, ROOT.TDirectoryFile,
+			ROOT.TTree, ROOT.TChain, ROOT.TNtuple,
+			ROOT.TH1, ROOT.TH1F, ROOT.TH1D,
+			ROOT.TH2, ROOT.TH2F, ROOT.TH2D,
+			ROOT.TH3, ROOT.TH3F, ROOT.TH3D,
+			ROOT.TProfile, ROOT.TProfile2D,
+			ROOT.TGraph, ROOT.TGraphErrors, ROOT.TGraphAsymmErrors,
+			ROOT.TGraph2D, ROOT.TGraph2DErrors,
+			ROOT.TF1, ROOT.TF2, ROOT.TF3,
+			ROOT.TCanvas, ROOT.TPad, ROOT.TLegend,
+	]:
+		root_type.__init__._creates = True # https://root.cern.ch/phpBB3/viewtopic.php?t=9786
+	_root_prepared = True
 
 
 def pool_plot(args):
+	prepare_root()
+	import clipl.utility.roottools as roottools
+	cache_statistics = roottools.RootTools.tree_draw_cache.statistics.copy()
 	try:
-		return (args[0].plot(*args[1:]), None, None)
+		result = (args[0].plot(*args[1:]), None, None)
 	except SystemExit as e:
-		return (None, args[0].harry_args[args[1]], None)
+		result = (None, args[0].harry_args[args[1]], None)
 	except Exception as e:
-		return (None, args[0].harry_args[args[1]], traceback.format_exc())
+		result = (None, args[0].harry_args[args[1]], traceback.format_exc())
+	
+	# cache statistics and profile of this plot for the summary in the main process
+	return result + (roottools.RootTools.tree_draw_cache.statistics - cache_statistics, profiling.pop_profile())
 
 
 class HarryPlotter(object):
-	def __init__(self, list_of_config_dicts=None, list_of_args_strings=None, n_processes=1, n_plots=None, batch=None, standalone_executable=None):
+	def __init__(self, list_of_config_dicts=None, list_of_args_strings=None, n_processes=1, n_plots=None, batch=None, standalone_executable=None,
+	             plot_timeout=None, max_plots_per_process=50, max_rss=None, input_planning=True, batch_job_time=None, keep_harry_cores=False):
+		"""
+		plot_timeout: maximum time per plot in seconds in case of multiple processes (None: unlimited)
+		max_plots_per_process: number of plots after which a plotting process is replaced by a new one
+		max_rss: memory usage (RSS) in MB after which a plotting process is replaced by a new one (None: unlimited)
+		input_planning: fill the inputs of all plots (deduplicated) before creating them in multiple processes
+		batch_job_time: targeted wall time in seconds of batch jobs, into which the plots are packed (e.g. 1200, None: one job per plot)
+		keep_harry_cores: keep the HarryCore (including the ROOT objects) of every plot in self.harry_cores.
+		                  Otherwise, the ROOT objects created by a plot are released after it has been saved.
+		"""
 		if standalone_executable is None:
 			standalone_executable = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts/standalone_harry.sh")
 		self.standalone_executable = standalone_executable
+		self.plot_timeout = plot_timeout
+		self.max_plots_per_process = max_plots_per_process
+		self.max_rss = max_rss
+		self.input_planning = input_planning
+		self.batch_job_time = batch_job_time
+		self.keep_harry_cores = keep_harry_cores
 		
 		self.output_filenames = self.multi_plots(
 				list_of_config_dicts=list_of_config_dicts,
@@ -61,13 +112,61 @@ class HarryPlotter(object):
 	
 	def plot(self, plot_index):
 		tmp_harry_args = self.harry_args[plot_index]
-		harry_core = harrycore.HarryCore(args_from_script=tmp_harry_args)
+		planned_harry_args, harry_core = _planned_harry_cores.pop(plot_index, (None, None))
+		if (harry_core is None) or (planned_harry_args != tmp_harry_args):
+			harry_core = harrycore.HarryCore(args_from_script=tmp_harry_args)
 		if not tmp_harry_args is None:
 			log.debug("harry.py " + tmp_harry_args)
-		output_filenames = harry_core.run()
-		self.harry_cores[plot_index] = harry_core # TODO: thread-safe?
+		memory_tracker = None
+		if not harry_core.args["list_available_modules"]:
+			prepare_root()
+			import clipl.utility.memorytracker as memorytracker
+			memory_tracker = memorytracker.RootObjectTracker()
+		try:
+			start_time = time.time()
+			output_filenames = harry_core.run()
+			if harry_core.args.get("record_plot_timings", False) and (not harry_core.args.get("dry_run", False)):
+				# timings for the cost estimates of batch jobs
+				import clipl.utility.jobpacking as jobpacking
+				import clipl.utility.rootfileindex as rootfileindex
+				jobpacking.get_plot_cost_model(rootfileindex.default_index_dir()).record(harry_core.args, time.time()-start_time)
+			if self.keep_harry_cores:
+				self.harry_cores[plot_index] = harry_core
+		finally:
+			if not memory_tracker is None:
+				log.debug("After plot {index:d}: {statistics}".format(index=plot_index, statistics=memory_tracker.get_statistics_string()))
+				if not self.keep_harry_cores:
+					n_released = memory_tracker.cleanup(harry_core.plot_data)
+					del harry_core
+					log.debug("After releasing {n:d} ROOT objects of plot {index:d}: {statistics}".format(n=n_released, index=plot_index, statistics=memory_tracker.get_statistics_string()))
 		return output_filenames
 	
+	def plan_inputs(self, n_processes=1):
+		"""
+		Fill the inputs of all plots before creating them, such that inputs shared by several plots are filled only once
+
+		The prepared HarryCores are kept for creating the plots (see plot), such that every plot is prepared only once.
+		"""
+		prepare_root()
+		import clipl.utility.fillplanner as fillplanner
+		fill_planner = fillplanner.FillPlanner()
+		
+		_planned_harry_cores.clear()
+		for plot_index, harry_args in enumerate(self.harry_args):
+			try:
+				harry_core = harrycore.HarryCore(args_from_script=harry_args)
+				fill_planner.add(harry_core.run(plan=True))
+				_planned_harry_cores[plot_index] = (harry_args, harry_core)
+			except (SystemExit, Exception):
+				log.warning("Planning the inputs of plot {index:d} failed. They are read while creating the plot.".format(index=plot_index))
+				log.debug(traceback.format_exc())
+		
+		log.info(fill_planner.get_statistics_string())
+		try:
+			fill_planner.run(n_processes=n_processes)
+		except SystemExit:
+			log.warning("Filling the planned inputs failed. They are read while creating the plots.")
+	
 	def multi_plots(self, list_of_config_dicts, list_of_args_strings, n_processes=1, n_fast_plots=None, batch=None):
 		config_dicts = list_of_config_dicts if isinstance(list_of_config_dicts, collections.Iterable) and not isinstance(list_of_config_dicts, basestring) else [list_of_config_dicts]
 		args_strings = list_of_args_strings if isinstance(list_of_args_strings, collections.Iterable) and not isinstance(list_of_args_strings, basestring) else [list_of_args_strings]
@@ -94,7 +193,7 @@ class HarryPlotter(object):
 				if not batch is None:
 					config_dict["dry_run"] = True
 				if "json_defaults" in config_dict:
-					json_defaults_dict = jsonTools.JsonDict(config_dict["json_defaults"]).doIncludes().doComments()
+					json_defaults_dict = jsonTools.JsonDict.resolve(config_dict["json_defaults"])
 					config_dict.pop("json_defaults")
 					json_defaults_dict.update(config_dict)
 					config_dict = json_defaults_dict
@@ -114,17 +213,62 @@ class HarryPlotter(object):
 			self.harry_args = self.harry_args[:n_fast_plots]
 			n_plots = len(self.harry_args)
 		
+		# start staging remote inputs of all plots, each plot only waits for its own inputs
+		# plots created in parallel processes stage their inputs themselves, since the threads
+		# of this process would need to be stopped before forking the processes
+		for config_dict in (config_dicts[:n_plots] if (n_processes <= 1) or (n_plots <= 1) else []):
+			if (not config_dict is None) and config_dict.get("stage_remote_files", False):
+				staging_pool = staging.get_staging_pool(
+						os.path.expandvars(config_dict.get("staging_dir", "$HP_WORK_BASE_COMMON/staging")),
+						n_threads=config_dict.get("n_staging_threads", 4),
+						n_retries=config_dict.get("staging_retries", 3)
+				)
+				staging_pool.stage_json([config_dict.get("files", []), config_dict.get("friend_files", [])])
+		
 		self.harry_cores = [None]*n_plots
 		
-		# multi processing of multiple plots
+		# plots created by a running harry server
 		output_filenames = []
 		failed_plots = []
-		if (n_plots > 1) and (n_processes > 1):
-			log.info("Creating {:d} plots in {:d} processes".format(n_plots, min(n_processes, n_plots)))
-			results = tools.parallelize(pool_plot, zip([self]*n_plots, range(n_plots)), n_processes, description="Plotting")
-			tmp_output_filenames, tmp_failed_plots, tmp_error_messages = zip(*([result for result in results if not result is None and result != (None,)]))
-			output_filenames = [output_filename for output_filename in tmp_output_filenames if not output_filename is None]
-			failed_plots = [(failed_plot, error_message) for failed_plot, error_message in zip(tmp_failed_plots, tmp_error_messages) if not failed_plot is None]
+		server_results = None
+		if (n_plots > 0) and (batch is None):
+			server_results = harryserver.forward(self.harry_args, timeout=(self.plot_timeout or harryserver.PLOT_TIMEOUT))
+		if not server_results is None:
+			log.debug("Plots created by the harry server.")
+			for harry_args, result in zip(self.harry_args, server_results):
+				sys.stdout.write(result["log"])
+				profiling.merge(result.get("profile", None))
+				if result["failed"]:
+					failed_plots.append((harry_args, result["traceback"]))
+				else:
+					output_filenames.append(result["output_filenames"])
+		
+		# multi processing of multiple plots
+		elif (n_plots > 1) and (n_processes > 1):
+			try:
+				if self.input_planning:
+					self.plan_inputs(n_processes=n_processes)
+				log.info("Creating {:d} plots in {:d} processes".format(n_plots, min(n_processes, n_plots)))
+				results = tools.parallelize(
+						pool_plot, zip([self]*n_plots, range(n_plots)), n_processes, description="Plotting",
+						timeout=self.plot_timeout, max_tasks_per_process=self.max_plots_per_process, max_rss=self.max_rss,
+						callback=release_planned_harry_core, ignore_failures=True
+				)
+			finally:
+				_planned_harry_cores.clear()
+			import clipl.utility.roottools as roottools
+			for plot_index, result in enumerate(results):
+				if result is None:
+					# the plotting process has been stopped (timeout) or has crashed
+					failed_plots.append((self.harry_args[plot_index], None))
+					continue
+				output_filename, failed_plot, error_message, cache_statistics, plot_profile = result
+				roottools.RootTools.tree_draw_cache.statistics.update(cache_statistics)
+				profiling.merge(plot_profile)
+				if not output_filename is None:
+					output_filenames.append(output_filename)
+				if not failed_plot is None:
+					failed_plots.append((failed_plot, error_message))
 		
 		# single processing of multiple plots
 		elif n_plots > 1:
@@ -142,6 +286,14 @@ class HarryPlotter(object):
 		elif n_plots > 0:
 			output_filenames.append(self.plot(0))
 		
+		if n_plots > 1:
+			import clipl.utility.roottools as roottools
+			if sum(roottools.RootTools.tree_draw_cache.statistics.values()) > 0:
+				log.info(roottools.RootTools.tree_draw_cache.get_statistics_string())
+		for statistics_string in staging.get_statistics_strings():
+			log.info(statistics_string)
+		profiling.save()
+		
 		# batch submission
 		if (not (batch is None)) and (len(failed_plots) < n_plots):
 			try:
@@ -160,12 +312,43 @@ class HarryPlotter(object):
 			with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "/data/grid-control_backend_" + batch + ".conf"), "r") as backend_config_file:
 				backend_config = backend_config_file.read()
 			
+			json_configs = [item[0] for item in output_filenames]
+			if self.batch_job_time is None:
+				job_configs = json_configs
+				executable = self.standalone_executable
+				arguments = "-c @CMSSW_BASE@ -d @CWD@ \" -j @JSON_CONFIG@ --log-level debug --record-plot-timings\""
+				wall_time = 1800.0
+			else:
+				# pack plots into jobs of roughly equal wall time
+				import clipl.utility.jobpacking as jobpacking
+				import clipl.utility.rootfileindex as rootfileindex
+				cost_model = jobpacking.get_plot_cost_model(rootfileindex.default_index_dir())
+				plot_configs = [jsonTools.JsonDict(json_config) for json_config in json_configs]
+				costs = [cost_model.estimate(plot_config) for plot_config in plot_configs]
+				jobs = jobpacking.pack(costs, [jobpacking.plot_inputs(plot_config) for plot_config in plot_configs], self.batch_job_time)
+				job_costs = [sum([costs[plot_index] for plot_index in job]) for job in jobs]
+				log.info("Packed {n_plots:d} plots into {n_jobs:d} batch jobs (estimated {min_time:.0f} s to {max_time:.0f} s per job).".format(
+						n_plots=len(json_configs), n_jobs=len(jobs), min_time=min(job_costs), max_time=max(job_costs)
+				))
+				# every job gets a file listing its JSON configs, whose plots are created one after another
+				# through the same environment setup as single plots (see scripts/harry_packed_job.sh)
+				job_configs = []
+				for job_index, job in enumerate(jobs):
+					job_configs.append(os.path.join(workdir, "packed_job_{index:d}.txt".format(index=job_index)))
+					with open(job_configs[-1], "w") as job_config_file:
+						job_config_file.write("".join([os.path.abspath(json_configs[plot_index])+"\n" for plot_index in job]))
+				executable = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts/harry_packed_job.sh")
+				arguments = self.standalone_executable + " @CMSSW_BASE@ @CWD@ @JSON_CONFIG@"
+				wall_time = max(1800.0, 2.0 * max(job_costs))
+			
 			final_config = string.Template(main_config).safe_substitute(
 					cmsswbase=os.path.expandvars("$CMSSW_BASE"),
 					hpworkbase=os.path.expandvars("$HP_WORK_BASE"),
 					cwd=os.getcwd(),
-					jsonconfigs="\n\t"+("\n\t".join([item[0] for item in output_filenames])),
-					executable=self.standalone_executable,
+					jsonconfigs="\n\t"+("\n\t".join(job_configs)),
+					executable=executable,
+					arguments=arguments,
+					walltime="{:02d}:{:02d}:00".format(int(wall_time) // 3600, int(wall_time) % 3600 // 60),
 					workdir=workdir,
 					backend=backend_config
 			)
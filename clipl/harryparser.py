@@ -36,6 +36,12 @@ class HarryParser(argparse.ArgumentParser):
 		                  help="Only execute prepare_args functions and safe the JSON file (if not configured differently).")
 		self.add_argument("--no-logo", default=True, action="store_true",
 		                  help="Don't show the HarryPlotter logo at startup.")
+		self.add_argument("--no-daemon", default=False, action="store_true",
+		                  help="Create the plots in this process even if a harry server (harry_server.py) is running.")
+		self.add_argument("--record-plot-timings", default=False, action="store_true",
+		                  help="Record the time needed for this plot, which is used for estimating the wall times when packing plots into batch jobs. This is enabled in the submitted batch jobs. [Default: %(default)s]")
+		self.add_argument("--profile", default=None, const="harry_profile.json", nargs="?",
+		                  help="Record the wall and CPU times of all processing steps and write them to this JSON file and as Chrome trace to <file>.trace.json. The steps of all plots created together are collected in one file. [Default: %(default)s, harry_profile.json if specified without argument]")
 		
 		self.module_options = self.add_argument_group('Modules')
 		self.module_options.add_argument("--modules-search-paths", default=[], nargs="+",
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+Long-running plot server keeping a pool of warm HarryCore workers
+
+The server listens on a Unix socket and accepts the argument strings of plots (the same strings
+that HarryPlotter.multi_plots builds). Every worker process has imported ROOT, the default
+processors and the styles once and keeps its caches across plots. The output filenames, the
+failures and the log of each plot are sent back to the client.
+
+Messages are JSON dicts, one per line. Requests contain the "command" ("plot", "ping" or
+"shutdown"). Plot requests additionally contain the list of "harry_args", the working directory
+("cwd"), the environment ("environ"), the settings (see settings) and the timeout per plot of the client.
+Settings captured when the modules are imported cannot be changed per plot. Plot requests from clients
+with different settings (e.g. another checkout of clipl) are therefore refused and created locally.
+
+The plots run in a utility.executor.ProcessExecutor, which terminates the workers of plots exceeding
+the timeout. Plot requests are processed one after the other. Since the clients can run arbitrary plot
+configurations as the owner of the server, the socket is only accessible for its owner and requests
+from other users are refused.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import json
+import multiprocessing
+import os
+import pipes
+import shlex
+import socket
+import SocketServer
+import StringIO
+import struct
+import sys
+import threading
+import traceback
+
+import clipl.utility.executor as executor
+
+
+# increase in case the messages change
+PROTOCOL_VERSION = 2
+
+# arguments that need to be handled locally (interactive output)
+LOCAL_ARGUMENTS = ["-h", "--help", "--list-available-modules", "--no-daemon"]
+
+# maximum time in seconds per forwarded plot
+PLOT_TIMEOUT = 3600.0
+
+# socket option for the credentials of the peer (Linux), not defined by the socket module of Python 2
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+
+def default_socket_file():
+	socket_dir = os.path.expandvars("$HP_WORK_BASE")
+	if "$" in socket_dir:
+		socket_dir = os.path.join(os.path.expanduser("~"), ".cache", "clipl")
+	return os.path.join(socket_dir, "harry_server.sock")
+
+
+def settings():
+	"""
+	Return the settings of this process, which need to be identical for client and server
+
+	clipl_dir: directory of the imported clipl package
+	cache_dir: directory of the tree draw cache (see RootTools.tree_draw_cache), determined when importing the module
+	"""
+	return {
+		"clipl_dir" : os.path.dirname(os.path.realpath(os.path.abspath(__file__))),
+		"cache_dir" : os.path.realpath(os.path.expandvars(os.path.join("$HP_WORK_BASE_COMMON", "caches"))),
+	}
+
+
+def _send(connection_file, message):
+	connection_file.write(json.dumps(message) + "\n")
+	connection_file.flush()
+
+
+def _receive(connection_file):
+	line = connection_file.readline()
+	return json.loads(line) if line else None
+
+
+def _initialise_worker():
+	"""
+	Import ROOT, the default processors and the styles once per worker process
+	"""
+	import clipl.harry as harry
+	import clipl.core as harrycore
+
+	harry.prepare_root()
+	harry_core = harrycore.HarryCore(args_from_script="--no-logo")
+	harry_core._detect_available_processors()
+	for processor_name in [harry_core.parser.get_default("input_modules"), harry_core.parser.get_default("plot_modules")]:
+		harry_core.available_processors.get(processor_name, None)
+
+
+def _peer_uid(connection):
+	"""
+	Return the user ID of the peer of a Unix socket or None in case it cannot be determined
+	"""
+	try:
+		pid, uid, gid = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i")))
+	except (socket.error, struct.error):
+		return None
+	return uid
+
+
+def _plot_task(arguments):
+	return _plot_in_worker(*arguments)
+
+
+def _plot_in_worker(harry_args, cwd, environ):
+	"""
+	Create a single plot and return a dict with the output filenames, the failure status and the log
+	"""
+	import clipl.core as harrycore
+	import clipl.utility.memorytracker as memorytracker
+	import clipl.utility.profiling as profiling
+
+	os.chdir(cwd)
+	os.environ.clear()
+	os.environ.update(environ)
+
+	# the log of this plot is collected and sent to the client
+	log_stream = StringIO.StringIO()
+	logging_args, unknown_args = logger.loggingParser.parse_known_args(shlex.split(harry_args))
+	logger.initLogger(logging_args)
+	log_handler = logging.StreamHandler(log_stream)
+	log_handler.setFormatter(logger.LevelDependentFormatter(logger.initLogger.LDFormatDefault))
+	root_logger = logging.getLogger()
+	root_logger.handlers = [handler for handler in root_logger.handlers if isinstance(handler, logging.FileHandler)] + [log_handler]
+
+	result = {"output_filenames" : None, "failed" : False, "traceback" : None}
+	memory_tracker = memorytracker.RootObjectTracker()
+	harry_core = None
+	try:
+		harry_core = harrycore.HarryCore(args_from_script=harry_args)
+		result["output_filenames"] = harry_core.run()
+	except SystemExit:
+		result["failed"] = True
+	except Exception:
+		result["failed"] = True
+		result["traceback"] = traceback.format_exc()
+	result["profile"] = profiling.pop_profile()
+
+	# release the ROOT objects of this plot, since the worker creates further plots
+	sys.exc_clear()
+	n_released = memory_tracker.cleanup(None if harry_core is None else harry_core.plot_data)
+	log.debug("After releasing {n:d} ROOT objects: {statistics}".format(n=n_released, statistics=memory_tracker.get_statistics_string()))
+
+	log_handler.flush()
+	result["log"] = log_stream.getvalue()
+	return result
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		peer_uid = _peer_uid(self.connection)
+		if (not peer_uid is None) and (peer_uid != os.getuid()):
+			log.warning("Refused request of user {uid:d}.".format(uid=peer_uid))
+			_send(self.wfile, {"version" : PROTOCOL_VERSION, "error" : "The harry server only accepts requests of its owner."})
+			return
+
+		try:
+			request = _receive(self.rfile)
+		except ValueError:
+			request = None
+		if (request is None) or (request.get("version", None) != PROTOCOL_VERSION):
+			_send(self.wfile, {"version" : PROTOCOL_VERSION, "error" : "Invalid request or protocol version."})
+			return
+
+		command = request.get("command", None)
+		if command == "ping":
+			_send(self.wfile, {"version" : PROTOCOL_VERSION, "pid" : os.getpid(), "n_workers" : self.server.n_workers})
+		elif command == "shutdown":
+			_send(self.wfile, {"version" : PROTOCOL_VERSION})
+			self.server.shutdown_requested = True
+		elif command == "plot":
+			mismatched_settings = sorted([key for key, value in self.server.settings.iteritems() if request.get("settings", {}).get(key, None) != value])
+			if len(mismatched_settings) > 0:
+				_send(self.wfile, {"version" : PROTOCOL_VERSION, "error" : "The settings {settings} of the server differ from the ones of the client. Create the plots locally.".format(
+						settings=", ".join(["{key}=\"{value}\"".format(key=key, value=self.server.settings[key]) for key in mismatched_settings])
+				)})
+				return
+			log.info("Creating {n_plots} plot(s) for {cwd}.".format(n_plots=len(request["harry_args"]), cwd=request["cwd"]))
+			with self.server.executor_lock:
+				self.server.executor.timeout = request.get("timeout", None)
+				task_results = self.server.executor.map(_plot_task, [(harry_args, request["cwd"], request["environ"]) for harry_args in request["harry_args"]])
+			results = []
+			for task_result in task_results:
+				if task_result.error is None:
+					results.append(task_result.result)
+				else:
+					results.append({"output_filenames" : None, "failed" : True, "traceback" : task_result.error, "log" : ""})
+			_send(self.wfile, {"version" : PROTOCOL_VERSION, "results" : results})
+		else:
+			_send(self.wfile, {"version" : PROTOCOL_VERSION, "error" : "Unknown command \"{command}\".".format(command=command)})
+
+
+class HarryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+	# handle_request returns regularly to check for shutdown requests
+	timeout = 1.0
+
+	def __init__(self, socket_file=None, n_workers=None, max_plots_per_worker=None):
+		self.socket_file = socket_file or default_socket_file()
+		self.n_workers = n_workers or multiprocessing.cpu_count()
+		self.settings = settings()
+		self.shutdown_requested = False
+
+		if not ping(self.socket_file) is None:
+			log.critical("A harry server is already listening on \"{socket_file}\"!".format(socket_file=self.socket_file))
+			sys.exit(1)
+		socket_dir = os.path.dirname(self.socket_file)
+		if not os.path.exists(socket_dir):
+			os.makedirs(socket_dir, 0700)
+		if os.path.exists(self.socket_file):
+			# left over from a server that has not been shut down properly
+			os.remove(self.socket_file)
+
+		# the workers are forked before anything heavy is imported in this process and before threads are started
+		self.executor = executor.ProcessExecutor(self.n_workers, max_tasks_per_worker=max_plots_per_worker, initializer=_initialise_worker)
+		self.executor.start_workers()
+		self.executor_lock = threading.Lock()
+
+		# the socket is created with permissions for the owner only
+		umask = os.umask(0177)
+		try:
+			SocketServer.UnixStreamServer.__init__(self, self.socket_file, _RequestHandler)
+		finally:
+			os.umask(umask)
+
+	def serve(self):
+		log.info("Listening on \"{socket_file}\" with {n_workers} workers.".format(socket_file=self.socket_file, n_workers=self.n_workers))
+		try:
+			while not self.shutdown_requested:
+				self.handle_request()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.server_close()
+			if os.path.exists(self.socket_file):
+				os.remove(self.socket_file)
+			self.executor.shutdown()
+		log.info("Server stopped.")
+
+
+def _request(socket_file, request, timeout=None):
+	"""
+	Send a request to the server and return its response or None in case no server is running
+	"""
+	socket_file = socket_file or default_socket_file()
+	if not os.path.exists(socket_file):
+		return None
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(timeout)
+	try:
+		client.connect(socket_file)
+		connection_file = client.makefile("rw")
+		request["version"] = PROTOCOL_VERSION
+		_send(connection_file, request)
+		response = _receive(connection_file)
+	except socket.timeout:
+		log.warning("Harry server: no response within {timeout:.0f} s.".format(timeout=timeout))
+		return None
+	except (socket.error, ValueError):
+		return None
+	finally:
+		client.close()
+	if (response is None) or ("error" in response):
+		if not response is None:
+			log.warning("Harry server: " + response["error"])
+		return None
+	return response
+
+def ping(socket_file=None):
+	return _request(socket_file, {"command" : "ping"}, timeout=5.0)
+
+def shutdown(socket_file=None):
+	return _request(socket_file, {"command" : "shutdown"}, timeout=5.0)
+
+def forward(harry_args, socket_file=None, timeout=PLOT_TIMEOUT):
+	"""
+	Create plots with a running server
+
+	harry_args: list of argument strings (None refers to the command line arguments of this process)
+	timeout: maximum time in seconds per plot (None: unlimited)
+
+	Returns a list of result dicts (output_filenames, failed, traceback, log) or None in case the plots
+	need to be created locally, since no server is running or arguments need to be handled locally.
+	"""
+	command_line_args = " ".join([pipes.quote(arg) for arg in sys.argv[1:]])
+	harry_args = [command_line_args if args is None else args for args in harry_args]
+	if any([arg in LOCAL_ARGUMENTS for args in harry_args for arg in shlex.split(args)]):
+		return None
+
+	response = _request(socket_file, {
+			"command" : "plot",
+			"harry_args" : harry_args,
+			"cwd" : os.getcwd(),
+			"environ" : dict(os.environ),
+			"settings" : settings(),
+			"timeout" : timeout,
+	}, timeout=(None if timeout is None else timeout * len(harry_args)))
+	if response is None:
+		return None
+
+	# the logger of this process has not been initialised in case no plot has been created here
+	if not logging.getLogger().handlers:
+		logger.initLogger(logger.loggingParser.parse_known_args(shlex.split(harry_args[0]))[0])
+	return response["results"]
@@ -12,6 +12,7 @@ import os
 import sys
 
 import clipl.inputbase as inputbase
+import clipl.utility.staging as staging
 
 
 class InputFile(inputbase.InputBase):
@@ -25,6 +26,15 @@ class InputFile(inputbase.InputBase):
 		                                help="Input (root) file(s).")
 		self.input_options.add_argument("-d", "--directories", type=str, nargs="+", default=[None],
 		                                help="Input directories, that are put before the values of the -i/--files option.")
+		
+		self.input_options.add_argument("--stage-remote-files", nargs="?", type="bool", default=False, const=True,
+		                                help="Download remote (dcap://, root://, srm://) input files to a local cache before reading them. Downloads run in the background while already staged inputs are read. [Default: %(default)s]")
+		self.input_options.add_argument("--staging-dir", default="$HP_WORK_BASE_COMMON/staging",
+		                                help="Cache directory for staged remote files. Copies are identified by the remote path and can be shared. Remote files are assumed not to change, delete their copies otherwise. [Default: %(default)s]")
+		self.input_options.add_argument("--n-staging-threads", type=int, default=4,
+		                                help="Number of concurrent downloads for staging. [Default: %(default)s]")
+		self.input_options.add_argument("--staging-retries", type=int, default=3,
+		                                help="Number of attempts for downloading a remote file. [Default: %(default)s]")
 
 	def prepare_args(self, parser, plotData):
 		super(InputFile, self).prepare_args(parser, plotData)
@@ -55,5 +65,15 @@ class InputFile(inputbase.InputBase):
 					sys.exit(1)
 			plotData.plotdict["files"][index] = files
 
+		# start staging of all remote inputs, the individual inputs wait for their files when they are read
+		self.staging_pool = None
+		if plotData.plotdict["stage_remote_files"]:
+			self.staging_pool = staging.get_staging_pool(
+					os.path.expandvars(plotData.plotdict["staging_dir"]),
+					n_threads=plotData.plotdict["n_staging_threads"],
+					n_retries=plotData.plotdict["staging_retries"]
+			)
+			self.staging_pool.stage_json(plotData.plotdict["files"])
+
 	def run(self, plotData):
 		super(InputFile, self).run(plotData)
@@ -15,11 +15,14 @@ import ROOT
 
 import clipl.inputbase as inputbase
 import clipl.input_modules.inputfile as inputfile
+import clipl.utility.cacheindex as cacheindex
 import clipl.utility.roottools as roottools
+import clipl.utility.rootfileindex as rootfileindex
+import clipl.utility.profiling as profiling
 import clipl.utility.progressiterator as pi
 import clipl.utility.tools as tools
 import clipl.utility.jsonTools as jsonTools
-from clipl.utility.tfilecontextmanager import TFileContextManager
+import clipl.utility.tfilecontextmanager as tfilecontextmanager
 
 
 class InputRoot(inputfile.InputFile):
@@ -73,8 +76,42 @@ class InputRoot(inputfile.InputFile):
 		                                help="Read in the config stored in Artus ROOT outputs. [Default: %(default)s]")
 		self.input_options.add_argument("--hide-progressbar", nargs ="?", type="bool", default=False, const=True,
 		                                help="Show progress of the individual plot. [Default: %(default)s]")
-		self.input_options.add_argument("--redo-cache", nargs ="?", type="bool", default=None, const=True,
-		                                help="Do not use inputs from cached trees, but overwrite them. [Default: False for absolute paths, True for relative paths]")
+		self.input_options.add_argument("--redo-cache", nargs ="?", type="bool", default=False, const=True,
+		                                help="Do not use inputs from cached trees, but overwrite them. Caches are invalidated automatically if input files change, since they are identified by size, modification time and ROOT file UUID. [Default: %(default)s]")
+		self.input_options.add_argument("--cache-fingerprints", nargs ="?", type="bool", default=False, const=True,
+		                                help="Additionally identify (local) input files for the caches by the MD5 sum of the first and last 64 kB of their content. [Default: %(default)s]")
+		self.input_options.add_argument("--cache-max-size", default=os.environ.get("HP_CACHE_MAX_SIZE", None),
+		                                help="Maximum total size of the caches in $HP_WORK_BASE_COMMON/caches (e.g. \"500G\"). Entries are evicted when new caches are created. [Default: $HP_CACHE_MAX_SIZE or unlimited]")
+		self.input_options.add_argument("--cache-eviction-policy", default="lru", choices=cacheindex.EVICTION_POLICIES,
+		                                help="Policy for evicting caches, least recently (lru) or least frequently (lfu) used entries are deleted first. [Default: %(default)s]")
+		self.input_options.add_argument("--cache-memory-size", default="256M",
+		                                help="Maximum size of cached objects kept in memory for following plots created in the same process. Use 0 to disable. [Default: %(default)s]")
+		self.input_options.add_argument("--cache-locking", nargs="?", type="bool", default=False, const=True,
+		                                help="Lock caches while computing them, such that other processes (e.g. batch jobs sharing the cache directory) wait for and reuse the result instead of computing it again. [Default: %(default)s]")
+		self.input_options.add_argument("--fill-engine", default="draw", choices=["draw", "numpy"],
+		                                help="Engine for filling histograms from trees. \"numpy\" reads the referenced branches into NumPy arrays and fills the histograms vectorised. This is possible for histograms (no profiles or graphs) with binnings known before reading, whose expressions consist of arithmetics, comparisons, logical operators and common mathematical functions of flat branches. All other inputs are read using ROOT.TTree.Draw. [Default: %(default)s]")
+		self.input_options.add_argument("--prune-branches", nargs="?", type="bool", default=True, const=True,
+		                                help="Read only the branches used in the expressions and weights when reading from trees and set up a TTreeCache for them. All branches are read in case the used branches cannot be determined. [Default: %(default)s]")
+		self.input_options.add_argument("--tree-cache-size", default=None,
+		                                help="Size of the TTreeCache used for reading from trees (e.g. \"100M\"). [Default: estimated from the used branches in case of --prune-branches, otherwise the ROOT default]")
+		self.input_options.add_argument("--tree-cache-learn-entries", type=int, default=None,
+		                                help="Number of entries for the learning phase of the TTreeCache in case the used branches are not known. [Default: ROOT default]")
+		self.input_options.add_argument("--prefetching", nargs="?", type="bool", default=True, const=True,
+		                                help="Enable the asynchronous prefetching of baskets. [Default: %(default)s]")
+		self.input_options.add_argument("--print-read-statistics", nargs="?", type="bool", default=False, const=True,
+		                                help="Print the number of bytes read, the number of read calls and the time needed after reading each input. [Default: %(default)s]")
+		self.input_options.add_argument("--proxy-cache-dir", default="$HP_WORK_BASE_COMMON/proxies",
+		                                help="Directory for caching compiled proxies (see --tree-draw-options proxy). Use an empty string to compile proxies in the current directory for every run. [Default: %(default)s]")
+		self.input_options.add_argument("--metadata-index-dir", default=rootfileindex.DEFAULT_INDEX_DIR,
+		                                help="Directory of the persistent index of the metadata (keys, trees and binnings) of the input files. Use an empty string to index the files only within the current run. [Default: %(default)s]")
+		self.input_options.add_argument("--n-merge-processes", type=int, default=1,
+		                                help="Number of parallel processes for reading and summing up histograms from many files per input. The result does not depend on the number of processes. [Default: %(default)s]")
+		self.input_options.add_argument("--max-open-files", type=int, default=64,
+		                                help="Maximum number of input files kept open for reading further objects from them. [Default: %(default)s]")
+		self.input_options.add_argument("--batched-fill", nargs="?", type="bool", default=False, const=True,
+		                                help="Fill all histograms reading from the same trees (files, folders and friends) in one loop over the events. This applies to inputs with binnings known before reading and without special tree draw options. [Default: %(default)s]")
+		self.input_options.add_argument("--n-input-processes", type=int, default=1,
+		                                help="Number of parallel processes for reading the inputs. Inputs from trees are only read in parallel if their binnings are known before reading. [Default: %(default)s]")
 
 	def prepare_args(self, parser, plotData):
 		super(InputRoot, self).prepare_args(parser, plotData)
@@ -86,9 +123,32 @@ class InputRoot(inputfile.InputFile):
 			plotData.plotdict[key] = [element.split() if element else [""] for element in plotData.plotdict[key]]
 		for key in ["friend_files", "friend_folders"]:
 			plotData.plotdict[key] = [element.split() if element else element for element in plotData.plotdict[key]]
+		if not self.staging_pool is None:
+			self.staging_pool.stage_json(plotData.plotdict["friend_files"])
 
-		if plotData.plotdict["redo_cache"] is None:
-			plotData.plotdict["redo_cache"] = not any(tools.flattenList([[input_file.startswith("/") or ("://" in input_file) for input_file in files] for files in plotData.plotdict["files"]]))
+		try:
+			plotData.plotdict["cache_max_size"] = cacheindex.parse_size(plotData.plotdict["cache_max_size"])
+			plotData.plotdict["cache_memory_size"] = cacheindex.parse_size(plotData.plotdict["cache_memory_size"])
+			plotData.plotdict["tree_cache_size"] = cacheindex.parse_size(plotData.plotdict["tree_cache_size"])
+		except ValueError, e:
+			log.critical(str(e))
+			sys.exit(1)
+
+		if plotData.plotdict["proxy_cache_dir"]:
+			plotData.plotdict["proxy_cache_dir"] = os.path.expandvars(plotData.plotdict["proxy_cache_dir"])
+			if "$" in plotData.plotdict["proxy_cache_dir"]:
+				log.debug("Proxy cache directory \"%s\" contains undefined environment variables. Compile proxies for every run." % plotData.plotdict["proxy_cache_dir"])
+				plotData.plotdict["proxy_cache_dir"] = None
+			else:
+				plotData.plotdict["proxy_cache_dir"] = os.path.abspath(plotData.plotdict["proxy_cache_dir"])
+
+		if plotData.plotdict["metadata_index_dir"]:
+			plotData.plotdict["metadata_index_dir"] = os.path.expandvars(plotData.plotdict["metadata_index_dir"])
+			if "$" in plotData.plotdict["metadata_index_dir"]:
+				log.debug("Metadata index directory \"%s\" contains undefined environment variables. Index the input files only within this run." % plotData.plotdict["metadata_index_dir"])
+				plotData.plotdict["metadata_index_dir"] = None
+			else:
+				plotData.plotdict["metadata_index_dir"] = os.path.abspath(plotData.plotdict["metadata_index_dir"])
 
 		if plotData.plotdict["read_config"]:
 			self.read_input_json_dicts(plotData)
@@ -99,7 +159,92 @@ class InputRoot(inputfile.InputFile):
 		self.hide_progressbar = plotData.plotdict["hide_progressbar"]
 		del(plotData.plotdict["hide_progressbar"])
 		files_to_remove = []
+		self._configure_caches(plotData)
+		
+		batched_fill = plotData.plotdict["batched_fill"]
+		n_input_processes = plotData.plotdict["n_input_processes"]
+		if (batched_fill or (n_input_processes > 1)) and plotData.plotdict["keep_trees"]:
+			log.warning("Batched or parallel reading of inputs is not possible in case trees need to be kept. Read inputs one by one.")
+			batched_fill = False
+			n_input_processes = 1
 		
+		# (root_tree_chain, root_histogram, tmp_files) for every input
+		results = [None] * len(plotData.plotdict["nicks"])
+		collected_tree_inputs = []
+		collected_directory_inputs = []
+		
+		for index, root_folder_type, kwargs in self._inputs(plotData, visible=not self.hide_progressbar):
+			if root_folder_type == "TTree":
+				if batched_fill or (n_input_processes > 1):
+					collected_tree_inputs.append((index, kwargs))
+				else:
+					with profiling.profile("input", "InputRoot", index=index, nick=plotData.plotdict["nicks"][index]):
+						results[index] = root_tools.histogram_from_tree(**kwargs)
+			else:
+				if n_input_processes > 1:
+					collected_directory_inputs.append((index, kwargs))
+				else:
+					with profiling.profile("input", "InputRoot", index=index, nick=plotData.plotdict["nicks"][index]):
+						root_histogram = roottools.RootTools.histogram_from_file(**kwargs)
+					if hasattr(root_histogram, "Sumw2"):
+						root_histogram.Sumw2()
+					results[index] = (None, root_histogram, [])
+		
+		if len(collected_tree_inputs) > 0:
+			indices, list_of_kwargs = zip(*collected_tree_inputs)
+			with profiling.profile("inputs from trees", "InputRoot", n_inputs=len(indices), batched=batched_fill, n_processes=n_input_processes):
+				tree_results = root_tools.histograms_from_trees(list_of_kwargs, batched=batched_fill, n_processes=n_input_processes)
+			for index, result in zip(indices, tree_results):
+				results[index] = result
+		
+		if len(collected_directory_inputs) > 0:
+			indices, list_of_kwargs = zip(*collected_directory_inputs)
+			with profiling.profile("inputs from directories", "InputRoot", n_inputs=len(indices), n_processes=n_input_processes):
+				directory_results = roottools.RootTools.histograms_from_files(list_of_kwargs, n_processes=n_input_processes)
+			for index, root_histogram in zip(indices, directory_results):
+				if hasattr(root_histogram, "Sumw2"):
+					root_histogram.Sumw2()
+				results[index] = (None, root_histogram, [])
+		
+		for index, (nick, (root_tree_chain, root_histogram, tmp_files)) in enumerate(zip(plotData.plotdict["nicks"], results)):
+			plotData.plotdict.setdefault("tmp_files", []).extend(tmp_files)
+			
+			log.debug("Input object %d (nick %s):" % (index, nick))
+			if log.isEnabledFor(logging.DEBUG):
+				root_histogram.Print()
+			
+			# save tree (chain) in plotData merging chains with same nick names
+			if (not root_tree_chain is None) and plotData.plotdict["keep_trees"]:
+				if nick in plotData.plotdict.setdefault("root_trees", {}):
+					plotData.plotdict["root_trees"][nick].Add(root_tree_chain)
+				else:
+					plotData.plotdict["root_trees"][nick] = root_tree_chain
+			
+			# save histogram in plotData
+			# merging histograms with same nick names is done in upper class
+			plotData.plotdict.setdefault("root_objects", {}).setdefault(nick, []).append(root_histogram)
+			
+		for tmp_file in files_to_remove:
+			log.debug("rm "+tmp_file)
+			#os.remove(tmp_file) # has to be deleted even later (after all multiplots finished)
+
+		# run upper class function at last
+		super(InputRoot, self).run(plotData)
+
+
+	@staticmethod
+	def _configure_caches(plotData):
+		roottools.RootTools.tree_draw_cache.fingerprint = plotData.plotdict["cache_fingerprints"]
+		roottools.RootTools.tree_draw_cache.max_size = plotData.plotdict["cache_max_size"]
+		roottools.RootTools.tree_draw_cache.eviction_policy = plotData.plotdict["cache_eviction_policy"]
+		roottools.RootTools.tree_draw_cache.memory_max_size = plotData.plotdict["cache_memory_size"]
+		roottools.RootTools.tree_draw_cache.locking = plotData.plotdict["cache_locking"]
+		tfilecontextmanager.set_max_open_files(plotData.plotdict["max_open_files"])
+
+	def _inputs(self, plotData, visible=True):
+		"""
+		Yield (index, root folder type, kwargs of RootTools.histogram_from_tree or RootTools.histogram_from_file) for all inputs
+		"""
 		for index, (
 				root_files,
 				folders,
@@ -132,32 +277,48 @@ class InputRoot(inputfile.InputFile):
 				plotData.plotdict["friend_aliases"],
 				plotData.plotdict["tree_draw_options"],
 				plotData.plotdict["proxy_prefixes"]
-		), description="Reading ROOT inputs", visible=not self.hide_progressbar )):
+		), description="Reading ROOT inputs", visible=visible)):
+			if not self.staging_pool is None:
+				root_files = self.staging_pool.local_paths(root_files)
+				if friend_files:
+					friend_files = self.staging_pool.local_paths(friend_files)
+			
 			# check whether to read from TTree or from TDirectory
 			root_folder_type = roottools.RootTools.check_type(root_files, folders,
-			                                                  print_quantities=plotData.plotdict["quantities"])
-			root_tree_chain = None
-			root_histogram = None
+			                                                  print_quantities=plotData.plotdict["quantities"],
+			                                                  index_dir=plotData.plotdict["metadata_index_dir"])
 			
 			if root_folder_type == "TTree":
-				variable_expression = "%s%s%s" % (z_expression + ":" if z_expression else "",
-				                                  y_expression + ":" if y_expression else "",
-				                                  x_expression)
-				root_tree_chain, root_histogram, tmp_files = root_tools.histogram_from_tree(
-						root_files, folders,
-						x_expression, y_expression, z_expression,
-						x_bins=["25"] if x_bins is None else x_bins,
-						y_bins=["25"] if y_bins is None else y_bins,
-						z_bins=["25"] if z_bins is None else z_bins,
-						weight_selection=weight, option=option, name=None,
-						friend_files=friend_files,
-						friend_folders=friend_folders,
-						friend_aliases=friend_aliases,
-						proxy_prefix=proxy_prefix,
-						scan=plotData.plotdict["scan"],
-						redo_cache=(plotData.plotdict["redo_cache"])
-				)
-				plotData.plotdict.setdefault("tmp_files", []).extend(tmp_files)
+				histogram_from_tree_kwargs = {
+					"root_file_names" : root_files,
+					"path_to_trees" : folders,
+					"x_expression" : x_expression,
+					"y_expression" : y_expression,
+					"z_expression" : z_expression,
+					"x_bins" : ["25"] if x_bins is None else x_bins,
+					"y_bins" : ["25"] if y_bins is None else y_bins,
+					"z_bins" : ["25"] if z_bins is None else z_bins,
+					"weight_selection" : weight,
+					"option" : option,
+					"name" : None,
+					"friend_files" : friend_files,
+					"friend_folders" : friend_folders,
+					"friend_aliases" : friend_aliases,
+					"proxy_prefix" : proxy_prefix,
+					"scan" : plotData.plotdict["scan"],
+					"redo_cache" : plotData.plotdict["redo_cache"],
+					"fill_engine" : plotData.plotdict["fill_engine"],
+					"read_options" : {
+						"prune_branches" : plotData.plotdict["prune_branches"],
+						"cache_size" : plotData.plotdict["tree_cache_size"],
+						"cache_learn_entries" : plotData.plotdict["tree_cache_learn_entries"],
+						"prefetching" : plotData.plotdict["prefetching"],
+						"print_statistics" : plotData.plotdict["print_read_statistics"],
+						"proxy_cache_dir" : plotData.plotdict["proxy_cache_dir"],
+						"metadata_index_dir" : plotData.plotdict["metadata_index_dir"],
+					},
+				}
+				yield index, root_folder_type, histogram_from_tree_kwargs
 				
 			elif root_folder_type == "TDirectory":
 				if x_expression is None:
@@ -165,49 +326,33 @@ class InputRoot(inputfile.InputFile):
 					sys.exit(1)
 				root_objects = [os.path.join(folder, x_expression) for folder in folders]
 				
-				root_histogram = roottools.RootTools.histogram_from_file(
-						root_files,
-						root_objects,
-						x_bins=x_bins,
-						y_bins=y_bins,
-						z_bins=z_bins,
-						name=None)
-				if hasattr(root_histogram, "Sumw2"):
-					root_histogram.Sumw2()
+				histogram_from_file_kwargs = {
+					"root_file_names" : root_files,
+					"path_to_histograms" : root_objects,
+					"x_bins" : x_bins,
+					"y_bins" : y_bins,
+					"z_bins" : z_bins,
+					"name" : None,
+					"n_processes" : plotData.plotdict["n_merge_processes"],
+				}
+				yield index, root_folder_type, histogram_from_file_kwargs
 			else:
 				log.critical("Error getting ROOT object from file. Exiting.")
 				sys.exit(1)
-			
-			log.debug("Input object %d (nick %s):" % (index, nick))
-			if log.isEnabledFor(logging.DEBUG):
-				root_histogram.Print()
-			
-			# save tree (chain) in plotData merging chains with same nick names
-			if (not root_tree_chain is None) and plotData.plotdict["keep_trees"]:
-				if nick in plotData.plotdict.setdefault("root_trees", {}):
-					plotData.plotdict["root_trees"][nick].Add(root_tree_chain)
-				else:
-					plotData.plotdict["root_trees"][nick] = root_tree_chain
-			
-			# save histogram in plotData
-			# merging histograms with same nick names is done in upper class
-			plotData.plotdict.setdefault("root_objects", {}).setdefault(nick, []).append(root_histogram)
-			
-		for tmp_file in files_to_remove:
-			log.debug("rm "+tmp_file)
-			#os.remove(tmp_file) # has to be deleted even later (after all multiplots finished)
-
-		# run upper class function at last
-		super(InputRoot, self).run(plotData)
 
+	def plan_fills(self, plotData):
+		"""
+		Return the kwargs of RootTools.histogram_from_tree for all inputs read from trees
+		"""
+		self._configure_caches(plotData)
+		return [kwargs for index, root_folder_type, kwargs in self._inputs(plotData, visible=False) if root_folder_type == "TTree"]
 
 	def read_input_json_dicts(self, plotData):
 		"""If Artus config dict is present in root file -> append to plotdict"""
 		for root_files in plotData.plotdict["files"]:
 			# TODO: make TChain instead of using only first file?
-			with TFileContextManager(root_files[0], "READ") as tfile:
-				keys, names = zip(*roottools.RootTools.walk_root_directory(tfile))
-			if jsonTools.JsonDict.PATH_TO_ROOT_CONFIG in names:
+			metadata = rootfileindex.get_metadata(root_files[0], index_dir=plotData.plotdict["metadata_index_dir"])
+			if (not metadata is None) and (not metadata.class_name(jsonTools.JsonDict.PATH_TO_ROOT_CONFIG) is None):
 				input_json_dict = jsonTools.JsonDict(root_files)
 			else:
 				input_json_dict = {}
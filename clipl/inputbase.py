@@ -8,7 +8,6 @@ import clipl.utility.logger as logger
 log = logging.getLogger(__name__)
 
 import collections
-import ROOT
 
 import clipl.processor as processor
 from clipl.utility.binnings import BinningsDict
@@ -55,6 +54,7 @@ class InputBase(processor.Processor):
 		plotData.plotdict["scale_factors"] = [float(scale) if scale != None else 1.0 for scale in plotData.plotdict["scale_factors"]]
 	
 	def run(self, plotData):
+		import ROOT
 		super(InputBase, self).run(plotData)
 
 		self.scale_histograms(plotData)
@@ -88,7 +88,14 @@ class InputBase(processor.Processor):
 				tmp_nicks.append(nick)
 		plotData.plotdict["nicks"] = tmp_nicks
 
+	def plan_fills(self, plotData):
+		"""
+		Return the fill tasks of the inputs, which can be run before creating the plots (see clipl.utility.fillplanner)
+		"""
+		return []
+
 	def scale_histograms(self, plotData):
+		import ROOT
 		nick_occurences = {}
 		for index, (nick, scale_factor) in enumerate(zip(*[plotData.plotdict[key] for key in ["nicks", "scale_factors"]])):
 			root_object = plotData.plotdict["root_objects"][nick]
@@ -16,11 +16,8 @@ import pprint
 import re
 import sys
 
-import ROOT
-
 import clipl.processor as processor
 import clipl.utility.tools as tools
-import clipl.utility.roottools as roottools
 import clipl.utility.colors as colors
 
 class PlotBase(processor.Processor):
@@ -355,6 +352,7 @@ class PlotBase(processor.Processor):
 		pass
 
 	def prepare_histograms(self, plotData):
+		import ROOT
 		# handle stacks
 		# TODO: define how functions should act when stacked
 		for index, (nick1, stack1) in enumerate(zip(plotData.plotdict["nicks"], plotData.plotdict["stacks"])):
@@ -458,6 +456,7 @@ class PlotBase(processor.Processor):
 
 	@staticmethod
 	def get_plot_lims(root_object, x_log=False, y_log=False, z_log=False):
+		import clipl.utility.roottools as roottools
 		max_dim = roottools.RootTools.get_dimension(root_object)
 
 		x_min, x_max = roottools.RootTools.get_min_max(root_object, 0)
@@ -14,6 +14,7 @@ import os
 import string
 import subprocess
 
+import clipl.utility.profiling as profiling
 import clipl.utility.tools as tools
 
 
@@ -158,10 +159,12 @@ class PlotData(object):
 
 
 	def save(self):
-		self.plot.finish()
+		with profiling.profile("finish", "save"):
+			self.plot.finish()
 		if not self.plot is None:
 			for filename in self.plotdict["output_filenames"]:
-				self.plot.save(filename)
+				with profiling.profile("save " + os.path.splitext(filename)[1].lstrip("."), "save", filename=filename):
+					self.plot.save(filename)
 				log.info("Created plot \"%s\"." % filename)
 
 			if not (self.plotdict["live"]==None):
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of the processors (input, analysis and plot modules) available in the module directories
+
+The names, types and docstrings of the processors defined in every module file are recorded
+in a manifest (JSON file), which is updated for files that are new or have been modified since
+they were scanned. Only the modules of processors that are actually used are imported.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import collections
+import fnmatch
+import imp
+import inspect
+import json
+import os
+import tempfile
+
+
+# increase in case the content of the manifest changes
+MANIFEST_VERSION = 1
+
+PROCESSOR_TYPES = ["input", "analysis", "plot"]
+
+# imported modules for every module file
+_modules = {}
+
+# registries for every set of module directories
+_processor_registries = {}
+
+
+def default_manifest_file():
+	manifest_dir = os.path.expandvars("$HP_WORK_BASE")
+	if "$" in manifest_dir:
+		manifest_dir = os.path.join(os.path.expanduser("~"), ".cache", "clipl")
+	return os.path.join(manifest_dir, "processor_manifest.json")
+
+
+def _file_state(filename):
+	stat = os.stat(filename)
+	return [stat.st_mtime, stat.st_size]
+
+
+def _load_module(filename):
+	"""
+	Import a module file (only once per process and modification time)
+	"""
+	file_state = _file_state(filename)
+	if (not filename in _modules) or (_modules[filename][0] != file_state):
+		log.debug("Importing modules from path {0}.".format(filename))
+		module_name = os.path.splitext(os.path.basename(filename))[0]
+		_modules[filename] = (file_state, imp.load_source(module_name, filename))
+	return _modules[filename][1]
+
+
+def _processor_type(obj):
+	# the base classes are imported only here, since they depend on ROOT
+	from clipl.analysisbase import AnalysisBase
+	from clipl.inputbase import InputBase
+	from clipl.plotbase import PlotBase
+
+	if not inspect.isclass(obj):
+		return None
+	for processor_type, base_class in zip(PROCESSOR_TYPES, [InputBase, AnalysisBase, PlotBase]):
+		if issubclass(obj, base_class):
+			return processor_type
+	return None
+
+
+class ProcessorRegistry(collections.MutableMapping):
+	"""
+	Dict-like mapping of processor names to processor classes, which are imported on first access
+	"""
+	def __init__(self, modules_dirs, manifest_file=None):
+		self.modules_dirs = modules_dirs
+		self.manifest_file = manifest_file or default_manifest_file()
+
+		# name -> (module file, attribute name, processor type, docstring)
+		self._entries = collections.OrderedDict()
+		# name -> class (imported or registered)
+		self._processors = {}
+
+		self.update()
+
+	def update(self):
+		"""
+		Update the manifest for all module files in the module directories and register their processors
+		"""
+		manifest = self._read_manifest()
+		manifest_changed = False
+
+		filenames = []
+		for module_dir in self.modules_dirs:
+			for root, dirnames, files in os.walk(module_dir):
+				for filename in fnmatch.filter(files, '*.py'):
+					filenames.append(os.path.abspath(os.path.join(root, filename)))
+
+		for filename in filenames:
+			file_state = _file_state(filename)
+			manifest_entry = manifest["files"].get(filename, None)
+			if (manifest_entry is None) or (manifest_entry["state"] != file_state):
+				try:
+					manifest_entry = {"state" : file_state, "processors" : self._scan(filename)}
+				except ImportError as e:
+					log.warning("Failed to import module {0} from {1}.".format(os.path.splitext(os.path.basename(filename))[0], filename))
+					log.warning("Error message {0}.".format(e))
+					continue
+				manifest["files"][filename] = manifest_entry
+				manifest_changed = True
+
+			for name, attribute, processor_type, docstring in manifest_entry["processors"]:
+				self._entries[name] = (filename, attribute, processor_type, docstring)
+				self._processors.pop(name, None)
+
+		# forget deleted files
+		for filename in manifest["files"].keys():
+			if not os.path.exists(filename):
+				del manifest["files"][filename]
+				manifest_changed = True
+
+		if manifest_changed:
+			self._write_manifest(manifest)
+
+	@staticmethod
+	def _scan(filename):
+		"""
+		Import a module file and return a list of (name, attribute name, type, docstring) of its processors
+		"""
+		processors = []
+		for attribute, obj in inspect.getmembers(_load_module(filename)):
+			processor_type = _processor_type(obj)
+			if not processor_type is None:
+				processors.append([obj.name(), attribute, processor_type, inspect.getdoc(obj) or ""])
+		return processors
+
+	def _read_manifest(self):
+		try:
+			with open(self.manifest_file) as manifest_file:
+				manifest = json.load(manifest_file)
+			if manifest.get("version", None) == MANIFEST_VERSION:
+				return manifest
+		except (IOError, ValueError):
+			pass
+		return {"version" : MANIFEST_VERSION, "files" : {}}
+
+	def _write_manifest(self, manifest):
+		# the manifest is written atomically, since it can be shared between processes
+		try:
+			manifest_dir = os.path.dirname(self.manifest_file)
+			if not os.path.exists(manifest_dir):
+				os.makedirs(manifest_dir)
+			tmp_file_descriptor, tmp_manifest_file = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=manifest_dir)
+			with os.fdopen(tmp_file_descriptor, "w") as manifest_file:
+				json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+			os.rename(tmp_manifest_file, self.manifest_file)
+		except (IOError, OSError) as e:
+			log.debug("Unable to write the processor manifest \"{0}\": {1}".format(self.manifest_file, e))
+
+	def processor_type(self, name):
+		"""
+		Return the type ("input", "analysis" or "plot") of a processor without importing it
+		"""
+		if name in self._entries:
+			return self._entries[name][2]
+		return _processor_type(self._processors.get(name, None))
+
+	def docstring(self, name):
+		"""
+		Return the docstring of a processor without importing it
+		"""
+		if name in self._entries:
+			return self._entries[name][3]
+		return inspect.getdoc(self._processors[name]) or ""
+
+	def __getitem__(self, name):
+		if not name in self._processors:
+			if not name in self._entries:
+				raise KeyError(name)
+			filename, attribute, processor_type, docstring = self._entries[name]
+			self._processors[name] = getattr(_load_module(filename), attribute)
+		return self._processors[name]
+
+	def __setitem__(self, name, processor):
+		self._processors[name] = processor
+
+	def __delitem__(self, name):
+		if (not name in self._entries) and (not name in self._processors):
+			raise KeyError(name)
+		self._entries.pop(name, None)
+		self._processors.pop(name, None)
+
+	def __iter__(self):
+		return iter(list(self._entries.keys()) + [name for name in self._processors if not name in self._entries])
+
+	def __len__(self):
+		return len(set(self._entries.keys()) | set(self._processors.keys()))
+
+	def __contains__(self, name):
+		return (name in self._entries) or (name in self._processors)
+
+
+def get_processor_registry(modules_dirs):
+	"""
+	Return the registry of this process for the given module directories
+
+	The manifest is only checked once per process, such that further plots created in the same
+	process do not need to scan the module directories again.
+	"""
+	key = tuple(os.path.abspath(module_dir) for module_dir in modules_dirs)
+	if not key in _processor_registries:
+		_processor_registries[key] = ProcessorRegistry(list(key))
+	return _processor_registries[key]
+
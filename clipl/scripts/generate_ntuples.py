@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import argparse
+
+import ROOT
+ROOT.gROOT.SetBatch(True)
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gErrorIgnoreLevel = ROOT.kError
+
+import clipl.benchmarks.ntuples as ntuples
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Generate synthetic ntuples with correlated Gaussian variables and friend trees (vectorised, much faster than generateCorrelatedGaussians.py).", parents=[logger.loggingParser])
+
+	parser.add_argument("-o", "--output-dir", default="ntuples",
+	                    help="Output directory. [Default: %(default)s]")
+	parser.add_argument("--n-files", type=int, default=1,
+	                    help="Number of files (and of friend files). [Default: %(default)s]")
+	parser.add_argument("--n-events", type=int, default=100000,
+	                    help="Number of events per file. [Default: %(default)s]")
+	parser.add_argument("--n-branches", type=int, default=10,
+	                    help="Number of variables in the trees. [Default: %(default)s]")
+	parser.add_argument("--n-friend-branches", type=int, default=2,
+	                    help="Number of variables in the friend trees (besides the weight). [Default: %(default)s]")
+	parser.add_argument("-t", "--tree-name", default="ntuple",
+	                    help="Tree name. [Default: %(default)s]")
+	parser.add_argument("--friend-tree-name", default="friend",
+	                    help="Name of the friend trees. [Default: %(default)s]")
+	parser.add_argument("--seed", type=int, default=0,
+	                    help="Seed of the random numbers. [Default: %(default)s]")
+
+	args = parser.parse_args()
+	logger.initLogger(args)
+
+	generated_ntuples = ntuples.generate_ntuples(
+			args.output_dir,
+			n_files=args.n_files,
+			n_events=args.n_events,
+			n_branches=args.n_branches,
+			n_friend_branches=args.n_friend_branches,
+			tree_name=args.tree_name,
+			friend_tree_name=args.friend_tree_name,
+			seed=args.seed
+	)
+	log.info("Created tree \"%s\" in %d file(s) and friend tree \"%s\" in %d file(s) in \"%s\"." % (
+			args.tree_name, len(generated_ntuples["files"]), args.friend_tree_name, len(generated_ntuples["friend_files"]), args.output_dir
+	))
+
@@ -7,45 +7,35 @@ log = logging.getLogger(__name__)
 
 import argparse
 import os
+import sys
 
 import ROOT
 ROOT.gROOT.SetBatch(True)
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gErrorIgnoreLevel = ROOT.kError
 
+import clipl.utility.rootfileindex as rootfileindex
 import clipl.utility.roottools as roottools
-from clipl.utility.tfilecontextmanager import TFileContextManager
 
 if __name__ == "__main__":
 	
 	parser = argparse.ArgumentParser(description="Print binning of histograms", parents=[logger.loggingParser])
 
 	parser.add_argument("root_file", help="Input ROOT file")
+	parser.add_argument("--index-dir", default=rootfileindex.default_index_dir(),
+	                    help="Directory of the persistent metadata index. [Default: %(default)s]")
 
 	args = parser.parse_args()
 	logger.initLogger(args)
 	
-	with TFileContextManager(args.root_file, "READ") as root_file:
-		elements = roottools.RootTools.walk_root_directory(root_file)
+	metadata = rootfileindex.get_metadata(args.root_file, index_dir=args.index_dir)
+	if metadata is None:
+		sys.exit(1)
 	
-		for key, path in elements:
-			if key.GetClassName().startswith("TH") or key.GetClassName().startswith("TProfile"):
-				histogram = root_file.Get(path)
-				if histogram.GetDimension() == 1:
-					log.info("%s: %s" % (
-							path,
-							roottools.RootTools.binning_formatted(roottools.RootTools.get_binning(histogram, 0))
-					))
-				elif histogram.GetDimension() == 2:
-					log.info("%s: %s x %s" % (
-							path,
-							roottools.RootTools.binning_formatted(roottools.RootTools.get_binning(histogram, 0)),
-							roottools.RootTools.binning_formatted(roottools.RootTools.get_binning(histogram, 1))
-					))
-				else:
-					log.info("%s: %s x %s x %s" % (
-							path,
-							roottools.RootTools.binning_formatted(roottools.RootTools.get_binning(histogram, 0)),
-							roottools.RootTools.binning_formatted(roottools.RootTools.get_binning(histogram, 1)),
-							roottools.RootTools.binning_formatted(roottools.RootTools.get_binning(histogram, 2))
-					))
+	for path, class_name in metadata.elements():
+		histogram = metadata.histogram(path)
+		if histogram is not None:
+			log.info("%s: %s" % (
+					path,
+					" x ".join([roottools.RootTools.binning_formatted(binning) for binning in histogram["binnings"]])
+			))
@@ -7,32 +7,33 @@ log = logging.getLogger(__name__)
 
 import argparse
 import os
+import sys
 
 import ROOT
 ROOT.gROOT.SetBatch(True)
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gErrorIgnoreLevel = ROOT.kError
 
-import clipl.utility.roottools as roottools
-from clipl.utility.tfilecontextmanager import TFileContextManager
+import clipl.utility.rootfileindex as rootfileindex
 
 if __name__ == "__main__":
 	
 	parser = argparse.ArgumentParser(description="Print numbers of entries of trees.", parents=[logger.loggingParser])
 
 	parser.add_argument("root_file", help="Input ROOT file")
+	parser.add_argument("--index-dir", default=rootfileindex.default_index_dir(),
+	                    help="Directory of the persistent metadata index. [Default: %(default)s]")
 
 	args = parser.parse_args()
 	logger.initLogger(args)
 	
-	with TFileContextManager(args.root_file, "READ") as root_file:
-		elements = roottools.RootTools.walk_root_directory(root_file)
+	metadata = rootfileindex.get_metadata(args.root_file, index_dir=args.index_dir)
+	if metadata is None:
+		sys.exit(1)
 	
-		for key, path in sorted(elements, key=lambda x: (x[1])):
-			if key.GetClassName().startswith("TTree") or key.GetClassName().startswith("TNtuple"):
-				tree = root_file.Get(path)
-				log.info("%s: %d entries" % (path, tree.GetEntries()))
-			elif key.GetClassName().startswith("TH") or key.GetClassName().startswith("TProfile"):
-				histogram = root_file.Get(path)
-				log.info("%s: %d entries, integral %f" % (path, histogram.GetEntries(), histogram.Integral()))
+	for path, class_name in metadata.elements():
+		if metadata.tree(path) is not None:
+			log.info("%s: %d entries" % (path, metadata.tree(path)["entries"]))
+		elif metadata.histogram(path) is not None:
+			log.info("%s: %d entries, integral %f" % (path, metadata.histogram(path)["entries"], metadata.histogram(path)["integral"]))
 
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import clipl.benchmarks.scenarios as scenarios
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Run performance benchmarks on synthetic ntuples and write the timings to a JSON file.", parents=[logger.loggingParser])
+
+	parser.add_argument("-s", "--scenarios", nargs="+", default=scenarios.SCENARIOS.keys(), choices=scenarios.SCENARIOS.keys(),
+	                    help="Benchmark scenarios. [Default: all]")
+	parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=scenarios.SIZES.keys(),
+	                    help="Data sizes. [Default: %(default)s]")
+	parser.add_argument("-r", "--repetitions", type=int, default=5,
+	                    help="Number of timed repetitions per scenario. [Default: %(default)s]")
+	parser.add_argument("--warmup", type=int, default=1,
+	                    help="Number of repetitions per scenario before the timed ones. [Default: %(default)s]")
+	parser.add_argument("--seed", type=int, default=0,
+	                    help="Seed for the generation of the inputs. [Default: %(default)s]")
+	parser.add_argument("-w", "--work-dir", default=None,
+	                    help="Working directory for the inputs and outputs. Generated inputs are reused by later runs. [Default: temporary directory]")
+	parser.add_argument("-o", "--output", default="benchmarks.json",
+	                    help="Output JSON file with the results. [Default: %(default)s]")
+	parser.add_argument("--list-scenarios", default=False, action="store_true",
+	                    help="List the available scenarios and data sizes. [Default: %(default)s]")
+
+	args = parser.parse_args()
+	logger.initLogger(args)
+
+	if args.list_scenarios:
+		for name, function in scenarios.SCENARIOS.iteritems():
+			log.info("{name:<30s} {description}".format(name=name, description=(function.__doc__ or "").strip()))
+		for size, parameters in scenarios.SIZES.iteritems():
+			log.info("{size:<30s} {parameters}".format(size=size, parameters=", ".join(["{0}={1}".format(key, value) for key, value in sorted(parameters.iteritems())])))
+
+	else:
+		work_dir = args.work_dir or tempfile.mkdtemp(prefix="harry_benchmarks_")
+		try:
+			results = scenarios.run_benchmarks(
+					os.path.abspath(os.path.expandvars(work_dir)),
+					scenarios=args.scenarios,
+					sizes=args.sizes,
+					n_repetitions=args.repetitions,
+					n_warmup=args.warmup,
+					seed=args.seed
+			)
+		finally:
+			if args.work_dir is None:
+				shutil.rmtree(work_dir)
+
+		with open(args.output, "w") as output_file:
+			json.dump(results, output_file, indent=1, sort_keys=True)
+		log.info("Created results \"{output}\".".format(output=args.output))
+
@@ -0,0 +1,18 @@
+#!/bin/bash
+# Create the plots of a packed batch job one after another (see HarryPlotter.multi_plots)
+# Usage: harry_packed_job.sh <standalone executable> <CMSSW_BASE> <CWD> <file listing one JSON config per line>
+# Every plot is created through the standalone executable like the plots of unpacked jobs.
+# The exit code is non-zero in case at least one of the plots failed.
+
+standalone_executable="$1"
+cmssw_base="$2"
+cwd="$3"
+json_configs_file="$4"
+
+status=0
+while IFS= read -r json_config || [ -n "$json_config" ]; do
+	[ -z "$json_config" ] && continue
+	echo "Plot \"$json_config\""
+	"$standalone_executable" -c "$cmssw_base" -d "$cwd" " -j $(printf '%q' "$json_config") --log-level debug --record-plot-timings" || status=1
+done < "$json_configs_file"
+exit $status
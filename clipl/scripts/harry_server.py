@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import argparse
+import sys
+
+import clipl.harryserver as harryserver
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Start a harry server keeping warm plotting processes. harry.py forwards plots to it as long as it is running.", parents=[logger.loggingParser])
+
+	parser.add_argument("--socket", default=harryserver.default_socket_file(),
+	                    help="Unix socket of the server. [Default: %(default)s]")
+	parser.add_argument("-n", "--n-workers", type=int, default=None,
+	                    help="Number of worker processes. [Default: number of CPUs]")
+	parser.add_argument("--max-plots-per-worker", type=int, default=100,
+	                    help="Restart worker processes after this number of plots in order to limit their memory usage. [Default: %(default)s]")
+	parser.add_argument("--status", default=False, action="store_true",
+	                    help="Print the status of a running server. [Default: %(default)s]")
+	parser.add_argument("--stop", default=False, action="store_true",
+	                    help="Stop a running server. [Default: %(default)s]")
+
+	args = parser.parse_args()
+	logger.initLogger(args)
+
+	if args.status:
+		status = harryserver.ping(args.socket)
+		if status is None:
+			log.info("No harry server is listening on \"%s\"." % args.socket)
+			sys.exit(1)
+		log.info("Harry server (PID %d) is listening on \"%s\" with %d workers." % (status["pid"], args.socket, status["n_workers"]))
+
+	elif args.stop:
+		if harryserver.shutdown(args.socket) is None:
+			log.critical("No harry server is listening on \"%s\"!" % args.socket)
+			sys.exit(1)
+		log.info("Requested the harry server to stop.")
+
+	else:
+		harryserver.HarryServer(
+				socket_file=args.socket,
+				n_workers=args.n_workers,
+				max_plots_per_worker=args.max_plots_per_worker
+		).serve()
+
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import argparse
+import datetime
+import os
+import sys
+
+import clipl.utility.cacheindex as cacheindex
+
+
+def _format_time(timestamp):
+	return "-" if timestamp is None else datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Inspect and clean up the HP caches using their index.", parents=[logger.loggingParser])
+
+	parser.add_argument("--cache-dir", default=os.path.expandvars(os.path.join("$HP_WORK_BASE_COMMON", "caches")),
+	                    help="Cache directory. [Default: %(default)s]")
+
+	subparsers = parser.add_subparsers(dest="command")
+
+	stats_parser = subparsers.add_parser("stats", help="Print size and access statistics of the caches.")
+
+	prune_parser = subparsers.add_parser("prune", help="Delete caches exceeding a size budget or not accessed for a given time.")
+	prune_parser.add_argument("--max-size", default=os.environ.get("HP_CACHE_MAX_SIZE", None),
+	                          help="Maximum total size of the caches (e.g. \"500G\"). [Default: $HP_CACHE_MAX_SIZE or unlimited]")
+	prune_parser.add_argument("--max-age", type=float, default=None,
+	                          help="Delete caches not accessed for more than this number of days. [Default: %(default)s]")
+	prune_parser.add_argument("--policy", default="lru", choices=cacheindex.EVICTION_POLICIES,
+	                          help="Delete least recently (lru) or least frequently (lfu) used caches first. [Default: %(default)s]")
+	prune_parser.add_argument("-n", "--dry-run", default=False, action="store_true",
+	                          help="Only print the caches to be deleted. [Default: %(default)s]")
+
+	verify_parser = subparsers.add_parser("verify", help="Synchronise the index with the files in the cache directory.")
+	verify_parser.add_argument("-n", "--dry-run", default=False, action="store_true",
+	                           help="Only print the differences. [Default: %(default)s]")
+
+	args = parser.parse_args()
+	logger.initLogger(args)
+
+	if not os.path.isdir(args.cache_dir):
+		log.critical("Cache directory \"%s\" does not exist!" % args.cache_dir)
+		sys.exit(1)
+	index = cacheindex.CacheIndex(args.cache_dir)
+
+	if args.command == "stats":
+		stats = index.stats()
+		log.info("Cache directory: %s" % args.cache_dir)
+		log.info("Entries:         %d" % stats["n_entries"])
+		log.info("Total size:      %s" % cacheindex.format_size(stats["total_size"]))
+		log.info("Accesses:        %d" % stats["n_accesses"])
+		log.info("Oldest access:   %s" % _format_time(stats["oldest_access"]))
+		log.info("Newest access:   %s" % _format_time(stats["newest_access"]))
+
+	elif args.command == "prune":
+		try:
+			max_size = cacheindex.parse_size(args.max_size)
+		except ValueError, e:
+			log.critical(str(e))
+			sys.exit(1)
+		if (max_size is None) and (args.max_age is None):
+			log.critical("Specify at least one of the options --max-size and --max-age!")
+			sys.exit(1)
+
+		size_before = index.total_size()
+		deleted = index.evict(
+				max_size=max_size,
+				max_age=(None if args.max_age is None else args.max_age * 24.0 * 60.0 * 60.0),
+				policy=args.policy,
+				dry_run=args.dry_run
+		)
+		for path in deleted:
+			log.debug(os.path.join(args.cache_dir, path))
+		log.info("%s %d caches, total size reduced from %s to %s." % (
+				"Would delete" if args.dry_run else "Deleted",
+				len(deleted),
+				cacheindex.format_size(size_before),
+				cacheindex.format_size(size_before if args.dry_run else index.total_size())
+		))
+
+	elif args.command == "verify":
+		missing, added, updated, orphaned_lock_files = index.verify(dry_run=args.dry_run)
+		for label, paths in [("Missing file", missing), ("Unindexed file", added), ("Changed size", updated), ("Orphaned lock file", orphaned_lock_files)]:
+			for path in paths:
+				log.debug("%s: %s" % (label, os.path.join(args.cache_dir, path)))
+		log.info("%d indexed caches are missing, %d caches were not indexed, %d caches changed their size, %d lock files are orphaned.%s" % (
+				len(missing), len(added), len(updated), len(orphaned_lock_files),
+				"" if args.dry_run else " The index has been updated."
+		))
+
@@ -26,6 +26,14 @@ if __name__ == "__main__":
 	                    help="Number of (parallel) processes. [Default: %(default)s]")
 	parser.add_argument("-f", "--n-plots", type=int,
 	                    help="Number of plots. [Default: all]")
+	parser.add_argument("--plot-timeout", type=float, default=None,
+	                    help="Maximum time per plot in seconds in case of parallel processes. [Default: %(default)s]")
+	parser.add_argument("--max-plots-per-process", type=int, default=50,
+	                    help="Replace plotting processes after this number of plots. [Default: %(default)s]")
+	parser.add_argument("--max-rss", type=float, default=None,
+	                    help="Replace plotting processes using more memory (MB). [Default: %(default)s]")
+	parser.add_argument("--no-input-planning", default=False, action="store_true",
+	                    help="Do not fill the (deduplicated) inputs of all plots before creating them in parallel processes. [Default: %(default)s]")
 	
 	args = parser.parse_args()
 	logger.initLogger(args)
@@ -44,5 +52,7 @@ if __name__ == "__main__":
 		plot_configs.append(plot_config)
 		plot_args.append(plot_arg)
 	
-	harry_plotter = harry.HarryPlotter(list_of_config_dicts=plot_configs, list_of_args_strings=plot_args, n_processes=args.n_processes, n_plots=args.n_plots)
+	harry_plotter = harry.HarryPlotter(list_of_config_dicts=plot_configs, list_of_args_strings=plot_args, n_processes=args.n_processes, n_plots=args.n_plots,
+	                                   plot_timeout=args.plot_timeout, max_plots_per_process=args.max_plots_per_process, max_rss=args.max_rss,
+	                                   input_planning=(not args.no_input_planning))
 
@@ -7,13 +7,14 @@ log = logging.getLogger(__name__)
 
 import argparse
 import os
+import sys
 
 import ROOT
 ROOT.gROOT.SetBatch(True)
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gErrorIgnoreLevel = ROOT.kError
 
-import clipl.utility.roottools as roottools
+import clipl.utility.rootfileindex as rootfileindex
 from clipl.utility.tfilecontextmanager import TFileContextManager
 
 if __name__ == "__main__":
@@ -21,15 +22,21 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Print contents of trees.", parents=[logger.loggingParser])
 
 	parser.add_argument("root_file", help="Input ROOT file")
+	parser.add_argument("--index-dir", default=rootfileindex.default_index_dir(),
+	                    help="Directory of the persistent metadata index. [Default: %(default)s]")
 
 	args = parser.parse_args()
 	logger.initLogger(args)
 	
-	with TFileContextManager(args.root_file, "READ") as root_file:
-		elements = roottools.RootTools.walk_root_directory(root_file)
+	metadata = rootfileindex.get_metadata(args.root_file, index_dir=args.index_dir)
+	if metadata is None:
+		sys.exit(1)
 	
-		for key, path in elements:
-			if key.GetClassName().startswith("TTree") or key.GetClassName().startswith("TNtuple"):
+	# the file is only opened in case it contains trees
+	paths_to_trees = [path for path, class_name in metadata.elements() if rootfileindex.inherits_from(class_name, "TTree")]
+	if len(paths_to_trees) > 0:
+		with TFileContextManager(args.root_file, "READ") as root_file:
+			for path in paths_to_trees:
 				tree = root_file.Get(path)
 				log.info("\nContent of tree \"{tree}\":\n".format(tree=path))
 				tree.Scan("*")
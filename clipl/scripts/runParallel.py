@@ -25,6 +25,8 @@ def main():
 	parser.add_argument("commands", help="Commands to be executed on a batch system. They can also be piped into this program.", nargs="*", default=[])
 	parser.add_argument("-n", "--n-processes", type=int, default=1,
 	                    help="Number of (parallel) processes. [Default: %(default)s]")
+	parser.add_argument("--timeout", type=float, default=None,
+	                    help="Maximum time per command in seconds in case of parallel processes. [Default: %(default)s]")
 
 	args = parser.parse_args()
 	logger.initLogger(args)
@@ -33,7 +35,7 @@ def main():
 	if (len(args.commands) == 0) and (not sys.stdin.isatty()):
 		args.commands.extend(sys.stdin.read().strip().split("\n"))
 	
-	tools.parallelize(run_command, args.commands, n_processes=args.n_processes, description=os.path.basename(sys.argv[0]))
+	tools.parallelize(run_command, args.commands, n_processes=args.n_processes, description=os.path.basename(sys.argv[0]), timeout=args.timeout, ignore_failures=True)
 
 
 if __name__ == "__main__":
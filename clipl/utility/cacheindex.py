@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index of the files in a cache directory with their sizes and access statistics
+
+The index is kept in an SQLite database in the cache directory. It is used to keep
+the total size of the cache below a given budget by deleting the least recently (LRU)
+or least frequently (LFU) used entries.
+
+The total size of the entries is tracked by triggers of the database, such that checking the
+budget does not need to scan the index. Accesses are collected in memory and written to the
+index in batches (see touch and flush). The collected accesses are written at exit and after
+every task of a worker process (see executor.register_after_task).
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import atexit
+import errno
+import fcntl
+import os
+import re
+import sqlite3
+import time
+import weakref
+
+import clipl.utility.executor as executor
+
+
+EVICTION_POLICIES = ["lru", "lfu"]
+
+# lock files of the entries (see RootFileCache._lock) are named <entry><LOCK_SUFFIX>
+LOCK_SUFFIX = ".lock"
+
+
+# all indices of this process, see flush_all
+_indices = weakref.WeakSet()
+
+
+def flush_all():
+	"""
+	write the collected accesses of all indices of this process
+	"""
+	for index in list(_indices):
+		index.flush()
+
+atexit.register(flush_all)
+executor.register_after_task(flush_all)
+
+
+def parse_size(size):
+	"""
+	convert sizes like "500M", "20G" or "1T" into bytes
+	None and integers are returned unchanged
+	"""
+	if (size is None) or isinstance(size, (int, long)):
+		return size
+	match = re.match(r"^\s*(?P<value>[0-9.]+)\s*(?P<unit>[kKMGTP]?)i?B?\s*$", str(size))
+	if match is None:
+		raise ValueError("Size \"%s\" cannot be parsed!" % size)
+	return int(float(match.group("value")) * (1024 ** " KMGTP".index(match.group("unit").upper() or " ")))
+
+
+def format_size(size):
+	for unit in ["B", "kB", "MB", "GB", "TB"]:
+		if abs(size) < 1024.0:
+			return "%.1f %s" % (size, unit)
+		size /= 1024.0
+	return "%.1f PB" % size
+
+
+class CacheIndex(object):
+	def __init__(self, cache_dir, index_name="index.sqlite", timeout=60.0, max_pending_accesses=100, flush_interval=60.0):
+		"""
+		max_pending_accesses, flush_interval: accesses are written to the index as soon as this number
+		of accesses is collected or the oldest collected access is older than this time in seconds
+		"""
+		self.cache_dir = cache_dir
+		self.index_file = os.path.join(cache_dir, index_name)
+		self.timeout = timeout
+		self.max_pending_accesses = max_pending_accesses
+		self.flush_interval = flush_interval
+
+		# relative path -> (path, last access, number of accesses) of accesses not yet written to the index
+		self._pending_accesses = {}
+		self._pending_since = None
+		self._pid = os.getpid()
+		_indices.add(self)
+
+		with self._connect() as connection:
+			connection.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER, created REAL, last_access REAL, n_accesses INTEGER)")
+			connection.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)")
+			connection.execute("INSERT OR IGNORE INTO totals SELECT 0, COALESCE(SUM(size), 0) FROM entries")
+			connection.execute("CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN UPDATE totals SET size = size + NEW.size WHERE id = 0; END")
+			connection.execute("CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN UPDATE totals SET size = size - OLD.size WHERE id = 0; END")
+			connection.execute("CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN UPDATE totals SET size = size + NEW.size - OLD.size WHERE id = 0; END")
+
+	def _connect(self):
+		# the connection is used as context manager committing (or rolling back) the transaction
+		return sqlite3.connect(self.index_file, timeout=self.timeout)
+
+	def _relative_path(self, path):
+		return os.path.relpath(os.path.abspath(path), os.path.abspath(self.cache_dir))
+
+	def add(self, path):
+		"""
+		register a new (or overwritten) cache entry
+		"""
+		now = time.time()
+		relative_path = self._relative_path(path)
+		with self._connect() as connection:
+			# replacing rows does not fire the delete trigger
+			connection.execute("DELETE FROM entries WHERE path = ?", (relative_path,))
+			connection.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", (relative_path, os.path.getsize(path), now, now, 1))
+
+	def touch(self, path):
+		"""
+		register an access of a cache entry
+
+		The access is written to the index with the next flush.
+		"""
+		self._drop_inherited_accesses()
+		now = time.time()
+		relative_path = self._relative_path(path)
+		n_accesses = self._pending_accesses.get(relative_path, (None, None, 0))[2]
+		self._pending_accesses[relative_path] = (path, now, n_accesses + 1)
+		if self._pending_since is None:
+			self._pending_since = now
+		if (len(self._pending_accesses) >= self.max_pending_accesses) or ((now - self._pending_since) > self.flush_interval):
+			self.flush()
+
+	def flush(self):
+		"""
+		write the collected accesses to the index
+		"""
+		self._drop_inherited_accesses()
+		if len(self._pending_accesses) == 0:
+			return
+		pending_accesses = self._pending_accesses
+		self._pending_accesses = {}
+		self._pending_since = None
+		with self._connect() as connection:
+			for relative_path, (path, last_access, n_accesses) in pending_accesses.iteritems():
+				cursor = connection.execute("UPDATE entries SET last_access = ?, n_accesses = n_accesses + ? WHERE path = ?", (last_access, n_accesses, relative_path))
+				if (cursor.rowcount == 0) and os.path.exists(path):
+					connection.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", (relative_path, os.path.getsize(path), os.path.getmtime(path), last_access, n_accesses))
+
+	def _drop_inherited_accesses(self):
+		# accesses collected before forking are written by the parent process
+		if self._pid != os.getpid():
+			self._pending_accesses = {}
+			self._pending_since = None
+			self._pid = os.getpid()
+
+	def total_size(self):
+		with self._connect() as connection:
+			return connection.execute("SELECT size FROM totals WHERE id = 0").fetchone()[0]
+
+	def stats(self):
+		"""
+		return a dict with the number of entries, their total size and access statistics
+		"""
+		self.flush()
+		with self._connect() as connection:
+			n_entries, total_size, n_accesses, oldest_access, newest_access = connection.execute(
+					"SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(n_accesses), 0), MIN(last_access), MAX(last_access) FROM entries"
+			).fetchone()
+		return {
+			"n_entries" : n_entries,
+			"total_size" : total_size,
+			"n_accesses" : n_accesses,
+			"oldest_access" : oldest_access,
+			"newest_access" : newest_access,
+		}
+
+	def evict(self, max_size=None, max_age=None, policy="lru", keep=[], dry_run=False):
+		"""
+		delete entries not accessed for more than max_age seconds and further entries
+		according to the policy until the total size is below max_size (in bytes)
+
+		keep: list of paths not to be deleted, e.g. the entry that has just been created
+		returns the list of deleted (relative) paths
+
+		The index is only scanned if max_age is set or the total size exceeds max_size.
+		"""
+		if not policy in EVICTION_POLICIES:
+			raise ValueError("Unknown eviction policy \"%s\"! Choose from %s." % (policy, EVICTION_POLICIES))
+		if (max_age is None) and ((max_size is None) or (self.total_size() <= max_size)):
+			return []
+		self.flush()
+		keep = [self._relative_path(path) for path in keep]
+		order = "last_access ASC" if policy == "lru" else "n_accesses ASC, last_access ASC"
+
+		with self._connect() as connection:
+			entries = connection.execute("SELECT path, size, last_access FROM entries ORDER BY " + order).fetchall()
+
+		total_size = sum([size for path, size, last_access in entries])
+		now = time.time()
+		to_delete = []
+		for path, size, last_access in entries:
+			if path in keep:
+				continue
+			too_old = (max_age is not None) and ((now - last_access) > max_age)
+			too_large = (max_size is not None) and (total_size > max_size)
+			if too_old or too_large:
+				to_delete.append(path)
+				total_size -= size
+
+		if not dry_run:
+			for path in to_delete:
+				self._remove_file(path)
+			self._remove_entries(to_delete)
+		return to_delete
+
+	def verify(self, dry_run=False):
+		"""
+		synchronise the index with the files in the cache directory
+
+		Entries of missing files are removed from the index, files unknown to the index are added
+		and entries with changed sizes are updated. Lock files of missing entries are deleted unless
+		they are currently locked.
+		returns (missing paths, added paths, updated paths, orphaned lock files)
+		"""
+		self.flush()
+		with self._connect() as connection:
+			indexed_sizes = dict(connection.execute("SELECT path, size FROM entries").fetchall())
+
+		existing_sizes = {}
+		lock_files = []
+		for directory, sub_directories, file_names in os.walk(self.cache_dir):
+			for file_name in file_names:
+				# skip temporary files of caches currently being written
+				if file_name.endswith(".root") and (not file_name.startswith(".tmp_")):
+					path = os.path.join(directory, file_name)
+					existing_sizes[self._relative_path(path)] = os.path.getsize(path)
+				elif file_name.endswith(".root"+LOCK_SUFFIX):
+					lock_files.append(self._relative_path(os.path.join(directory, file_name)))
+		orphaned_lock_files = sorted([path for path in lock_files if not path[:-len(LOCK_SUFFIX)] in existing_sizes])
+
+		missing = sorted(set(indexed_sizes.keys()) - set(existing_sizes.keys()))
+		added = sorted(set(existing_sizes.keys()) - set(indexed_sizes.keys()))
+		updated = sorted([path for path in set(existing_sizes.keys()) & set(indexed_sizes.keys()) if existing_sizes[path] != indexed_sizes[path]])
+
+		if not dry_run:
+			self._remove_entries(missing)
+			with self._connect() as connection:
+				for path in added:
+					modification_time = os.path.getmtime(os.path.join(self.cache_dir, path))
+					connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (path, existing_sizes[path], modification_time, modification_time, 0))
+				for path in updated:
+					connection.execute("UPDATE entries SET size = ? WHERE path = ?", (existing_sizes[path], path))
+				connection.execute("UPDATE totals SET size = (SELECT COALESCE(SUM(size), 0) FROM entries) WHERE id = 0")
+			for path in orphaned_lock_files:
+				self._remove_lock_file(os.path.join(self.cache_dir, path))
+				self._remove_empty_directories(os.path.dirname(os.path.join(self.cache_dir, path)))
+		return missing, added, updated, orphaned_lock_files
+
+	def _remove_entries(self, paths):
+		with self._connect() as connection:
+			connection.executemany("DELETE FROM entries WHERE path = ?", [(path,) for path in paths])
+
+	def _remove_file(self, relative_path):
+		path = os.path.join(self.cache_dir, relative_path)
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		self._remove_lock_file(path + LOCK_SUFFIX)
+		self._remove_empty_directories(os.path.dirname(path))
+
+	@staticmethod
+	def _remove_lock_file(path):
+		"""
+		delete a lock file unless it is currently locked by another process
+		"""
+		if not os.path.exists(path):
+			return
+		try:
+			with open(path, "a") as lock_file:
+				fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				try:
+					os.remove(path)
+				finally:
+					fcntl.lockf(lock_file, fcntl.LOCK_UN)
+		except IOError, e:
+			if not e.errno in [errno.EACCES, errno.EAGAIN, errno.ENOENT]:
+				raise
+		except OSError:
+			pass
+
+	def _remove_empty_directories(self, directory):
+		# remove empty hash directories
+		while os.path.abspath(directory) != os.path.abspath(self.cache_dir):
+			try:
+				os.rmdir(directory)
+			except OSError:
+				break
+			directory = os.path.dirname(directory)
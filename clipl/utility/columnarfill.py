@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar filling of histograms from trees using NumPy
+
+Simple TTree::Draw expressions (arithmetics, comparisons, logical operators and common
+mathematical functions on flat branches of fundamental types) are translated into NumPy
+expressions. The referenced branches are read into arrays (file by file) and the histograms
+are filled vectorised via numpy.histogramdd.
+
+Expressions that cannot be translated and files whose arrays would exceed MAX_READ_SIZE are
+not handled here. The callers are expected to fall back to ROOT.TTree.Draw in this case.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import numpy
+import re
+
+import ROOT
+
+
+# maximum size of the arrays read from one file
+MAX_READ_SIZE = 256 * 1024 * 1024 # bytes
+
+FUNCTIONS = {
+	"numpy.abs" : ["abs", "fabs", "std::abs", "std::fabs", "TMath::Abs"],
+	"numpy.sqrt" : ["sqrt", "std::sqrt", "TMath::Sqrt"],
+	"numpy.exp" : ["exp", "std::exp", "TMath::Exp"],
+	"numpy.log" : ["log", "std::log", "TMath::Log"],
+	"numpy.log10" : ["log10", "std::log10", "TMath::Log10"],
+	"numpy.sin" : ["sin", "std::sin", "TMath::Sin"],
+	"numpy.cos" : ["cos", "std::cos", "TMath::Cos"],
+	"numpy.tan" : ["tan", "std::tan", "TMath::Tan"],
+	"numpy.arcsin" : ["asin", "std::asin", "TMath::ASin"],
+	"numpy.arccos" : ["acos", "std::acos", "TMath::ACos"],
+	"numpy.arctan" : ["atan", "std::atan", "TMath::ATan"],
+	"numpy.arctan2" : ["atan2", "std::atan2", "TMath::ATan2"],
+	"numpy.sinh" : ["sinh", "std::sinh", "TMath::SinH"],
+	"numpy.cosh" : ["cosh", "std::cosh", "TMath::CosH"],
+	"numpy.tanh" : ["tanh", "std::tanh", "TMath::TanH"],
+	"numpy.floor" : ["floor", "std::floor", "TMath::Floor"],
+	"numpy.ceil" : ["ceil", "std::ceil", "TMath::Ceil"],
+	"numpy.power" : ["pow", "std::pow", "TMath::Power"],
+	"numpy.minimum" : ["min", "std::min", "TMath::Min"],
+	"numpy.maximum" : ["max", "std::max", "TMath::Max"],
+}
+FUNCTIONS = {name : numpy_function for numpy_function, names in FUNCTIONS.iteritems() for name in names}
+
+CONSTANTS = {
+	"TMath::Pi" : "numpy.pi",
+	"TMath::E" : "numpy.e",
+	"true" : "1.0",
+	"false" : "0.0",
+}
+
+BRANCH_TYPES = [
+	"Bool_t", "bool",
+	"Char_t", "UChar_t", "char", "unsigned char",
+	"Short_t", "UShort_t", "short", "unsigned short",
+	"Int_t", "UInt_t", "int", "unsigned int",
+	"Long_t", "ULong_t", "Long64_t", "ULong64_t", "long", "unsigned long", "long long", "unsigned long long",
+	"Float_t", "Double_t", "float", "double",
+]
+
+_token_regex = re.compile(r"\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(?P<name>[A-Za-z_]\w*(?:::[A-Za-z_]\w*)*)|(?P<operator>&&|\|\||<=|>=|==|!=|[-+*/%^<>!(),]))")
+
+
+class UnsupportedExpression(Exception):
+	pass
+
+
+class _Parser(object):
+	"""
+	Recursive descent parser translating a TTree::Draw expression into a Python expression
+	operating on NumPy arrays. Operator precedences follow C++, comparisons and logical
+	operations result in 0.0 and 1.0.
+	"""
+	def __init__(self, expression):
+		self.tokens = []
+		position = 0
+		expression = expression.strip()
+		while position < len(expression):
+			match = _token_regex.match(expression, position)
+			if (match is None) or (match.end() == position):
+				raise UnsupportedExpression("Unsupported character %r in expression \"%s\"." % (expression[position], expression))
+			kind = match.lastgroup
+			self.tokens.append((kind, match.group(kind)))
+			position = match.end()
+			while (position < len(expression)) and expression[position].isspace():
+				position += 1
+		self.position = 0
+		self.branch_names = set()
+
+	def parse(self):
+		if len(self.tokens) == 0:
+			raise UnsupportedExpression("Empty expression.")
+		result = self._logical_or()
+		if self.position != len(self.tokens):
+			raise UnsupportedExpression("Unexpected token \"%s\"." % self.tokens[self.position][1])
+		return result
+
+	def _peek(self):
+		return self.tokens[self.position][1] if self.position < len(self.tokens) else None
+
+	def _next(self):
+		if self.position >= len(self.tokens):
+			raise UnsupportedExpression("Unexpected end of expression.")
+		self.position += 1
+		return self.tokens[self.position-1]
+
+	def _expect(self, token):
+		if self._next()[1] != token:
+			raise UnsupportedExpression("Expected \"%s\"." % token)
+
+	def _logical_or(self):
+		result = self._logical_and()
+		while self._peek() == "||":
+			self._next()
+			result = "(numpy.logical_or(%s, %s) * 1.0)" % (result, self._logical_and())
+		return result
+
+	def _logical_and(self):
+		result = self._equality()
+		while self._peek() == "&&":
+			self._next()
+			result = "(numpy.logical_and(%s, %s) * 1.0)" % (result, self._equality())
+		return result
+
+	def _equality(self):
+		result = self._relational()
+		while self._peek() in ["==", "!="]:
+			operator = self._next()[1]
+			result = "((%s %s %s) * 1.0)" % (result, operator, self._relational())
+		return result
+
+	def _relational(self):
+		result = self._additive()
+		while self._peek() in ["<", ">", "<=", ">="]:
+			operator = self._next()[1]
+			result = "((%s %s %s) * 1.0)" % (result, operator, self._additive())
+		return result
+
+	def _additive(self):
+		result = self._multiplicative()
+		while self._peek() in ["+", "-"]:
+			operator = self._next()[1]
+			result = "(%s %s %s)" % (result, operator, self._multiplicative())
+		return result
+
+	def _multiplicative(self):
+		result = self._unary()
+		while self._peek() in ["*", "/", "%"]:
+			operator = self._next()[1]
+			if operator == "%":
+				result = "numpy.fmod(numpy.trunc(%s), numpy.trunc(%s))" % (result, self._unary())
+			else:
+				result = "(%s %s %s)" % (result, operator, self._unary())
+		return result
+
+	def _unary(self):
+		if self._peek() in ["-", "+"]:
+			return "(%s%s)" % (self._next()[1], self._unary())
+		elif self._peek() == "!":
+			self._next()
+			return "(numpy.logical_not(%s) * 1.0)" % self._unary()
+		return self._power()
+
+	def _power(self):
+		result = self._primary()
+		if self._peek() == "^":
+			self._next()
+			result = "numpy.power(%s, %s)" % (result, self._unary())
+		return result
+
+	def _primary(self):
+		kind, token = self._next()
+		if kind == "number":
+			return repr(float(token))
+		elif token == "(":
+			result = self._logical_or()
+			self._expect(")")
+			return result
+		elif kind == "name":
+			if self._peek() == "(":
+				self._next()
+				arguments = []
+				if self._peek() != ")":
+					arguments.append(self._logical_or())
+					while self._peek() == ",":
+						self._next()
+						arguments.append(self._logical_or())
+				self._expect(")")
+				if (len(arguments) == 0) and (token in CONSTANTS):
+					return CONSTANTS[token]
+				elif token in FUNCTIONS:
+					return "%s(%s)" % (FUNCTIONS[token], ", ".join(arguments))
+				raise UnsupportedExpression("Unsupported function \"%s\"." % token)
+			elif token in CONSTANTS:
+				return CONSTANTS[token]
+			elif "::" in token:
+				raise UnsupportedExpression("Unsupported name \"%s\"." % token)
+			self.branch_names.add(token)
+			return "columns[%r]" % token
+		raise UnsupportedExpression("Unexpected token \"%s\"." % token)
+
+
+def translate_expression(expression):
+	"""
+	Translate a TTree::Draw expression into a NumPy expression
+
+	Returns (python_expression, set of branch names). Raises UnsupportedExpression.
+	"""
+	parser = _Parser(expression)
+	return parser.parse(), parser.branch_names
+
+
+def split_variable_expression(variable_expression):
+	"""
+	Split a TTree::Draw variable expression "z:y:x" into the list [x, y, z] ("::" is not split)
+	"""
+	return re.split(r"(?<!:):(?!:)", variable_expression)[::-1]
+
+
+def check_branches(tree, branch_names):
+	"""
+	Raise UnsupportedExpression in case not all branches are flat branches of fundamental types.
+	"""
+	for branch_name in branch_names:
+		if tree.GetAlias(branch_name):
+			raise UnsupportedExpression("Aliases are not supported (\"%s\")." % branch_name)
+		branch = tree.GetBranch(branch_name)
+		if (not branch) or (branch.GetListOfLeaves().GetEntries() != 1):
+			raise UnsupportedExpression("\"%s\" is no flat branch." % branch_name)
+		leaf = branch.GetListOfLeaves().At(0)
+		if leaf.GetLeafCount() or (leaf.GetLenStatic() != 1) or (not leaf.GetTypeName() in BRANCH_TYPES):
+			raise UnsupportedExpression("Branch \"%s\" of type \"%s\" is not supported." % (branch_name, leaf.GetTypeName()))
+
+
+class HistogramFiller(object):
+	"""
+	Fill a ROOT histogram (TH1, TH2 or TH3, no profiles) from NumPy arrays
+	"""
+	def __init__(self, root_histogram, variable_expression, weight_selection):
+		if (not isinstance(root_histogram, ROOT.TH1)) or isinstance(root_histogram, (ROOT.TProfile, ROOT.TProfile2D, ROOT.TProfile3D)):
+			raise UnsupportedExpression("Only histograms without profiles can be filled.")
+
+		self.root_histogram = root_histogram
+		self.dimension = root_histogram.GetDimension()
+		expressions = split_variable_expression(variable_expression)
+		if len(expressions) != self.dimension:
+			raise UnsupportedExpression("Number of expressions does not match the dimension of the histogram.")
+
+		translated = [translate_expression(expression) for expression in expressions]
+		if str(weight_selection).strip() != "":
+			translated.append(translate_expression(str(weight_selection)))
+		else:
+			translated.append(("1.0", set()))
+
+		self.branch_names = set().union(*[branch_names for python_expression, branch_names in translated])
+		self.compiled_expressions = [compile(python_expression, "<%s>" % python_expression, "eval") for python_expression, branch_names in translated]
+
+		axes = [root_histogram.GetXaxis(), root_histogram.GetYaxis(), root_histogram.GetZaxis()][:self.dimension]
+		self.bin_edges = [numpy.array([axis.GetBinLowEdge(bin_index) for bin_index in xrange(1, axis.GetNbins()+2)]) for axis in axes]
+		# additional infinite edges for the under- and overflow bins
+		self.bin_edges_with_flow = [numpy.concatenate(([-numpy.inf], bin_edges, [numpy.inf])) for bin_edges in self.bin_edges]
+
+		self.sum_of_weights = numpy.zeros([len(bin_edges)+1 for bin_edges in self.bin_edges])
+		self.sum_of_squared_weights = numpy.zeros(self.sum_of_weights.shape)
+		self.statistics = numpy.zeros(13)
+		self.n_entries = 0
+		self.weighted = False
+
+	def fill(self, columns, n_rows):
+		"""
+		Fill the histogram from the arrays of the referenced branches (dict of branch name and array)
+		"""
+		environment = {"numpy" : numpy, "columns" : columns, "__builtins__" : {}}
+		values = [numpy.broadcast_to(numpy.asarray(eval(compiled_expression, environment), dtype=numpy.float64), (n_rows,)) for compiled_expression in self.compiled_expressions]
+		weights = values.pop()
+
+		# TTree::Draw skips entries with vanishing weights
+		selected = (weights != 0.0)
+		values = [value[selected] for value in values]
+		weights = weights[selected]
+		if len(weights) == 0:
+			return
+		self.n_entries += len(weights)
+		self.weighted = self.weighted or numpy.any(weights != 1.0)
+
+		sample = numpy.column_stack(values)
+		self.sum_of_weights += numpy.histogramdd(sample, bins=self.bin_edges_with_flow, weights=weights)[0]
+		self.sum_of_squared_weights += numpy.histogramdd(sample, bins=self.bin_edges_with_flow, weights=weights*weights)[0]
+
+		# statistics are only determined from entries inside the axis ranges (see ROOT.TH1.GetStats)
+		in_range = numpy.ones(len(weights), dtype=bool)
+		for value, bin_edges in zip(values, self.bin_edges):
+			in_range &= (value >= bin_edges[0]) & (value < bin_edges[-1])
+		w = weights[in_range]
+		x, y, z = (values + [None, None])[:3]
+		self.statistics[0] += numpy.sum(w)
+		self.statistics[1] += numpy.sum(w*w)
+		self.statistics[2] += numpy.sum(w*x[in_range])
+		self.statistics[3] += numpy.sum(w*x[in_range]*x[in_range])
+		if self.dimension > 1:
+			self.statistics[4] += numpy.sum(w*y[in_range])
+			self.statistics[5] += numpy.sum(w*y[in_range]*y[in_range])
+			self.statistics[6] += numpy.sum(w*x[in_range]*y[in_range])
+		if self.dimension > 2:
+			self.statistics[7] += numpy.sum(w*z[in_range])
+			self.statistics[8] += numpy.sum(w*z[in_range]*z[in_range])
+			self.statistics[9] += numpy.sum(w*x[in_range]*z[in_range])
+			self.statistics[10] += numpy.sum(w*y[in_range]*z[in_range])
+
+	def finish(self):
+		"""
+		Add the filled contents to the ROOT histogram
+		"""
+		root_histogram = self.root_histogram
+		previous_statistics = numpy.zeros(13)
+		root_histogram.GetStats(previous_statistics)
+		previous_entries = root_histogram.GetEntries()
+
+		if self.weighted and (root_histogram.GetSumw2N() == 0):
+			root_histogram.Sumw2()
+		sumw2 = root_histogram.GetSumw2() if root_histogram.GetSumw2N() > 0 else None
+
+		# numpy bin indices including under- and overflow correspond to the ROOT bin indices,
+		# the ROOT global bin numbering runs fastest along the x-axis
+		sum_of_weights = self.sum_of_weights.flatten(order="F")
+		sum_of_squared_weights = self.sum_of_squared_weights.flatten(order="F")
+		for global_bin in numpy.nonzero(sum_of_weights)[0]:
+			global_bin = int(global_bin)
+			root_histogram.SetBinContent(global_bin, root_histogram.GetBinContent(global_bin) + sum_of_weights[global_bin])
+			if not sumw2 is None:
+				sumw2.SetAt(sumw2.At(global_bin) + sum_of_squared_weights[global_bin], global_bin)
+
+		root_histogram.PutStats(previous_statistics + self.statistics)
+		root_histogram.SetEntries(previous_entries + self.n_entries)
+
+
+def _data_frames(tree):
+	"""
+	Return a list of (RDataFrame, number of entries) to be read one after another
+
+	The files of the chain are read one after another, the complete chain is read as one in case
+	it has friends.
+	"""
+	if (not tree.GetListOfFriends()) or (tree.GetListOfFriends().GetEntries() == 0):
+		return [(ROOT.ROOT.RDataFrame(chain_element.GetName(), chain_element.GetTitle()), chain_element.GetEntries()) for chain_element in tree.GetListOfFiles()]
+	else:
+		return [(ROOT.ROOT.RDataFrame(tree), tree.GetEntries())]
+
+
+def _iterate_columns(data_frames, branch_names):
+	"""
+	Yield (dict of branch name and array, number of entries) for every data frame (see _data_frames)
+
+	Every data frame is read in a single event loop.
+	"""
+	columns = ROOT.std.vector("string")()
+	for branch_name in sorted(branch_names):
+		columns.push_back(branch_name)
+
+	for data_frame, n_entries in data_frames:
+		if len(branch_names) == 0:
+			yield {}, data_frame.Count().GetValue()
+			continue
+
+		arrays = data_frame.AsNumpy(columns)
+		arrays = {branch_name : numpy.asarray(arrays[branch_name], dtype=numpy.float64) for branch_name in branch_names}
+		n_rows = len(arrays.values()[0])
+		if n_rows > 0:
+			yield arrays, n_rows
+
+
+def fill_histograms(tree, list_of_histograms_expressions, max_read_size=MAX_READ_SIZE):
+	"""
+	Fill several histograms from a tree (chain) reading the union of the referenced branches once
+
+	list_of_histograms_expressions: list of (root_histogram, variable_expression, weight_selection)
+
+	Returns a list of booleans stating which histograms have been filled. Histograms
+	with unsupported expressions or branches are not touched. No histogram is filled in case
+	the arrays of a file would take more than max_read_size bytes.
+	"""
+	if not hasattr(ROOT.ROOT, "RDataFrame"):
+		log.debug("ROOT.RDataFrame is not available, the columnar filling is not possible.")
+		return [False] * len(list_of_histograms_expressions)
+
+	fillers = []
+	for root_histogram, variable_expression, weight_selection in list_of_histograms_expressions:
+		try:
+			filler = HistogramFiller(root_histogram, variable_expression, weight_selection)
+			check_branches(tree, filler.branch_names)
+			fillers.append(filler)
+		except UnsupportedExpression, e:
+			log.debug("Columnar filling of \"%s\" with weight \"%s\" is not possible: %s" % (variable_expression, weight_selection, str(e)))
+			fillers.append(None)
+
+	active_fillers = [filler for filler in fillers if not filler is None]
+	if len(active_fillers) > 0:
+		branch_names = set().union(*[filler.branch_names for filler in active_fillers])
+		data_frames = _data_frames(tree)
+		max_entries = max([n_entries for data_frame, n_entries in data_frames] + [0])
+		if max_entries * 8 * len(branch_names) > max_read_size:
+			log.debug("Columnar filling is not possible, since reading %d entries of the branches %s at once would exceed %d bytes." % (max_entries, str(sorted(branch_names)), max_read_size))
+			return [False] * len(list_of_histograms_expressions)
+
+		log.debug("Reading branches %s for columnar filling of %d histograms ..." % (str(sorted(branch_names)), len(active_fillers)))
+		for columns, n_rows in _iterate_columns(data_frames, branch_names):
+			for filler in active_fillers:
+				filler.fill(columns, n_rows)
+		for filler in active_fillers:
+			filler.finish()
+
+	return [not filler is None for filler in fillers]
+
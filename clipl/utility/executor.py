@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pool of worker processes streaming back the results of tasks as soon as they are finished
+
+Every worker is connected to the main process by its own pipe, on which the main process waits
+(select) for results, crashed workers and timeouts. Workers are recycled after a given number of
+tasks or in case their memory usage (RSS) exceeds a limit, since e.g. PyROOT does not release all
+memory after a plot has been created. Tasks exceeding the timeout are stopped by terminating
+their worker, which does not affect the other tasks.
+
+Progress is reported to a callback function called with (event, task index, executor), where
+event is one of the *_EVENT constants below.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import collections
+import errno
+import multiprocessing
+import os
+import resource
+import select
+import signal
+import time
+import traceback
+
+
+STARTED_EVENT = "started"
+FINISHED_EVENT = "finished"
+FAILED_EVENT = "failed"
+TIMEOUT_EVENT = "timeout"
+CANCELLED_EVENT = "cancelled"
+RECYCLED_EVENT = "recycled"
+
+# functions called before worker processes are forked (see register_before_fork)
+_before_fork_functions = []
+# functions called in the worker processes after every task (see register_after_task)
+_after_task_functions = []
+
+TaskResult = collections.namedtuple("TaskResult", ["index", "result", "error"])
+
+
+def get_rss():
+	"""
+	Return the resident memory (RSS) of this process in MB
+	"""
+	try:
+		with open("/proc/self/statm") as statm_file:
+			return int(statm_file.read().split()[1]) * resource.getpagesize() / 1024.0**2
+	except (IOError, IndexError, ValueError):
+		# peak RSS in kB on Linux
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _worker_main(connection, max_tasks, max_rss, initializer):
+	# interruptions are handled by the main process, which terminates the workers
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	if not initializer is None:
+		initializer()
+
+	n_tasks = 0
+	while True:
+		try:
+			task = connection.recv()
+		except (EOFError, IOError):
+			break
+		if task is None:
+			break
+
+		index, function, arguments = task
+		try:
+			result = (index, function(arguments), None)
+		except (Exception, SystemExit):
+			result = (index, None, traceback.format_exc())
+		for after_task_function in _after_task_functions:
+			try:
+				after_task_function()
+			except Exception:
+				log.warning("Calling \"{function}\" after task {index} failed: {error}".format(function=str(after_task_function), index=index, error=traceback.format_exc()))
+
+		n_tasks += 1
+		retire = ((not max_tasks is None) and (n_tasks >= max_tasks)) or ((not max_rss is None) and (get_rss() > max_rss))
+		try:
+			connection.send(result + (retire,))
+		except Exception:
+			connection.send((index, None, traceback.format_exc(), retire))
+		if retire:
+			break
+	connection.close()
+
+
+def register_before_fork(function):
+	"""
+	Register a function to be called before worker processes are forked
+
+	Forking while other threads of the process hold locks (e.g. of the logging module) can deadlock
+	the workers. Modules starting threads register functions stopping them here.
+	"""
+	if not function in _before_fork_functions:
+		_before_fork_functions.append(function)
+
+
+def register_after_task(function):
+	"""
+	Register a function to be called in the worker processes after every task
+
+	The workers are terminated or exit without running atexit handlers. Modules buffering
+	data (e.g. accesses of cache entries) register functions writing them here.
+	"""
+	if not function in _after_task_functions:
+		_after_task_functions.append(function)
+
+
+class _Worker(object):
+	def __init__(self, max_tasks, max_rss, initializer=None):
+		for function in _before_fork_functions:
+			function()
+		self.connection, worker_connection = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=_worker_main, args=(worker_connection, max_tasks, max_rss, initializer))
+		self.process.daemon = True
+		self.process.start()
+		worker_connection.close()
+
+		# index and start time of the current task
+		self.task = None
+
+	def stop(self, terminate=False):
+		if terminate:
+			self.process.terminate()
+		else:
+			try:
+				self.connection.send(None)
+			except (IOError, OSError):
+				pass
+		self.process.join()
+		self.connection.close()
+
+
+class ProcessExecutor(object):
+	def __init__(self, n_processes, max_tasks_per_worker=None, max_rss=None, timeout=None, callback=None, initializer=None):
+		"""
+		n_processes: maximum number of worker processes
+		max_tasks_per_worker: number of tasks after which a worker is replaced by a new one (None: unlimited)
+		max_rss: memory usage (RSS) in MB after which a worker is replaced by a new one (None: unlimited)
+		timeout: maximum time in seconds per task (None: unlimited)
+		callback: function called with (event, task index, executor) for every change of the status of a task
+		initializer: function called once in every new worker process before it runs tasks
+		"""
+		self.n_processes = max(1, n_processes)
+		self.max_tasks_per_worker = max_tasks_per_worker
+		self.max_rss = max_rss
+		self.timeout = timeout
+		self.callback = callback
+		self.initializer = initializer
+
+		self._workers = []
+		self._cancelled = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.shutdown()
+
+	def cancel(self):
+		"""
+		Cancel all pending and running tasks (e.g. from within the callback)
+		"""
+		self._cancelled = True
+
+	def start_workers(self):
+		"""
+		Start all worker processes in advance, e.g. before the main process starts threads
+		"""
+		while len(self._workers) < self.n_processes:
+			self._workers.append(self._new_worker())
+
+	def _new_worker(self):
+		return _Worker(self.max_tasks_per_worker, self.max_rss, initializer=self.initializer)
+
+	def shutdown(self):
+		for worker in self._workers:
+			worker.stop(terminate=(not worker.task is None))
+		self._workers = []
+
+	def _notify(self, event, index):
+		if not self.callback is None:
+			self.callback(event, index, self)
+
+	def _remove_worker(self, worker, terminate=False):
+		self._workers.remove(worker)
+		worker.stop(terminate=terminate)
+
+	def imap_unordered(self, function, arguments_list):
+		"""
+		Execute function(arguments) for all arguments and yield a TaskResult for every task as soon as it is
+		finished. The error is None for successful tasks or otherwise a description (e.g. the traceback).
+		"""
+		pending_tasks = collections.deque(enumerate(arguments_list))
+		n_processes = min(self.n_processes, len(pending_tasks))
+		self._cancelled = False
+
+		try:
+			while (len(pending_tasks) > 0) or any([not worker.task is None for worker in self._workers]):
+				if self._cancelled:
+					for index, arguments in pending_tasks:
+						self._notify(CANCELLED_EVENT, index)
+						yield TaskResult(index, None, "cancelled")
+					pending_tasks.clear()
+					for worker in [worker for worker in self._workers if not worker.task is None]:
+						index = worker.task[0]
+						self._remove_worker(worker, terminate=True)
+						self._notify(CANCELLED_EVENT, index)
+						yield TaskResult(index, None, "cancelled")
+					break
+
+				# submit tasks to idle workers
+				while len(pending_tasks) > 0:
+					idle_workers = [worker for worker in self._workers if worker.task is None]
+					if (len(idle_workers) == 0) and (len(self._workers) < n_processes):
+						self._workers.append(self._new_worker())
+						continue
+					elif len(idle_workers) == 0:
+						break
+
+					index, arguments = pending_tasks.popleft()
+					try:
+						idle_workers[0].connection.send((index, function, arguments))
+					except Exception:
+						self._notify(FAILED_EVENT, index)
+						yield TaskResult(index, None, traceback.format_exc())
+						continue
+					idle_workers[0].task = (index, time.time())
+					self._notify(STARTED_EVENT, index)
+
+				running_workers = [worker for worker in self._workers if not worker.task is None]
+				if len(running_workers) == 0:
+					continue
+
+				# wait for results or the next timeout
+				wait_time = None
+				if not self.timeout is None:
+					wait_time = max(0.0, min([worker.task[1] for worker in running_workers]) + self.timeout - time.time())
+				try:
+					ready_connections = select.select([worker.connection for worker in running_workers], [], [], wait_time)[0]
+				except select.error, e:
+					if e.args[0] == errno.EINTR:
+						continue
+					raise
+
+				for worker in running_workers:
+					index = worker.task[0]
+					if worker.connection in ready_connections:
+						try:
+							result_index, result, error, retire = worker.connection.recv()
+						except (EOFError, IOError):
+							self._remove_worker(worker, terminate=True)
+							self._notify(FAILED_EVENT, index)
+							yield TaskResult(index, None, "Worker process {pid} died (exit code {exit_code}).".format(pid=worker.process.pid, exit_code=worker.process.exitcode))
+							continue
+
+						worker.task = None
+						if retire:
+							self._remove_worker(worker)
+							self._notify(RECYCLED_EVENT, index)
+						self._notify(FINISHED_EVENT if error is None else FAILED_EVENT, index)
+						yield TaskResult(index, result, error)
+
+					elif (not self.timeout is None) and (time.time() - worker.task[1] > self.timeout):
+						self._remove_worker(worker, terminate=True)
+						self._notify(TIMEOUT_EVENT, index)
+						yield TaskResult(index, None, "Timeout after {timeout} s.".format(timeout=self.timeout))
+		finally:
+			# workers of tasks that are not waited for anymore (e.g. interruptions) are terminated
+			for worker in [worker for worker in self._workers if not worker.task is None]:
+				self._remove_worker(worker, terminate=True)
+
+	def map(self, function, arguments_list):
+		"""
+		Execute function(arguments) for all arguments and return the list of TaskResults in the order of the arguments
+		"""
+		task_results = [None] * len(arguments_list)
+		for task_result in self.imap_unordered(function, arguments_list):
+			task_results[task_result.index] = task_result
+		return task_results
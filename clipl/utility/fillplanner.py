@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Planning of the inputs of multiple plots read from trees
+
+The inputs of all plots are collected before the plots are created and deduplicated by their
+cache files (see rootcache.RootFileCache), such that inputs shared by several plots are filled
+only once, in parallel and without several processes racing to create the same caches. The
+plots are created afterwards and take their inputs from the caches.
+
+Only inputs with binnings known beforehand can be planned. Inputs with binnings determined
+automatically depend on the previous inputs of the same plot and are read during the plotting.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import collections
+import os
+
+import ROOT
+
+import clipl.utility.roottools as roottools
+
+
+class FillPlanner(object):
+	def __init__(self):
+		# cache file -> kwargs of RootTools.histogram_from_tree
+		self.tasks = collections.OrderedDict()
+		self.n_plots = 0
+		self.n_inputs = 0
+		self.n_cached = 0
+		self.n_planned = 0
+
+	def add(self, list_of_kwargs):
+		"""
+		Add the inputs (kwargs of RootTools.histogram_from_tree) of a single plot
+		"""
+		self.n_plots += 1
+		# binnings are registered per plot
+		root_tools = roottools.RootTools()
+		for kwargs in list_of_kwargs:
+			self.n_inputs += 1
+			if kwargs.get("redo_cache", False):
+				continue
+
+			tree_draw_kwargs, binning_identifier = root_tools.prepare_histogram_from_tree(**kwargs)
+			if not isinstance(tree_draw_kwargs["root_histogram"], ROOT.TH1):
+				continue
+
+			cache_file = roottools.RootTools.tree_draw_cache.get_cache_file(**tree_draw_kwargs)
+			if cache_file is None:
+				continue
+			elif os.path.exists(cache_file):
+				self.n_cached += 1
+				continue
+
+			self.n_planned += 1
+			self.tasks.setdefault(cache_file, kwargs)
+
+	def get_statistics_string(self):
+		return "Planned {n_tasks} fills for {n_planned} inputs of {n_plots} plots ({n_saved} fills saved, {n_cached} inputs already cached, {n_unplanned} inputs read during plotting).".format(
+				n_tasks=len(self.tasks),
+				n_planned=self.n_planned,
+				n_plots=self.n_plots,
+				n_saved=self.n_planned-len(self.tasks),
+				n_cached=self.n_cached,
+				n_unplanned=self.n_inputs-self.n_planned-self.n_cached
+		)
+
+	def run(self, n_processes=1, batched=True):
+		"""
+		Fill the histograms of all tasks into the caches
+
+		The results are also kept in memory, such that plots created in processes forked
+		afterwards do not need to read the cache files.
+		"""
+		if len(self.tasks) == 0:
+			return
+
+		results = roottools.RootTools().histograms_from_trees(self.tasks.values(), batched=batched, n_processes=n_processes)
+		for cache_file, (tree, root_histogram, tmp_files) in zip(self.tasks.keys(), results):
+			roottools.RootTools.tree_draw_cache.keep_in_memory(cache_file, root_histogram)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""
+Packing of plots into batch jobs of roughly equal wall time
+
+The cost of a plot is estimated from the time recorded for the same inputs (files and folders)
+in previous runs. Plots with unknown inputs are estimated from the numbers of entries of their
+input trees (taken from the metadata index) or otherwise from the sizes of their input files,
+using a linear model fitted to all recorded timings. The timings are stored in an SQLite
+database next to the metadata index.
+
+Plots sharing input files are kept in the same job, such that the files are read (and cached)
+only once per job. The groups of plots are distributed to the jobs following the
+longest-processing-time-first (LPT) rule.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import glob
+import hashlib
+import heapq
+import json
+import math
+import os
+import sqlite3
+import time
+
+import clipl.utility.rootfileindex as rootfileindex
+
+
+# cost model in case no (or too few) timings are recorded
+DEFAULT_TIME_PER_PLOT = 10.0 # s
+DEFAULT_TIME_PER_ENTRY = 2e-6 # s
+# entries assumed for files that are not indexed
+DEFAULT_BYTES_PER_ENTRY = 100.0
+
+
+def _as_list(value):
+	if value is None:
+		return [None]
+	if isinstance(value, basestring):
+		return [value]
+	return list(value) or [None]
+
+
+def plot_inputs(plotdict):
+	"""
+	Return the set of (file, folder) pairs read by a plot
+
+	plotdict: arguments of a plot either as given (e.g. exported JSON configs) or as prepared by the input modules
+	"""
+	files = _as_list(plotdict.get("files", None))
+	directories = _as_list(plotdict.get("directories", None))
+	folders = _as_list(plotdict.get("folders", None))
+
+	inputs = set()
+	for index in xrange(max(len(files), len(directories), len(folders))):
+		file_args = files[index % len(files)]
+		directory_args = directories[index % len(directories)]
+		folder_args = folders[index % len(folders)]
+		if file_args is None:
+			continue
+
+		# the input modules replace the file arguments by lists of the globbed files
+		if not isinstance(file_args, basestring):
+			paths = file_args
+		elif "://" in file_args:
+			paths = [file_args]
+		else:
+			paths = []
+			for file_arg in file_args.split():
+				for directory in directory_args.split() if directory_args else [None]:
+					paths.extend(glob.glob(os.path.expandvars(os.path.join(directory, file_arg) if directory else file_arg)))
+
+		folder_list = folder_args.split() if isinstance(folder_args, basestring) else (folder_args or [""])
+		for path in paths:
+			path = path if "://" in path else os.path.realpath(path)
+			for folder in folder_list:
+				inputs.add((path, (folder or "").strip("/")))
+	return inputs
+
+
+def input_signature(inputs):
+	return hashlib.md5(json.dumps(sorted(inputs))).hexdigest()
+
+
+def count_entries(inputs, index_dir=None, scan=True):
+	"""
+	Return the number of entries to be read for the given (file, folder) pairs
+
+	scan: index files, which are not indexed yet. Otherwise, their entries are estimated from the file sizes.
+	"""
+	n_entries = 0.0
+	for path, folder in inputs:
+		tree = None
+		if "://" in path:
+			continue
+		if folder:
+			metadata = rootfileindex.get_metadata(path, index_dir=index_dir, scan=scan)
+			tree = None if metadata is None else metadata.tree(folder, read=scan)
+		if not tree is None:
+			n_entries += tree["entries"]
+		elif os.path.exists(path):
+			n_entries += os.path.getsize(path) / DEFAULT_BYTES_PER_ENTRY
+	return n_entries
+
+
+class PlotCostModel(object):
+	def __init__(self, index_dir=None, index_name="plot_timings.sqlite", timeout=60.0):
+		"""
+		index_dir: directory of the recorded timings. If None, nothing is recorded and the default cost model is used.
+		"""
+		self.index_dir = index_dir
+		self.index_file = None
+		self.timeout = timeout
+
+		if index_dir:
+			try:
+				if not os.path.exists(index_dir):
+					os.makedirs(index_dir)
+			except OSError:
+				pass
+			self.index_file = os.path.join(index_dir, index_name)
+			try:
+				with self._connect() as connection:
+					connection.execute("CREATE TABLE IF NOT EXISTS timings (signature TEXT PRIMARY KEY, seconds REAL, entries REAL, time REAL)")
+			except sqlite3.Error, e:
+				log.warning("Unable to open the plot timings \"{index_file}\": {error}".format(index_file=self.index_file, error=e))
+				self.index_file = None
+
+		self._recorded_times = None
+		self._parameters = None
+
+	def _connect(self):
+		# the connection is used as context manager committing (or rolling back) the transaction
+		return sqlite3.connect(self.index_file, timeout=self.timeout)
+
+	def _load(self):
+		if self._recorded_times is None:
+			self._recorded_times = {}
+			if self.index_file:
+				try:
+					with self._connect() as connection:
+						for signature, seconds, entries in connection.execute("SELECT signature, seconds, entries FROM timings"):
+							self._recorded_times[signature] = (seconds, entries)
+				except sqlite3.Error, e:
+					log.debug("Unable to read the plot timings \"{index_file}\": {error}".format(index_file=self.index_file, error=e))
+		return self._recorded_times
+
+	def record(self, plotdict, seconds):
+		"""
+		Record the time needed for a plot
+
+		Input files are not opened for this, files not yet indexed are estimated from their sizes.
+		"""
+		if not self.index_file:
+			return
+		inputs = plot_inputs(plotdict)
+		if len(inputs) == 0:
+			return
+		try:
+			n_entries = count_entries(inputs, index_dir=self.index_dir, scan=False)
+			with self._connect() as connection:
+				connection.execute("INSERT OR REPLACE INTO timings VALUES (?, ?, ?, ?)", (input_signature(inputs), seconds, n_entries, time.time()))
+		except sqlite3.Error, e:
+			log.debug("Unable to record the plot timing in \"{index_file}\": {error}".format(index_file=self.index_file, error=e))
+		self._recorded_times = None
+		self._parameters = None
+
+	def parameters(self):
+		"""
+		Return (time per plot, time per entry) fitted to the recorded timings (least squares)
+		"""
+		if self._parameters is None:
+			self._parameters = (DEFAULT_TIME_PER_PLOT, DEFAULT_TIME_PER_ENTRY)
+			timings = [(entries, seconds) for seconds, entries in self._load().values() if entries > 0.0]
+			n_timings = float(len(timings))
+			sum_x = sum([x for x, y in timings])
+			sum_y = sum([y for x, y in timings])
+			sum_xx = sum([x*x for x, y in timings])
+			sum_xy = sum([x*y for x, y in timings])
+			denominator = n_timings * sum_xx - sum_x * sum_x
+			if (n_timings >= 2) and (denominator > 0.0):
+				time_per_entry = (n_timings * sum_xy - sum_x * sum_y) / denominator
+				time_per_plot = (sum_y - time_per_entry * sum_x) / n_timings
+				if time_per_entry > 0.0:
+					self._parameters = (max(0.0, time_per_plot), time_per_entry)
+		return self._parameters
+
+	def estimate(self, plotdict):
+		"""
+		Return the estimated time in seconds needed for a plot
+		"""
+		inputs = plot_inputs(plotdict)
+		recorded_time = self._load().get(input_signature(inputs), None)
+		if not recorded_time is None:
+			return recorded_time[0]
+		time_per_plot, time_per_entry = self.parameters()
+		return time_per_plot + time_per_entry * count_entries(inputs, index_dir=self.index_dir)
+
+
+_plot_cost_models = {}
+
+def get_plot_cost_model(index_dir=None):
+	"""
+	Return the cost model of this process for the given directory (None: default cost model only)
+	"""
+	key = (os.getpid(), os.path.abspath(index_dir) if index_dir else None)
+	if not key in _plot_cost_models:
+		_plot_cost_models[key] = PlotCostModel(key[1])
+	return _plot_cost_models[key]
+
+
+def pack(costs, list_of_inputs, job_time):
+	"""
+	Pack plots into jobs of roughly equal wall time
+
+	costs: estimated time per plot
+	list_of_inputs: sets of (file, folder) pairs per plot (see plot_inputs)
+	job_time: targeted wall time per job
+
+	Returns a list of jobs, each being a list of plot indices.
+	"""
+	# group plots sharing input files (union-find)
+	parents = range(len(costs))
+	def find(index):
+		while parents[index] != index:
+			parents[index] = parents[parents[index]]
+			index = parents[index]
+		return index
+
+	plots_per_file = {}
+	for plot_index, inputs in enumerate(list_of_inputs):
+		for path, folder in inputs:
+			if path in plots_per_file:
+				parents[find(plot_index)] = find(plots_per_file[path])
+			else:
+				plots_per_file[path] = plot_index
+
+	groups = {}
+	for plot_index in xrange(len(costs)):
+		groups.setdefault(find(plot_index), []).append(plot_index)
+
+	# groups exceeding the job time are split into consecutive chunks
+	items = []
+	for group in groups.values():
+		chunk = []
+		for plot_index in group:
+			if (len(chunk) > 0) and (sum([costs[index] for index in chunk]) + costs[plot_index] > job_time):
+				items.append(chunk)
+				chunk = []
+			chunk.append(plot_index)
+		items.append(chunk)
+	items = sorted([(sum([costs[index] for index in item]), item) for item in items], key=lambda item: item[0], reverse=True)
+
+	# longest processing time first: every item goes to the job with the smallest load
+	n_jobs = max(1, min(len(items), int(math.ceil(sum(costs) / float(job_time)))))
+	jobs = [[] for job_index in xrange(n_jobs)]
+	loads = [(0.0, job_index) for job_index in xrange(n_jobs)]
+	for cost, item in items:
+		load, job_index = heapq.heappop(loads)
+		jobs[job_index].extend(item)
+		heapq.heappush(loads, (load + cost, job_index))
+
+	return [sorted(job) for job in jobs if len(job) > 0]
+
@@ -13,13 +13,20 @@ import pprint
 import sys
 import tempfile
 
-import ROOT
-ROOT.gROOT.SetBatch(True)
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-ROOT.gErrorIgnoreLevel = ROOT.kError
-
 import clipl.utility.tools as tools
 import clipl.utility.dcachetools as dcachetools
+import clipl.utility.staging as staging
+
+
+# parsed JSON files and resolved configs (see JsonDict.readJsonDict and JsonDict.resolve)
+_parsed_files = {}
+_resolved_configs = {}
+# files read during the resolutions currently running, mapped to their states
+_read_files_stack = []
+
+def _file_state(fileName):
+	stat = os.stat(fileName)
+	return (stat.st_mtime, stat.st_size)
 
 
 class JsonDict(dict):
@@ -123,6 +130,35 @@ class JsonDict(dict):
 		""" resolves the includes and returns a new object """
 		return JsonDict(JsonDict.deepinclude(self))
 
+	@staticmethod
+	def resolve(jsonDicts):
+		"""
+		returns JsonDict(jsonDicts).doIncludes().doComments() as a new object
+		results for (lists of) file names and JSON strings are memoized as long as none of the files
+		read for them (including the included ones) has been modified
+		"""
+		try:
+			items = jsonDicts if isinstance(jsonDicts, list) else [jsonDicts]
+			key = (tuple([os.path.expandvars(item) for item in items]), os.getcwd(), JsonDict.COMMENT_DELIMITER)
+			hash(key)
+		except (AttributeError, TypeError):
+			# dicts are not memoized
+			return JsonDict(jsonDicts).doIncludes().doComments()
+
+		if key in _resolved_configs:
+			readFiles, resolvedConfig = _resolved_configs[key]
+			if all([os.path.exists(fileName) and (_file_state(fileName) == fileState) for fileName, fileState in readFiles.iteritems()]):
+				return copy.deepcopy(resolvedConfig)
+
+		readFiles = {}
+		_read_files_stack.append(readFiles)
+		try:
+			resolvedConfig = JsonDict(jsonDicts).doIncludes().doComments()
+		finally:
+			_read_files_stack.pop()
+		_resolved_configs[key] = (readFiles, copy.deepcopy(resolvedConfig))
+		return resolvedConfig
+
 	def doNicks(self, nick="default"):
 		""" resolves the nicks and returns a new object """
 		return JsonDict(JsonDict.deepresolvenicks(self, nick))
@@ -173,9 +209,21 @@ class JsonDict(dict):
 			log.critical("File \"%s\" does not exist!" % fileName)
 			sys.exit(1)
 
+		# files are only parsed again after they have been modified
+		fileState = _file_state(fileName)
+		for readFiles in _read_files_stack:
+			readFiles[fileName] = fileState
+		key = (os.path.abspath(fileName), JsonDict.COMMENT_DELIMITER)
+		if (key in _parsed_files) and (_parsed_files[key][0] == fileState):
+			return copy.deepcopy(_parsed_files[key][1])
+
 		jsonStrings = []
 		# read all cycles of JsonDict.PATH_TO_ROOT_CONFIG from ROOT file and merge them
 		if os.path.splitext(fileName)[1] == ".root":
+			import ROOT
+			ROOT.gROOT.SetBatch(True)
+			ROOT.PyConfig.IgnoreCommandLineOptions = True
+			ROOT.gErrorIgnoreLevel = ROOT.kError
 			rootFile = ROOT.TFile(fileName, "READ")
 			listOfKeys = rootFile.GetListOfKeys()
 			for keyIndex in range(listOfKeys.GetSize()):
@@ -198,6 +246,7 @@ class JsonDict(dict):
 			log.critical("Invalid JSON syntax in file \"%s\"." % fileName)
 			log.critical(str(e))
 			sys.exit(1)
+		_parsed_files[key] = (fileState, copy.deepcopy(jsonDict))
 		return jsonDict
 
 	@staticmethod
@@ -379,37 +428,18 @@ class JsonDict(dict):
 	@staticmethod
 	def deepreplaceremotefiles(jsonDict, tmp_directory, remote_identifiers=None):
 		""" download remote files in dictionary values first and point to this copies in the dictionary """
-		remote_identifiers = ["dcap", "root", "srm"]
-		
+		# the files are downloaded concurrently, see staging.StagingPool
 		if not os.path.exists(tmp_directory):
 			os.makedirs(tmp_directory)
 		
-		result = None
-		if isinstance(jsonDict, dict):
-			result = JsonDict()
-			for key, value in jsonDict.items():
-				result[key] = JsonDict.deepreplaceremotefiles(value, tmp_directory, remote_identifiers)
-		elif isinstance(jsonDict, collections.Iterable) and not isinstance(jsonDict, basestring):
-			result = []
-			for item in jsonDict:
-				result.append(JsonDict.deepreplaceremotefiles(item, tmp_directory, remote_identifiers))
-		elif isinstance(jsonDict, basestring):
-			if any([jsonDict.strip().rstrip().startswith(remote_identifier) for remote_identifier in remote_identifiers]):
-				result = os.path.join(tmp_directory, jsonDict.strip().rstrip().replace(":", "_").replace("/", "__")[-200:])
-				if not os.path.exists(result):
-					exit_code = tools.download_remote_file(remote=dcachetools.xrd2srm(jsonDict), local=result)
-					if exit_code is None: # gfal-stat failed
-						result = jsonDict
-						log.critical("Could not download \""+jsonDict+"\"!")
-						sys.exit(1)
-					elif exit_code == False: # gfal-copy failed  (after gfal-stat success)
-						result = jsonDict
-						log.warning("Could not download \""+jsonDict+"\"!")
-						#sys.exit(1)
-			else:
-				result = jsonDict
-		else:
-			result = jsonDict
+		staging_pool = staging.get_staging_pool(tmp_directory)
+		result = staging_pool.replace_json(jsonDict)
+		
+		unavailable_files = [path for path in staging.remote_paths(jsonDict) if path in staging_pool.unavailable]
+		if len(unavailable_files) > 0: # gfal-stat failed
+			for path in unavailable_files:
+				log.critical("Could not download \""+path+"\"!")
+			sys.exit(1)
 		return result
 
 def print_comments_from_json_files(json_dir, comment_key):
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tracking of the memory usage and of the ROOT objects created while making a plot
+
+ROOT registers histograms, trees, canvases and functions in global lists (gROOT, gDirectory
+and the open files). Objects in these lists stay alive after a plot has been saved, since
+objects returned by e.g. ROOT.gDirectory.Get are not owned by Python. A tracker records the
+contents of these lists and the resident memory (RSS) before a plot and reports their growth
+afterwards. The objects owned by the plot (the inputs and results in the plot data and the
+canvases) are then handed over to Python, such that they are deleted as soon as they are not
+referenced anymore. Objects in the global lists may still be referenced by other ROOT
+structures (e.g. chains or open files) and are therefore only reported.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import gc
+
+import ROOT
+
+import clipl.utility.executor as executor
+
+
+def _address(root_object):
+	return ROOT.AddressOf(root_object)[0]
+
+
+def root_lists():
+	"""
+	Return a dict of the global ROOT lists keeping objects alive
+	"""
+	lists = {
+		"gROOT" : ROOT.gROOT.GetList(),
+		"canvases" : ROOT.gROOT.GetListOfCanvases(),
+		"functions" : ROOT.gROOT.GetListOfFunctions(),
+		"files" : ROOT.gROOT.GetListOfFiles(),
+		"specials" : ROOT.gROOT.GetListOfSpecials(),
+	}
+	if ROOT.gDirectory and (ROOT.gDirectory.GetPath() != ROOT.gROOT.GetPath()):
+		lists["gDirectory"] = ROOT.gDirectory.GetList()
+	for root_file in ROOT.gROOT.GetListOfFiles():
+		lists["file " + root_file.GetName()] = root_file.GetList()
+	return lists
+
+
+class RootObjectTracker(object):
+	def __init__(self):
+		"""
+		Record the RSS and the objects in the global ROOT lists
+		"""
+		self.rss = executor.get_rss()
+		self.objects = dict([(name, set([_address(root_object) for root_object in root_list])) for name, root_list in root_lists().iteritems()])
+
+	def get_statistics_string(self):
+		n_objects = dict([(name, root_list.GetSize()) for name, root_list in root_lists().iteritems()])
+		rss = executor.get_rss()
+		return "RSS: {rss:.1f} MB ({rss_difference:+.1f} MB), ROOT objects: {n_objects}".format(
+				rss=rss,
+				rss_difference=rss - self.rss,
+				n_objects=", ".join(["{name} {n:d} ({difference:+d})".format(name=name, n=n, difference=n - len(self.objects.get(name, set()))) for name, n in sorted(n_objects.iteritems()) if (n > 0) or (name in self.objects and len(self.objects[name]) > 0)])
+		)
+
+	def cleanup(self, plot_data):
+		"""
+		Hand the ROOT objects owned by a plot over to Python and drop the references of the plot data to them
+
+		See plot_objects for the released objects. Objects still referenced elsewhere in Python survive
+		until these references are dropped. Returns the number of released objects.
+		"""
+		released_objects = [] if plot_data is None else plot_objects(plot_data)
+		for root_object in released_objects:
+			if isinstance(root_object, ROOT.TH1):
+				root_object.SetDirectory(0)
+			ROOT.SetOwnership(root_object, True)
+		n_released = len(released_objects)
+
+		# the objects are deleted together with the last references to them
+		del released_objects
+		if not plot_data is None:
+			plot_data.plotdict.pop("root_objects", None)
+			plot_data.plotdict.pop("root_trees", None)
+			plot_data.plot = None
+		gc.collect()
+		return n_released
+
+
+def plot_objects(plot_data):
+	"""
+	Return the ROOT objects owned by a plot: the histograms, graphs and trees in the plot data and the canvas
+
+	Other objects (e.g. functions) may belong to other objects (e.g. the list of functions of a histogram)
+	and pads belong to their canvases. Trees in files belong to their files. These objects are excluded.
+	"""
+	candidates = []
+	for key in ["root_objects", "root_trees"]:
+		for root_objects in (plot_data.plotdict.get(key, None) or {}).values():
+			candidates.extend(root_objects if isinstance(root_objects, (list, tuple)) else [root_objects])
+	candidates.append(getattr(plot_data.plot, "canvas", None))
+
+	released_objects = []
+	for root_object in candidates:
+		if (root_object is None) or (not any([isinstance(root_object, root_type) for root_type in [ROOT.TH1, ROOT.TGraph, ROOT.TGraph2D, ROOT.TTree, ROOT.TCanvas]])) or (not root_object):
+			continue
+		# trees in files are deleted by their files, only chains and trees in memory are released
+		if isinstance(root_object, ROOT.TTree) and (not isinstance(root_object, ROOT.TChain)) and root_object.GetDirectory():
+			continue
+		if not any([released_object is root_object for released_object in released_objects]):
+			released_objects.append(root_object)
+	return released_objects
+
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in recording of the wall and CPU times of the processing steps of plots
+
+Steps are recorded with the profile context manager or the profiled decorator, which do nothing
+unless profiling has been enabled in this process (harry.py --profile). Every step results in an
+event containing its start time, wall time, CPU time (user and system) and the time spent in
+the step itself excluding nested steps (self time).
+
+The events of all processes (e.g. the workers of a HarryPlotter) are collected in the main
+process (pop_profile/merge) and written to a JSON file with a summary per step and as a trace
+in the Chrome trace event format, which can be viewed in chrome://tracing or Perfetto.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import functools
+import json
+import os
+import threading
+import time
+
+
+_enabled = False
+_output_file = None
+_events = []
+_state = threading.local()
+
+
+def _cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+
+def enable(output_file):
+	global _enabled, _output_file
+	_enabled = True
+	_output_file = output_file
+
+
+def disable():
+	global _enabled
+	_enabled = False
+
+
+def is_enabled():
+	return _enabled
+
+
+class profile(object):
+	"""
+	Context manager recording the time spent in a step
+
+	name: name of the step (e.g. the name of a processor)
+	category: kind of step (e.g. "processor", "input", "cache" or "save")
+	args: further information stored with the event
+	"""
+	def __init__(self, name, category, **args):
+		self.name = name
+		self.category = category
+		self.args = args
+		self._start = None
+
+	def __enter__(self):
+		if _enabled:
+			if not hasattr(_state, "stack"):
+				_state.stack = []
+			# [start wall time, start CPU time, wall time of nested steps]
+			self._start = [time.time(), _cpu_time(), 0.0]
+			_state.stack.append(self._start)
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		if self._start is None:
+			return False
+		wall_time = time.time() - self._start[0]
+		cpu_time = _cpu_time() - self._start[1]
+		_state.stack.pop()
+		if len(_state.stack) > 0:
+			_state.stack[-1][2] += wall_time
+
+		_events.append({
+			"name" : self.name,
+			"category" : self.category,
+			"start" : self._start[0],
+			"wall_time" : wall_time,
+			"cpu_time" : cpu_time,
+			"self_time" : wall_time - self._start[2],
+			"pid" : os.getpid(),
+			"tid" : threading.current_thread().ident,
+			"failed" : not exc_type is None,
+			"args" : self.args,
+		})
+		self._start = None
+		return False
+
+
+def profiled(name=None, category="function"):
+	"""
+	Decorator recording the time spent in a function (see profile)
+	"""
+	def decorator(function):
+		step_name = name or function.__name__
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not _enabled:
+				return function(*args, **kwargs)
+			with profile(step_name, category):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def pop_profile():
+	"""
+	Return the output file and the events recorded in this process so far (None if there are none) and forget the events
+	"""
+	global _events
+	if len(_events) == 0:
+		return None
+	result = {"output_file" : _output_file, "events" : _events}
+	_events = []
+	return result
+
+
+def merge(recorded_profile):
+	"""
+	Add the events recorded in another process (see pop_profile)
+	"""
+	global _output_file
+	if recorded_profile is None:
+		return
+	if _output_file is None:
+		_output_file = recorded_profile["output_file"]
+	_events.extend(recorded_profile["events"])
+
+
+def summary(events):
+	"""
+	Return a list of dicts with the number of calls and the total wall, CPU and self times per step (sorted by self time)
+	"""
+	steps = {}
+	for event in events:
+		step = steps.setdefault((event["category"], event["name"]), {
+				"category" : event["category"], "name" : event["name"],
+				"calls" : 0, "wall_time" : 0.0, "cpu_time" : 0.0, "self_time" : 0.0,
+		})
+		step["calls"] += 1
+		for key in ["wall_time", "cpu_time", "self_time"]:
+			step[key] += event[key]
+	return sorted(steps.values(), key=lambda step: step["self_time"], reverse=True)
+
+
+def get_summary_string(events, n_steps=20):
+	lines = ["{:<12s} {:<40s} {:>7s} {:>10s} {:>10s} {:>10s}".format("Category", "Step", "Calls", "Wall [s]", "CPU [s]", "Self [s]")]
+	for step in summary(events)[:n_steps]:
+		lines.append("{category:<12s} {name:<40s} {calls:>7d} {wall_time:>10.3f} {cpu_time:>10.3f} {self_time:>10.3f}".format(**step))
+	return "\n".join(lines)
+
+
+def chrome_trace(events):
+	"""
+	Convert events into the Chrome trace event format (complete events with times in microseconds)
+	"""
+	trace_events = [{
+			"name" : "process_name", "ph" : "M", "pid" : pid,
+			"args" : {"name" : "harry ({pid})".format(pid=pid)},
+	} for pid in sorted(set([event["pid"] for event in events]))]
+	for event in events:
+		args = dict(event["args"])
+		args.update({"cpu_time_ms" : event["cpu_time"] * 1e3, "self_time_ms" : event["self_time"] * 1e3})
+		if event["failed"]:
+			args["failed"] = True
+		trace_events.append({
+				"name" : event["name"],
+				"cat" : event["category"],
+				"ph" : "X",
+				"ts" : event["start"] * 1e6,
+				"dur" : event["wall_time"] * 1e6,
+				"pid" : event["pid"],
+				"tid" : event["tid"],
+				"args" : args,
+		})
+	return {"traceEvents" : trace_events, "displayTimeUnit" : "ms"}
+
+
+def save(output_file=None):
+	"""
+	Write the recorded events to a JSON file and the Chrome trace to <output file>.trace.json and forget the events
+
+	Returns the names of the written files.
+	"""
+	global _events
+	output_file = output_file or _output_file
+	if (output_file is None) or (len(_events) == 0):
+		return []
+	output_file = os.path.expandvars(output_file)
+	trace_file = os.path.splitext(output_file)[0] + ".trace.json"
+
+	output_dir = os.path.dirname(output_file)
+	if output_dir and (not os.path.exists(output_dir)):
+		os.makedirs(output_dir)
+	with open(output_file, "w") as profile_file:
+		json.dump({"summary" : summary(_events), "events" : _events}, profile_file, indent=1, sort_keys=True)
+	with open(trace_file, "w") as profile_file:
+		json.dump(chrome_trace(_events), profile_file)
+
+	log.info("Profile of {n_events:d} steps:\n{summary}".format(n_events=len(_events), summary=get_summary_string(_events)))
+	log.info("Created profile \"{output_file}\" and trace \"{trace_file}\".".format(output_file=output_file, trace_file=trace_file))
+	_events = []
+	return [output_file, trace_file]
+
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rebinning of histograms to variable bin widths using NumPy
+
+The bin contents and the sums of squared weights (including under- and overflow) are read
+as arrays. Every source bin is assigned to the target bin containing its centre, which is
+the same assignment as done by THnSparse::RebinnedAdd. The mapping is determined once per
+pair of binnings and the contents are summed up per axis via numpy.add.reduceat.
+
+Profiles and histograms with other storage types are not handled here. The callers are
+expected to fall back to THnSparse in this case.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import array
+import numpy
+
+import ROOT
+
+
+# ROOT array base classes of the histogram classes and the corresponding NumPy types
+ARRAY_TYPES = [
+	(ROOT.TArrayD, numpy.float64),
+	(ROOT.TArrayF, numpy.float32),
+	(ROOT.TArrayI, numpy.int32),
+	(ROOT.TArrayS, numpy.int16),
+	(ROOT.TArrayC, numpy.int8),
+]
+
+_bin_mappings = {}
+
+
+def _array_type(root_histogram):
+	for root_array_type, numpy_type in ARRAY_TYPES:
+		if isinstance(root_histogram, root_array_type):
+			return numpy_type
+	return None
+
+
+def supported(root_histogram):
+	return (isinstance(root_histogram, ROOT.TH1) and
+	        (not isinstance(root_histogram, (ROOT.TProfile, ROOT.TProfile2D, ROOT.TProfile3D))) and
+	        (root_histogram.GetDimension() <= 3) and
+	        (not _array_type(root_histogram) is None))
+
+
+def _array_view(root_buffer, size, dtype):
+	"""
+	Writable NumPy view on the C array of a ROOT histogram (or ROOT.TArrayD)
+	"""
+	if hasattr(root_buffer, "SetSize"):
+		root_buffer.SetSize(size)
+	return numpy.frombuffer(root_buffer, dtype=dtype, count=size)
+
+
+def bin_mapping(source_bin_edges, target_bin_edges):
+	"""
+	Determine the assignment of source to target bins (including under- and overflow)
+
+	Returns (indices, target_bins), where indices are the positions in the source bins at which the
+	sums for the target bins listed in target_bins start (see numpy.add.reduceat). Target bins not
+	listed do not get any contributions. The mappings are cached per pair of binnings.
+	"""
+	key = (tuple(source_bin_edges), tuple(target_bin_edges))
+	if not key in _bin_mappings:
+		source_bin_edges = numpy.asarray(source_bin_edges, dtype=numpy.float64)
+		target_bin_edges = numpy.asarray(target_bin_edges, dtype=numpy.float64)
+
+		# underflow, bin centres and overflow of the source binning
+		source_bin_centers = numpy.concatenate(([-numpy.inf], 0.5 * (source_bin_edges[:-1] + source_bin_edges[1:]), [numpy.inf]))
+		# bins are closed at their lower edges, 0 is the underflow and len(target_bin_edges) the overflow bin
+		assigned_target_bins = numpy.searchsorted(target_bin_edges, source_bin_centers, side="right")
+
+		# bin centres are monotonic, therefore all source bins of a target bin are neighbours
+		indices = numpy.concatenate(([0], numpy.nonzero(numpy.diff(assigned_target_bins))[0] + 1))
+		_bin_mappings[key] = (indices, assigned_target_bins[indices])
+	return _bin_mappings[key]
+
+
+def rebinning_possible(source_bin_edges, target_bin_edges):
+	"""
+	Check whether all target bin edges are also source bin edges (no splitting of bins)
+	"""
+	if len(target_bin_edges) > len(source_bin_edges):
+		return False
+	source_bin_edges = numpy.asarray(source_bin_edges, dtype=numpy.float64)
+	target_bin_edges = numpy.asarray(target_bin_edges, dtype=numpy.float64)
+	positions = numpy.clip(numpy.searchsorted(source_bin_edges, target_bin_edges), 0, len(source_bin_edges)-1)
+	closest = numpy.minimum(
+			numpy.abs(source_bin_edges[positions] - target_bin_edges),
+			numpy.abs(source_bin_edges[numpy.maximum(positions-1, 0)] - target_bin_edges)
+	)
+	return bool(numpy.all(closest <= 1e-9 * numpy.maximum(1.0, numpy.abs(target_bin_edges))))
+
+
+def _reduce(values, mappings):
+	for axis, (target_bin_edges, (indices, target_bins)) in enumerate(mappings):
+		shape = list(values.shape)
+		shape[axis] = len(target_bin_edges) + 1
+		reduced_values = numpy.zeros(shape, dtype=values.dtype)
+		selection = [slice(None)] * values.ndim
+		selection[axis] = target_bins
+		reduced_values[tuple(selection)] = numpy.add.reduceat(values, indices, axis=axis)
+		values = reduced_values
+	return values
+
+
+def rebin(root_histogram, target_bin_edges, name):
+	"""
+	Rebin a TH1/TH2/TH3 to the given bin edges per axis
+
+	Returns a new histogram of the same type with the same statistics (mean, RMS, entries).
+	"""
+	dimension = root_histogram.GetDimension()
+	dtype = _array_type(root_histogram)
+	axes = [root_histogram.GetXaxis(), root_histogram.GetYaxis(), root_histogram.GetZaxis()][:dimension]
+	source_bin_edges = [[axis.GetBinLowEdge(bin_index) for bin_index in xrange(1, axis.GetNbins()+2)] for axis in axes]
+	target_bin_edges = [numpy.asarray(bin_edges, dtype=numpy.float64) for bin_edges in target_bin_edges[:dimension]]
+	mappings = [(target, bin_mapping(source, target)) for source, target in zip(source_bin_edges, target_bin_edges)]
+
+	# the ROOT global bin numbering runs fastest along the x-axis
+	shape = [len(bin_edges)+1 for bin_edges in source_bin_edges]
+	n_cells = root_histogram.GetNcells()
+	contents = _reduce(_array_view(root_histogram.GetArray(), n_cells, dtype).reshape(shape, order="F"), mappings)
+	sumw2 = None
+	if root_histogram.GetSumw2N() > 0:
+		sumw2 = _reduce(_array_view(root_histogram.GetSumw2().GetArray(), n_cells, numpy.float64).reshape(shape, order="F"), mappings)
+
+	statistics = numpy.zeros(13)
+	root_histogram.GetStats(statistics)
+	entries = root_histogram.GetEntries()
+
+	# the clone keeps the type, titles and style, ROOT.TH1.SetBins resizes the arrays
+	rebinned_root_histogram = root_histogram.Clone(name)
+	rebinned_root_histogram.SetBins(*[item for bin_edges in target_bin_edges for item in (len(bin_edges)-1, array.array("d", bin_edges))])
+	rebinned_n_cells = rebinned_root_histogram.GetNcells()
+	_array_view(rebinned_root_histogram.GetArray(), rebinned_n_cells, dtype)[:] = contents.flatten(order="F")
+	if not sumw2 is None:
+		if rebinned_root_histogram.GetSumw2N() != rebinned_n_cells:
+			rebinned_root_histogram.Sumw2()
+		_array_view(rebinned_root_histogram.GetSumw2().GetArray(), rebinned_n_cells, numpy.float64)[:] = sumw2.flatten(order="F")
+
+	rebinned_root_histogram.PutStats(statistics)
+	rebinned_root_histogram.SetEntries(entries)
+	return rebinned_root_histogram
+
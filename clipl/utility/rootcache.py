@@ -5,13 +5,21 @@ import clipl.utility.logger as logger
 log = logging.getLogger(__name__)
 
 import abc
+import collections
 import copy
+import errno
+import fcntl
+import glob
 import hashlib
 import os
+import sqlite3
 import tempfile
+import time
 
 import ROOT
 
+import clipl.utility.cacheindex as cacheindex
+import clipl.utility.profiling as profiling
 import clipl.utility.tfilecontextmanager as tfilecontextmanager
 import clipl.utility.tools as tools
 
@@ -27,7 +35,32 @@ class Cache(object):
 
 
 class RootFileCache(Cache):
-	def __init__(self, cache_dir=None, args_groups=[[0,2],[1,3,4],[5,7,8,10,11,12],[6,9]], kwargs_groups=[["root_file_names","friend_files"],["path_to_trees","friend_folders","friend_aliases",],["root_histogram","name","binning","option","proxy_prefix","scan"],["variable_expression","weight_selection"]]):
+	"""
+	Cache for ROOT objects returned by functions reading from ROOT files
+
+	The cache key does not depend on the paths of the input files but on their identity
+	(size, modification time and ROOT file UUID, optionally a fingerprint of the content).
+	Regenerated files therefore invalidate the cache, while identical files read via different
+	paths share the same cache. Arguments listed in ignored_args/ignored_kwargs (e.g. the name
+	of the resulting object) do not enter the cache key.
+
+	Accesses are recorded in a cacheindex.CacheIndex. If max_size (in bytes) is set, entries are
+	evicted according to the eviction_policy ("lru" or "lfu") whenever a new entry makes the total
+	size exceed max_size.
+
+	Cache files are written to temporary files first and renamed afterwards. If locking is enabled,
+	only one process computes the object for a given key at a time while other processes wait for
+	and reuse its result.
+
+	Objects loaded from or written to the cache files are additionally kept in memory (up to
+	memory_max_size bytes, least recently used objects are dropped first), such that repeated
+	requests within the same process do not need to read the cache files again. Clones of the
+	objects in memory are returned.
+	"""
+	def __init__(self, cache_dir=None, args_groups=[[0,2],[1,3,4],[5,7,8,10,11,12],[6,9]], kwargs_groups=[["root_file_names","friend_files"],["path_to_trees","friend_folders","friend_aliases",],["root_histogram","name","binning","option","proxy_prefix","scan"],["variable_expression","weight_selection"]],
+	             file_args=[0,2], file_kwargs=["root_file_names","friend_files"], ignored_args=[7,13,14,15], ignored_kwargs=["name","redo_cache","fill_engine","read_options"], fingerprint=False,
+	             max_size=None, eviction_policy="lru", memory_max_size=256*1024*1024,
+	             locking=False, lock_timeout=3600.0):
 		self.cache_name = "cached_object"
 		self.cache_dir = os.path.expandvars(cache_dir)
 		if self.cache_dir is None:
@@ -48,20 +81,168 @@ class RootFileCache(Cache):
 		self.args_groups.append([max(flat_args_groups)+1])
 		self.kwargs_groups = copy.deepcopy(kwargs_groups)
 		
+		self.file_args = file_args
+		self.file_kwargs = file_kwargs
+		self.ignored_args = ignored_args
+		self.ignored_kwargs = ignored_kwargs
+		self.fingerprint = fingerprint
+		self._file_identities = {}
+		
+		self.max_size = max_size
+		self.eviction_policy = eviction_policy
+		self._index = None
+		
+		self.memory_max_size = memory_max_size
+		self._memory_cache = collections.OrderedDict()
+		self._memory_size = 0
+		self.statistics = collections.Counter()
+		
+		self.locking = locking
+		self.lock_timeout = lock_timeout
+	
+	def get_statistics_string(self):
+		n_requests = sum([self.statistics[key] for key in ["memory_hits", "file_hits", "misses"]])
+		return "{n_requests} cache requests: {memory_hits} hits in memory, {file_hits} hits in files, {misses} misses.".format(
+				n_requests=n_requests,
+				memory_hits=self.statistics["memory_hits"],
+				file_hits=self.statistics["file_hits"],
+				misses=self.statistics["misses"]
+		)
+	
+	@staticmethod
+	def _clone(root_object, name=None):
+		clone = root_object.Clone(root_object.GetName() if name is None else name)
+		if hasattr(clone, "SetDirectory"):
+			clone.SetDirectory(0)
+		return clone
+	
+	@staticmethod
+	def _object_size(root_object):
+		buffer = ROOT.TBufferFile(ROOT.TBuffer.kWrite)
+		buffer.WriteObject(root_object)
+		return buffer.Length()
+	
+	def _memory_load(self, cache_file, name=None):
+		if not cache_file in self._memory_cache:
+			return None
+		root_object, size = self._memory_cache.pop(cache_file)
+		self._memory_cache[cache_file] = (root_object, size)
+		return RootFileCache._clone(root_object, name)
+	
+	def _memory_store(self, cache_file, root_object):
+		if (not self.memory_max_size) or (cache_file is None):
+			return
+		if cache_file in self._memory_cache:
+			self._memory_size -= self._memory_cache.pop(cache_file)[1]
+		
+		size = RootFileCache._object_size(root_object)
+		if size > self.memory_max_size:
+			return
+		self._memory_cache[cache_file] = (RootFileCache._clone(root_object), size)
+		self._memory_size += size
+		
+		while self._memory_size > self.memory_max_size:
+			self._memory_size -= self._memory_cache.popitem(last=False)[1][1]
+	
+	def get_index(self):
+		"""
+		Return the index of the cache directory (None in case there is no cache directory).
+		"""
+		if (self._index is None) and (not self.cache_dir is None):
+			try:
+				self._index = cacheindex.CacheIndex(self.cache_dir)
+			except sqlite3.Error, e:
+				log.warning("Unable to open the index of the cache in \"{cache_dir}\": {error}".format(cache_dir=self.cache_dir, error=e))
+		return self._index
+	
+	def file_identity(self, file_name):
+		"""
+		Return a string identifying the content of a ROOT file independent of its path.
+		
+		The identity consists of the file size, the modification time and the UUID of the ROOT file.
+		If self.fingerprint is set, the MD5 sum of the first and the last 64 kB of local files is added.
+		Identities are determined only once per process and file (and modification time).
+		In case the file cannot be opened, the path is returned.
+		"""
+		stat = None
+		if not "://" in file_name:
+			try:
+				stat = os.stat(file_name)
+			except OSError:
+				return file_name
+		
+		memo_key = (os.path.realpath(file_name) if stat else file_name, stat.st_size if stat else None, stat.st_mtime if stat else None, self.fingerprint)
+		if not memo_key in self._file_identities:
+			identity = file_name
+			try:
+				with tfilecontextmanager.TFileContextManager(file_name, "READ") as root_file:
+					identity = "size={size},mtime={mtime},uuid={uuid}".format(
+							size=(stat.st_size if stat else root_file.GetSize()),
+							mtime=(stat.st_mtime if stat else root_file.GetModificationDate().AsSQLString()),
+							uuid=root_file.GetUUID().AsString()
+					)
+			except IOError:
+				pass
+			
+			if self.fingerprint and stat and (identity != file_name):
+				chunk_size = 64 * 1024
+				fingerprint = hashlib.md5()
+				with open(file_name, "rb") as input_file:
+					fingerprint.update(input_file.read(chunk_size))
+					if stat.st_size > 2 * chunk_size:
+						input_file.seek(-chunk_size, os.SEEK_END)
+						fingerprint.update(input_file.read(chunk_size))
+				identity += ",md5={fingerprint}".format(fingerprint=fingerprint.hexdigest())
+			
+			self._file_identities[memo_key] = identity
+		return self._file_identities[memo_key]
+	
+	def _file_names_identity(self, file_names):
+		if file_names is None:
+			return file_names
+		if isinstance(file_names, basestring):
+			file_names = [file_names]
+		
+		identities = []
+		for file_name in file_names:
+			expanded_file_names = [] if "://" in file_name else sorted(glob.glob(file_name))
+			identities.extend([self.file_identity(expanded_file_name) for expanded_file_name in (expanded_file_names if len(expanded_file_names) > 0 else [file_name])])
+		return identities
+	
+	@staticmethod
+	def _root_object_identity(root_object):
+		# the name of the (empty) histogram to be filled does not influence the result, but its binning does
+		if isinstance(root_object, ROOT.TH1):
+			identity = [root_object.ClassName()]
+			for axis in [root_object.GetXaxis(), root_object.GetYaxis(), root_object.GetZaxis()][:root_object.GetDimension()]:
+				identity.append([axis.GetBinLowEdge(bin_index) for bin_index in xrange(1, axis.GetNbins()+2)])
+			if hasattr(root_object, "GetErrorOption"):
+				identity.append(root_object.GetErrorOption())
+			return str(identity)
+		else:
+			return root_object.GetName()
+	
 	def _determine_cache_file(self, *args, **kwargs):
 		if self.cache_dir is None:
 			return None
 		
-		tmp_args = copy.deepcopy(args)
+		tmp_args = list(args)
 		for index, arg in enumerate(tmp_args):
-			if isinstance(arg, ROOT.TObject):
-				tmp_args[index] = arg.GetName()
+			if index in self.ignored_args:
+				tmp_args[index] = None
+			elif index in self.file_args:
+				tmp_args[index] = self._file_names_identity(arg)
+			elif isinstance(arg, ROOT.TObject):
+				tmp_args[index] = RootFileCache._root_object_identity(arg)
 
-		tmp_kwargs = copy.deepcopy(kwargs)
-		tmp_kwargs.pop("redo_cache")
+		tmp_kwargs = dict(kwargs)
+		for keyword in self.ignored_kwargs:
+			tmp_kwargs.pop(keyword, None)
 		for keyword, arg in tmp_kwargs.iteritems():
-			if isinstance(arg, ROOT.TObject):
-				tmp_kwargs[keyword] = arg.GetName()
+			if keyword in self.file_kwargs:
+				tmp_kwargs[keyword] = self._file_names_identity(arg)
+			elif isinstance(arg, ROOT.TObject):
+				tmp_kwargs[keyword] = RootFileCache._root_object_identity(arg)
 		
 		hashes = []
 		for args_group in self.args_groups[:-1]:
@@ -89,39 +270,184 @@ class RootFileCache(Cache):
 		cache_file = os.path.join(self.cache_dir, *hashes)+".root"
 		return cache_file
 	
-	def _get_cached(self, *args, **kwargs):
-		cache_file = self._determine_cache_file(*args, **kwargs)
-		root_tree = None
-		root_object = None
-		tmp_files = []
-		cache_found = False
-		if (not kwargs.get("redo_cache", False)) and cache_file and os.path.exists(cache_file):
+	def get_cache_file(self, *args, **kwargs):
+		"""
+		Return the cache file for the given arguments of the cached function or None in case caching is disabled.
+		"""
+		return self._determine_cache_file(*args, **kwargs)
+	
+	def keep_in_memory(self, cache_file, root_object):
+		"""
+		Keep an object in memory for following requests of the given cache file (without writing the file).
+		"""
+		self._memory_store(cache_file, root_object)
+	
+	def load(self, *args, **kwargs):
+		"""
+		Return the cached object for the given arguments of the cached function or None in case there is no cache.
+		"""
+		if kwargs.get("redo_cache", False):
+			return None
+		return self._load(self._determine_cache_file(*args, **kwargs), name=kwargs.get("name", None))
+
+	def store(self, root_object, *args, **kwargs):
+		"""
+		Write the result of the cached function for the given arguments to the cache.
+		"""
+		self._store(self._determine_cache_file(*args, **kwargs), root_object)
+
+	@profiling.profiled("cache load", "cache")
+	def _load(self, cache_file, name=None, count=True):
+		root_object = self._memory_load(cache_file, name)
+		if not root_object is None:
+			if count:
+				self.statistics["memory_hits"] += 1
+			log.debug("Took cached object for \"{root_file}/{path_to_object}\" from memory.".format(root_file=cache_file, path_to_object=self.cache_name))
+			return root_object
+		
+		if cache_file and os.path.exists(cache_file):
 			try:
 				with tfilecontextmanager.TFileContextManager(cache_file, "READ") as root_file:
 					root_object = root_file.Get(self.cache_name)
-					root_object.SetDirectory(0)
 					if (not root_object is None) and (not root_object == None):
-						cache_found = True
+						root_object.SetDirectory(0)
+						if name is not None:
+							root_object.SetName(name)
 						log.debug("Took cached object from \"{root_file}/{path_to_object}\".".format(root_file=cache_file, path_to_object=self.cache_name))
-			except:
-				root_tree = None
+					else:
+						log.warning("Cache file \"{root_file}\" does not contain \"{path_to_object}\" and is ignored.".format(root_file=cache_file, path_to_object=self.cache_name))
+						root_object = None
+			except Exception, e:
+				log.warning("Unable to read cache file \"{root_file}\": {error}".format(root_file=cache_file, error=e))
 				root_object = None
-				cache_found = False
+			
+			if (not root_object is None) and (not self.get_index() is None):
+				try:
+					self.get_index().touch(cache_file)
+				except (sqlite3.Error, OSError), e:
+					log.warning("Unable to update the index of the cache: {error}".format(error=e))
 		
-		if root_object is None:
-			root_tree, root_object, tmp_files = self._function_to_cache(*args, **kwargs)
-			if cache_file and (not cache_found) and (not root_object is None) and (not root_object == None):
+		if count:
+			self.statistics["misses" if root_object is None else "file_hits"] += 1
+		if not root_object is None:
+			self._memory_store(cache_file, root_object)
+		return root_object
+
+	@profiling.profiled("cache store", "cache")
+	def _store(self, cache_file, root_object):
+		if (not cache_file) or (root_object is None) or (root_object == None):
+			return
+		
+		self._memory_store(cache_file, root_object)
+		
+		# write to a temporary file in the same directory first and move it to the final
+		# location afterwards, such that concurrent readers never see incomplete files
+		tmp_cache_file = None
+		try:
+			full_cache_dir = os.path.dirname(cache_file)
+			if not os.path.exists(full_cache_dir):
 				try:
-					full_cache_dir = os.path.dirname(cache_file)
-					if not os.path.exists(full_cache_dir):
-						os.makedirs(full_cache_dir)
-					
-					with tfilecontextmanager.TFileContextManager(cache_file, "RECREATE") as root_file:
-						root_file.cd()
-						root_object.Write(self.cache_name, ROOT.TObject.kWriteDelete)
-						log.debug("Created cache in \"{root_file}/{path_to_object}\".".format(root_file=cache_file, path_to_object=self.cache_name))
-						root_object.SetDirectory(0)
-				except:
-					pass
+					os.makedirs(full_cache_dir)
+				except OSError:
+					if not os.path.isdir(full_cache_dir):
+						raise
+			
+			tmp_cache_file_descriptor, tmp_cache_file = tempfile.mkstemp(prefix=".tmp_", suffix=".root", dir=full_cache_dir)
+			os.close(tmp_cache_file_descriptor)
+			with tfilecontextmanager.TFileContextManager(tmp_cache_file, "RECREATE") as root_file:
+				root_file.cd()
+				root_object.Write(self.cache_name, ROOT.TObject.kWriteDelete)
+				root_object.SetDirectory(0)
+			os.chmod(tmp_cache_file, 0644)
+			os.rename(tmp_cache_file, cache_file)
+			log.debug("Created cache in \"{root_file}/{path_to_object}\".".format(root_file=cache_file, path_to_object=self.cache_name))
+		except Exception, e:
+			log.warning("Unable to write cache file \"{root_file}\": {error}".format(root_file=cache_file, error=e))
+			if (not tmp_cache_file is None) and os.path.exists(tmp_cache_file):
+				os.remove(tmp_cache_file)
+			return
+		
+		if not self.get_index() is None:
+			try:
+				self.get_index().add(cache_file)
+				if not self.max_size is None:
+					evicted_entries = self.get_index().evict(max_size=self.max_size, policy=self.eviction_policy, keep=[cache_file])
+					if len(evicted_entries) > 0:
+						log.debug("Evicted {n} entries from the cache in \"{cache_dir}\".".format(n=len(evicted_entries), cache_dir=self.cache_dir))
+			except (sqlite3.Error, OSError), e:
+				log.warning("Unable to update the index of the cache: {error}".format(error=e))
+
+	def _lock(self, cache_file):
+		"""
+		Acquire an exclusive lock for computing the object of the given cache file.
+		
+		Waits at most self.lock_timeout seconds. Returns the opened lock file or None
+		in case the lock could not be acquired.
+		"""
+		lock_file_name = cache_file + ".lock"
+		try:
+			full_cache_dir = os.path.dirname(cache_file)
+			if not os.path.exists(full_cache_dir):
+				try:
+					os.makedirs(full_cache_dir)
+				except OSError:
+					if not os.path.isdir(full_cache_dir):
+						raise
+			lock_file = open(lock_file_name, "a")
+		except (IOError, OSError), e:
+			log.warning("Unable to create lock file \"{lock_file}\": {error}".format(lock_file=lock_file_name, error=e))
+			return None
+		
+		start_time = time.time()
+		waiting = False
+		while True:
+			try:
+				fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				return lock_file
+			except IOError, e:
+				if not e.errno in [errno.EACCES, errno.EAGAIN]:
+					log.warning("Unable to lock \"{lock_file}\": {error}".format(lock_file=lock_file_name, error=e))
+					lock_file.close()
+					return None
+			
+			if (time.time() - start_time) > self.lock_timeout:
+				log.warning("Timeout while waiting for \"{lock_file}\". Compute the object without lock.".format(lock_file=lock_file_name))
+				lock_file.close()
+				return None
+			if not waiting:
+				log.debug("Wait for another process computing the object for \"{root_file}\".".format(root_file=cache_file))
+				waiting = True
+			time.sleep(0.5)
+
+	@staticmethod
+	def _unlock(lock_file):
+		# the lock file is kept, since removing it would let waiting processes and newcomers
+		# lock different files under the same name at the same time, it is deleted together
+		# with the cache file by the index (see CacheIndex.evict and CacheIndex.verify)
+		fcntl.lockf(lock_file, fcntl.LOCK_UN)
+		lock_file.close()
+
+	def _get_cached(self, *args, **kwargs):
+		root_tree = None
+		tmp_files = []
+		redo_cache = kwargs.get("redo_cache", False)
+		name = kwargs.get("name", None)
+		
+		cache_file = self._determine_cache_file(*args, **kwargs)
+		root_object = None if redo_cache else self._load(cache_file, name=name)
+		
+		if root_object is None:
+			lock_file = self._lock(cache_file) if (self.locking and cache_file) else None
+			try:
+				# another process might have created the cache in the meantime
+				if (not lock_file is None) and (not redo_cache):
+					root_object = self._load(cache_file, name=name, count=False)
+				
+				if root_object is None:
+					root_tree, root_object, tmp_files = self._function_to_cache(*args, **kwargs)
+					self._store(cache_file, root_object)
+			finally:
+				if not lock_file is None:
+					RootFileCache._unlock(lock_file)
 		
 		return root_tree, root_object, tmp_files
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent index of the metadata of ROOT files
+
+For every file, the structure of the keys (with their class names) is recorded. The numbers
+of entries and the branches of trees and the binnings of histograms are only read for the
+paths requested (see RootFileMetadata.tree and RootFileMetadata.histogram). Files are only
+opened in case the requested metadata is not yet known. The metadata of local files are stored
+in an SQLite database keyed by the path of the file together with its size and modification
+time (and the UUID of the file is recorded), such that files only need to be opened again
+after they have changed. Remote files are indexed only within the process.
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import json
+import os
+import sqlite3
+import time
+
+import ROOT
+
+import clipl.utility.tfilecontextmanager as tfilecontextmanager
+
+
+DEFAULT_INDEX_DIR = os.path.join("$HP_WORK_BASE_COMMON", "metadata")
+
+# increase in case the content of the recorded metadata changes
+METADATA_VERSION = 2
+
+
+def default_index_dir():
+	"""
+	Return the expanded DEFAULT_INDEX_DIR or None in case it contains undefined environment variables
+	"""
+	index_dir = os.path.expandvars(DEFAULT_INDEX_DIR)
+	return None if "$" in index_dir else os.path.abspath(index_dir)
+
+
+def inherits_from(class_name, base_class_name):
+	root_class = ROOT.TClass.GetClass(str(class_name))
+	return bool(root_class) and bool(root_class.InheritsFrom(base_class_name))
+
+
+class RootFileMetadata(object):
+	"""
+	Metadata of a single ROOT file, which is read lazily
+
+	objects: dict mapping paths (including directories) to the class names, complete in case keys_scanned is True
+	trees: dict mapping paths of trees to dicts with the number of entries and the list of (leaf name, type name)
+	histograms: dict mapping paths of histograms to dicts with the dimension, the bin edges per axis, the number of entries and the integral
+	on_change: function called with this object after further metadata has been read from the file
+	"""
+	def __init__(self, file_name, uuid=None, objects=None, keys_scanned=False, trees=None, histograms=None, on_change=None):
+		self.file_name = file_name
+		self.uuid = uuid
+		self.objects = objects or {}
+		self.keys_scanned = keys_scanned
+		self.trees = trees or {}
+		self.histograms = histograms or {}
+		self.on_change = on_change
+		# paths not found in the file, which has not been scanned completely
+		self._missing_paths = set()
+
+	@staticmethod
+	def _normalise_path(path):
+		return str(path).strip("/")
+
+	def class_name(self, path):
+		"""
+		Return the class name of the object at the given path ("" refers to the file itself) or None if it does not exist
+		"""
+		path = RootFileMetadata._normalise_path(path)
+		if path == "":
+			return "TFile"
+		if (not path in self.objects) and (not self.keys_scanned):
+			self.scan_keys()
+		return self.objects.get(path, None)
+
+	def elements(self, path=""):
+		"""
+		Return a list of (path, class name) for all non-directory objects below the given directory in the same
+		way as RootTools.walk_root_directory, but with paths relative to the file
+		"""
+		if not self.keys_scanned:
+			self.scan_keys()
+		path = RootFileMetadata._normalise_path(path)
+		prefix = (path + "/") if path != "" else ""
+		return sorted([(str(object_path), str(class_name)) for object_path, class_name in self.objects.iteritems() if object_path.startswith(prefix) and (not inherits_from(class_name, "TDirectory"))])
+
+	def tree(self, path, read=True):
+		"""
+		Return the number of entries and the leaves of a tree or None if it does not exist
+
+		read: open the file in case the tree has not been read yet. Otherwise, None is returned in this case.
+		"""
+		path = RootFileMetadata._normalise_path(path)
+		if (not path in self.trees) and read:
+			self._read_object(path)
+		return self.trees.get(path, None)
+
+	def histogram(self, path, read=True):
+		"""
+		Return the dimension, the binnings, the number of entries and the integral of a histogram or None if it does not exist
+
+		read: open the file in case the histogram has not been read yet. Otherwise, None is returned in this case.
+		"""
+		path = RootFileMetadata._normalise_path(path)
+		if (not path in self.histograms) and read:
+			self._read_object(path)
+		return self.histograms.get(path, None)
+
+	def to_dict(self):
+		return {
+			"version" : METADATA_VERSION,
+			"uuid" : self.uuid,
+			"objects" : self.objects,
+			"keys_scanned" : self.keys_scanned,
+			"trees" : self.trees,
+			"histograms" : self.histograms,
+		}
+
+	@staticmethod
+	def from_dict(file_name, metadata):
+		if metadata.get("version", None) != METADATA_VERSION:
+			return None
+		return RootFileMetadata(
+				file_name,
+				uuid=metadata["uuid"],
+				objects=metadata["objects"],
+				keys_scanned=metadata["keys_scanned"],
+				trees=metadata["trees"],
+				histograms=metadata["histograms"]
+		)
+
+	def scan_keys(self):
+		"""
+		Read the class names of all keys in the file (without reading the objects other than directories)
+		"""
+		try:
+			with tfilecontextmanager.TFileContextManager(self.file_name, "READ") as root_file:
+				self.uuid = root_file.GetUUID().AsString()
+				self._scan_directory(root_file, "")
+		except IOError, e:
+			log.error(str(e))
+			return
+		self.keys_scanned = True
+		self._changed()
+
+	def _scan_directory(self, root_directory, path):
+		for key in root_directory.GetListOfKeys():
+			object_path = os.path.join(path, key.GetName())
+			class_name = key.GetClassName()
+			# only the highest cycle of each key is recorded
+			if object_path in self.objects:
+				continue
+			self.objects[object_path] = class_name
+
+			if inherits_from(class_name, "TDirectory"):
+				self._scan_directory(root_directory.Get(key.GetName()), object_path)
+
+	def _read_object(self, path):
+		"""
+		Read the metadata of the tree or histogram at the given path
+		"""
+		class_name = self.objects.get(path, None)
+		if class_name is None:
+			if self.keys_scanned or (path in self._missing_paths):
+				return
+		elif (not inherits_from(class_name, "TTree")) and (not inherits_from(class_name, "TH1")):
+			return
+
+		try:
+			with tfilecontextmanager.TFileContextManager(self.file_name, "READ") as root_file:
+				self.uuid = root_file.GetUUID().AsString()
+				root_object = root_file.Get(path)
+				if (root_object is None) or (root_object == None):
+					self._missing_paths.add(path)
+					return
+				self.objects[path] = root_object.ClassName()
+
+				if isinstance(root_object, ROOT.TTree):
+					self.trees[path] = {
+						"entries" : root_object.GetEntries(),
+						"leaves" : [[RootFileMetadata._full_leaf_name(leaf), leaf.GetTypeName()] for leaf in root_object.GetListOfLeaves()],
+					}
+				elif isinstance(root_object, ROOT.TH1):
+					root_object.SetDirectory(0)
+					ROOT.SetOwnership(root_object, True)
+					axes = [root_object.GetXaxis(), root_object.GetYaxis(), root_object.GetZaxis()][:root_object.GetDimension()]
+					self.histograms[path] = {
+						"dimension" : root_object.GetDimension(),
+						"binnings" : [[axis.GetBinLowEdge(bin_index) for bin_index in xrange(1, axis.GetNbins()+2)] for axis in axes],
+						"entries" : root_object.GetEntries(),
+						"integral" : root_object.Integral(),
+					}
+				else:
+					return
+		except IOError, e:
+			log.error(str(e))
+			return
+		self._changed()
+
+	def _changed(self):
+		if not self.on_change is None:
+			self.on_change(self)
+
+	@staticmethod
+	def _full_leaf_name(leaf):
+		# same as RootTools.full_leaf_name, which cannot be imported here due to circular imports
+		name = leaf.GetName()
+		if leaf.GetBranch().GetMother().GetName() != leaf.GetName():
+			name = leaf.GetBranch().GetMother().GetName()+"."+name
+		return name
+
+
+class RootFileIndex(object):
+	def __init__(self, index_dir=None, index_name="root_files.sqlite", timeout=60.0):
+		"""
+		index_dir: directory of the persistent index. If None, the metadata is only kept in memory.
+		"""
+		self.index_dir = index_dir
+		self.index_file = None
+		self.timeout = timeout
+		self._metadata = {}
+		self._connection = None
+
+		if index_dir:
+			try:
+				if not os.path.exists(index_dir):
+					os.makedirs(index_dir)
+			except OSError:
+				pass
+			self.index_file = os.path.join(index_dir, index_name)
+			try:
+				with self._connect() as connection:
+					connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, uuid TEXT, metadata TEXT, last_access REAL)")
+			except sqlite3.Error, e:
+				log.warning("Unable to open the metadata index \"{index_file}\": {error}".format(index_file=self.index_file, error=e))
+				self.index_file = None
+
+	def _connect(self):
+		"""
+		Return the connection of this index, which is opened only once
+
+		The connection is used as context manager committing (or rolling back) the transaction.
+		"""
+		if self._connection is None:
+			self._connection = sqlite3.connect(self.index_file, timeout=self.timeout)
+		return self._connection
+
+	def get(self, file_name, scan=True):
+		"""
+		Return the RootFileMetadata of a file or None in case it does not exist
+
+		Files are only opened in case the requested metadata is not yet indexed or they have changed since.
+		scan: if False, None is returned for files, which are not indexed.
+		"""
+		stat = None
+		if not "://" in file_name:
+			try:
+				stat = os.stat(file_name)
+			except OSError:
+				log.error("Could not find ROOT file \"{file_name}\"!".format(file_name=file_name))
+				return None
+			path = os.path.realpath(file_name)
+			memo_key = (path, stat.st_size, stat.st_mtime)
+		else:
+			path = file_name
+			memo_key = (path, None, None)
+
+		if not memo_key in self._metadata:
+			metadata = None
+			if stat and self.index_file:
+				metadata = self._load(path, stat)
+
+			if metadata is None:
+				if not scan:
+					return None
+				metadata = RootFileMetadata(file_name)
+
+			metadata.file_name = file_name
+			if stat and self.index_file:
+				metadata.on_change = lambda changed_metadata: self._store(path, stat, changed_metadata)
+			self._metadata[memo_key] = metadata
+		return self._metadata[memo_key]
+
+	def invalidate(self, file_name):
+		"""
+		Remove the metadata of a file from the index, such that it is scanned again when it is requested next time
+		"""
+		path = file_name if "://" in file_name else os.path.realpath(file_name)
+		for memo_key in [memo_key for memo_key in self._metadata.keys() if memo_key[0] == path]:
+			del self._metadata[memo_key]
+		if self.index_file:
+			try:
+				with self._connect() as connection:
+					connection.execute("DELETE FROM files WHERE path = ?", (path,))
+			except sqlite3.Error, e:
+				log.debug("Unable to remove the metadata of \"{path}\" from the index: {error}".format(path=path, error=e))
+
+	def _load(self, path, stat):
+		# reading does not update last_access, which is only set when the metadata is written
+		try:
+			row = self._connect().execute("SELECT metadata FROM files WHERE path = ? AND size = ? AND mtime = ?", (path, stat.st_size, stat.st_mtime)).fetchone()
+		except sqlite3.Error, e:
+			log.debug("Unable to read the metadata of \"{path}\" from the index: {error}".format(path=path, error=e))
+			return None
+		return None if row is None else RootFileMetadata.from_dict(path, json.loads(row[0]))
+
+	def _store(self, path, stat, metadata):
+		try:
+			with self._connect() as connection:
+				connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", (
+						path, stat.st_size, stat.st_mtime, metadata.uuid, json.dumps(metadata.to_dict()), time.time()
+				))
+		except sqlite3.Error, e:
+			log.debug("Unable to write the metadata of \"{path}\" to the index: {error}".format(path=path, error=e))
+
+
+_root_file_indices = {}
+
+def get_root_file_index(index_dir=None):
+	"""
+	Return the metadata index of this process for the given directory (None: in-memory index only)
+	"""
+	key = (os.getpid(), os.path.abspath(index_dir) if index_dir else None)
+	if not key in _root_file_indices:
+		_root_file_indices[key] = RootFileIndex(key[1])
+	return _root_file_indices[key]
+
+def get_metadata(file_name, index_dir=None, scan=True):
+	return get_root_file_index(index_dir).get(file_name, scan=scan)
+
@@ -11,6 +11,7 @@ log = logging.getLogger(__name__)
 import array
 import copy
 import collections
+import fcntl
 import glob
 import hashlib
 import numpy
@@ -18,6 +19,9 @@ import os
 import sys
 import shlex
 import re
+import tempfile
+import time
+import traceback
 
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -27,10 +31,15 @@ ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
 ROOT.gEnv.SetValue("ACLiC.LinkLibs", 0)
 ROOT.gROOT.ProcessLine("gEnv->SetValue(\"ACLiC.LinkLibs\", 0)")
 
+import clipl.utility.columnarfill as columnarfill
 import clipl.utility.geometry as geometry
+import clipl.utility.profiling as profiling
+import clipl.utility.rebinning as rebinning
 import clipl.utility.tools as tools
+import clipl.utility.tfilecontextmanager as tfilecontextmanager
 from clipl.utility.tfilecontextmanager import TFileContextManager
 import clipl.utility.rootcache as rootcache
+import clipl.utility.rootfileindex as rootfileindex
 
 
 class RootTools(object):
@@ -49,34 +58,41 @@ class RootTools(object):
 		return name
 
 	@staticmethod
-	def check_type(root_file_names, path_to_objects, print_quantities=False):
+	def check_type(root_file_names, path_to_objects, print_quantities=False, index_dir=None):
+		"""
+		Determine whether the objects are read from trees or directories
+
+		The type is taken from the metadata index (see rootfileindex.RootFileIndex),
+		such that the first file only needs to be opened in case it is not yet indexed.
+		"""
 		if isinstance(root_file_names, basestring):
 			root_file_names = [root_file_names]
 		if isinstance(path_to_objects, basestring):
 			path_to_objects = [path_to_objects]
 
-		with TFileContextManager(root_file_names[0], "READ") as root_file:
-			root_object = root_file.Get(str(path_to_objects[0])) if str(path_to_objects[0]) != "" else root_file
-			if root_object:
-				if isinstance(root_object, ROOT.TTree):
-					if print_quantities:
-						log.info("List of all tree quantities (in the first file):")
-						for leaf in sorted(root_object.GetListOfLeaves(), key=lambda leaf: leaf.GetName()):
-							log.info("\t%s (%s)" % (RootTools.full_leaf_name(leaf), leaf.GetTypeName()))
-					return "TTree"
-				elif isinstance(root_object, ROOT.TDirectory):
-					if print_quantities:
-						log.info("List of all histogram/graph/function quantities (in the first file):")
-						for key, path in sorted(RootTools.walk_root_directory(root_object), key=lambda element: element[1]):
-							if key.GetClassName().startswith("TH") or key.GetClassName().startswith("TF") or key.GetClassName().startswith("Roo") or "Graph" in key.GetClassName():
-								log.info("\t%s (%s)" % (path, key.GetClassName()))
-					return "TDirectory"
-				else:
-					log.error("Usage of ROOT objects of Type \"" + root_object.ClassName() + "\" is not yet implemented!")
-					return None
+		metadata = rootfileindex.get_metadata(root_file_names[0], index_dir=index_dir)
+		class_name = None if metadata is None else metadata.class_name(path_to_objects[0])
+		if class_name:
+			if rootfileindex.inherits_from(class_name, "TTree"):
+				if print_quantities:
+					log.info("List of all tree quantities (in the first file):")
+					for leaf_name, type_name in sorted(metadata.tree(path_to_objects[0])["leaves"]):
+						log.info("\t%s (%s)" % (leaf_name, type_name))
+				return "TTree"
+			elif rootfileindex.inherits_from(class_name, "TDirectory"):
+				if print_quantities:
+					log.info("List of all histogram/graph/function quantities (in the first file):")
+					prefix = (str(path_to_objects[0]).strip("/") + "/") if str(path_to_objects[0]).strip("/") != "" else ""
+					for path, element_class_name in metadata.elements(path_to_objects[0]):
+						if element_class_name.startswith("TH") or element_class_name.startswith("TF") or element_class_name.startswith("Roo") or "Graph" in element_class_name:
+							log.info("\t%s (%s)" % (path[len(prefix):], element_class_name))
+				return "TDirectory"
 			else:
-				log.error("Could not find ROOT object \"" + path_to_objects[0] + "\" in file \"" + root_file_names[0] + "\"!")
+				log.error("Usage of ROOT objects of Type \"" + class_name + "\" is not yet implemented!")
 				return None
+		else:
+			log.error("Could not find ROOT object \"" + path_to_objects[0] + "\" in file \"" + root_file_names[0] + "\"!")
+			return None
 
 
 	@staticmethod
@@ -124,7 +140,8 @@ class RootTools(object):
 
 
 	@staticmethod
-	def histogram_from_file(root_file_names, path_to_histograms, x_bins=None, y_bins=None, z_bins=None, name=None):
+	@profiling.profiled("read histograms", "InputRoot")
+	def histogram_from_file(root_file_names, path_to_histograms, x_bins=None, y_bins=None, z_bins=None, name=None, n_processes=1):
 		"""
 		Read histograms from files
 
@@ -133,6 +150,11 @@ class RootTools(object):
 
 		This function looks for the same histograms in all files and sums them up
 		The name (string) of the resulting histogram can be passed as a parameter
+
+		With a single process, the histograms are summed up one after another in the order of the files.
+		With n_processes > 1, blocks of files are read and summed up in parallel processes and the histograms
+		are summed up pairwise in a fixed order (see merge_pairwise), such that the result does not depend on
+		the number of processes. It can differ from the single-process result in the last bits.
 		"""
 
 		if isinstance(root_file_names, basestring):
@@ -146,28 +168,23 @@ class RootTools(object):
 				                                                     str(path_to_histograms)])).hexdigest())
 
 		# loop over files and try to read histograms
-		root_histogram = None
-		for root_file_name in root_file_names:
-			with TFileContextManager(root_file_name, "READ") as root_file:
-				for path_to_histogram in path_to_histograms:
-					tmp_root_histogram = root_file.Get(str(path_to_histogram))
-					if tmp_root_histogram == None:
-						log.critical("Cannot find histogram \"%s\" in file \"%s\"!" % (path_to_histogram, root_file_name))
-						sys.exit(1)
-
-					if tmp_root_histogram is None:
-						log.error("Could not find histogram \"" + path_to_histogram + "\" in file \"" + root_file_name + "\"!")
-					else:
-						if isinstance(tmp_root_histogram, ROOT.TH1):
-							tmp_root_histogram.SetDirectory(0)
-
-						if root_histogram == None:
-							root_histogram = tmp_root_histogram.Clone(name)
-						else:
-							root_histogram.Add(tmp_root_histogram)
+		elements = [(root_file_name, path_to_histogram) for root_file_name in root_file_names for path_to_histogram in path_to_histograms]
+		block_size = RootTools.merge_block_size(len(elements), n_processes)
+		if block_size < len(elements):
+			blocks = []
+			for task_result in tools.parallelize(_merge_histograms_from_files_in_process, [elements[index:index+block_size] for index in xrange(0, len(elements), block_size)], n_processes=n_processes, description="Merging ROOT inputs"):
+				if task_result is None:
+					log.critical("Merging inputs from files in parallel processes failed!")
+					sys.exit(1)
+				blocks.extend(RootTools.read_objects_from_temporary_file(task_result))
+			root_histogram = RootTools.merge_pairwise(blocks, weights=[min(block_size, len(elements)-index) for index in xrange(0, len(elements), block_size)])
+		else:
+			root_histogram = RootTools.merge_histograms_from_files(elements, pairwise=(n_processes > 1))
 
-						if isinstance(root_histogram, ROOT.TH1):
-							root_histogram.SetDirectory(0)
+		if not root_histogram is None:
+			root_histogram.SetName(name)
+			if isinstance(root_histogram, ROOT.TH1):
+				root_histogram.SetDirectory(0)
 
 		# rebinning
 		if isinstance(root_histogram, ROOT.TH1) and root_histogram.GetNbinsX()*root_histogram.GetNbinsY()*root_histogram.GetNbinsZ() > 1:
@@ -209,12 +226,77 @@ class RootTools(object):
 		return root_histogram
 
 
+	@staticmethod
+	def merge_histograms_from_files(elements, pairwise=True):
+		"""
+		Read and sum up histograms
+
+		elements: list of (root file name, path to histogram)
+		pairwise: sum up pairwise (see merge_pairwise) instead of one after another
+		"""
+		stack = []
+		for root_file_name, path_to_histogram in elements:
+			with TFileContextManager(root_file_name, "READ", pooled=True) as root_file:
+				tmp_root_histogram = tfilecontextmanager.get_tfile_pool().get_object(root_file, path_to_histogram)
+				if tmp_root_histogram == None:
+					log.critical("Cannot find histogram \"%s\" in file \"%s\"!" % (path_to_histogram, root_file_name))
+					sys.exit(1)
+
+				if isinstance(tmp_root_histogram, ROOT.TH1):
+					tmp_root_histogram.SetDirectory(0)
+				if pairwise or (len(stack) == 0):
+					RootTools._push_pairwise(stack, tmp_root_histogram)
+				else:
+					stack[0][1].Add(tmp_root_histogram)
+		return RootTools._finish_pairwise(stack)
+
+	@staticmethod
+	def merge_pairwise(root_objects, weights=None):
+		"""
+		Sum up ROOT objects pairwise like a binary tree (in place, the first object contains the result)
+
+		weights: numbers of original objects contained in already merged partial sums. Partial sums
+		         of aligned blocks with sizes given by merge_block_size are summed up in the same order
+		         as the original objects, such that the results are bit-identical.
+		"""
+		stack = []
+		for root_object, weight in zip(root_objects, weights or ([1] * len(root_objects))):
+			RootTools._push_pairwise(stack, root_object, weight)
+		return RootTools._finish_pairwise(stack)
+
+	@staticmethod
+	def merge_block_size(n_elements, n_processes):
+		"""
+		Size of the blocks to be merged in parallel processes (power of two)
+		"""
+		block_size = 1
+		while (block_size * max(n_processes, 1)) < n_elements:
+			block_size *= 2
+		return block_size
+
+	@staticmethod
+	def _push_pairwise(stack, root_object, weight=1):
+		# partial sums of equal numbers of objects are summed up as soon as possible
+		stack.append([weight, root_object])
+		while (len(stack) > 1) and (stack[-1][0] == stack[-2][0]):
+			right_weight, right_object = stack.pop()
+			stack[-1][1].Add(right_object)
+			stack[-1][0] += right_weight
+
+	@staticmethod
+	def _finish_pairwise(stack):
+		while len(stack) > 1:
+			right_weight, right_object = stack.pop()
+			stack[-1][1].Add(right_object)
+			stack[-1][0] += right_weight
+		return stack[0][1] if len(stack) > 0 else None
+
 	def histogram_from_tree(self, root_file_names, path_to_trees,
 		                    x_expression, y_expression=None, z_expression=None,
 		                    x_bins=None, y_bins=None, z_bins=None,
 		                    weight_selection="", option="", name=None,
 		                    friend_files=None, friend_folders=None, friend_aliases=None,
-		                    proxy_prefix="", scan=None, redo_cache=False):
+		                    proxy_prefix="", scan=None, redo_cache=False, fill_engine="draw", read_options=None):
 		"""
 		Read histograms from trees
 
@@ -227,10 +309,40 @@ class RootTools(object):
 		binning: string, can be empty, "<nbins>", "<nbins>, <low>, <up>", ...
 		weight_selection: Used as cut parameter of ROOT.TTree.Draw
 		option: Used as option parameter of ROOT.TTree.Draw, "GOFF" is added
+		fill_engine: "draw" (ROOT.TTree.Draw) or "numpy" (see columnarfill, falls back to "draw" if not possible)
+		read_options: dict with options not affecting the result, see tree_draw
 
 		The name (string) of the resulting histogram can be passed as a parameter
 		"""
 
+		tree_draw_kwargs, binning_identifier = self.prepare_histogram_from_tree(
+				root_file_names, path_to_trees,
+				x_expression, y_expression=y_expression, z_expression=z_expression,
+				x_bins=x_bins, y_bins=y_bins, z_bins=z_bins,
+				weight_selection=weight_selection, option=option, name=name,
+				friend_files=friend_files, friend_folders=friend_folders, friend_aliases=friend_aliases,
+				proxy_prefix=proxy_prefix, scan=scan, redo_cache=redo_cache, fill_engine=fill_engine, read_options=read_options
+		)
+
+		# draw histogram
+		tree, root_histogram, tmp_files = RootTools.tree_draw(**tree_draw_kwargs)
+
+		root_histogram = self.finish_histogram_from_tree(root_histogram, binning_identifier, tree_draw_kwargs)
+		return tree, root_histogram, tmp_files
+
+	def prepare_histogram_from_tree(self, root_file_names, path_to_trees,
+		                            x_expression, y_expression=None, z_expression=None,
+		                            x_bins=None, y_bins=None, z_bins=None,
+		                            weight_selection="", option="", name=None,
+		                            friend_files=None, friend_folders=None, friend_aliases=None,
+		                            proxy_prefix="", scan=None, redo_cache=False, fill_engine="draw", read_options=None):
+		"""
+		Prepare the arguments of RootTools.tree_draw for reading a histogram from trees
+
+		Takes the same arguments as histogram_from_tree.
+		Returns (tree_draw_kwargs, binning_identifier).
+		"""
+
 		variable_expression = "%s%s%s" % (z_expression + ":" if z_expression else "",
 			                              y_expression + ":" if y_expression else "",
 			                              x_expression)
@@ -286,26 +398,37 @@ class RootTools(object):
 						profile_error_option=(option.lower().replace("prof", ''))
 					)
 
-		# draw histogram
-		tree, root_histogram, tmp_files = RootTools.tree_draw(
-				root_file_names=root_file_names,
-				path_to_trees=path_to_trees,
-				friend_files=friend_files,
-				friend_folders=friend_folders,
-				friend_aliases=friend_aliases,
-				root_histogram=root_histogram,
-				variable_expression=variable_expression,
-				name=name,
-				binning=binning,
-				weight_selection=str(weight_selection),
-				option=option,
-				proxy_prefix=proxy_prefix,
-				scan=scan,
-				redo_cache=redo_cache
-		)
+		tree_draw_kwargs = {
+			"root_file_names" : root_file_names,
+			"path_to_trees" : path_to_trees,
+			"friend_files" : friend_files,
+			"friend_folders" : friend_folders,
+			"friend_aliases" : friend_aliases,
+			"root_histogram" : root_histogram,
+			"variable_expression" : variable_expression,
+			"name" : name,
+			"binning" : binning,
+			"weight_selection" : str(weight_selection),
+			"option" : option,
+			"proxy_prefix" : proxy_prefix,
+			"scan" : scan,
+			"redo_cache" : redo_cache,
+			"fill_engine" : fill_engine,
+			"read_options" : read_options,
+		}
+		return tree_draw_kwargs, binning_identifier
+
+	def finish_histogram_from_tree(self, root_histogram, binning_identifier, tree_draw_kwargs):
+		"""
+		Check and register the result of RootTools.tree_draw for the following inputs with the same binning
+
+		Returns the final histogram.
+		"""
+		name = tree_draw_kwargs["name"]
+		option = tree_draw_kwargs["option"]
 
 		if root_histogram == None:
-			log.critical("Cannot find histogram \"%s\" created from trees %s in files %s!" % (name, str(path_to_trees), str(root_file_names)))
+			log.critical("Cannot find histogram \"%s\" created from trees %s in files %s!" % (name, str(tree_draw_kwargs["path_to_trees"]), str(tree_draw_kwargs["root_file_names"])))
 			sys.exit(1)
 
 		if isinstance(root_histogram, ROOT.TH1):
@@ -319,7 +442,202 @@ class RootTools(object):
 
 		if "prof" not in option.lower() and binning_identifier not in self.binning_determined:
 			self.binning_determined.append(binning_identifier)
-		return tree, root_histogram, tmp_files
+		return root_histogram
+
+	def histograms_from_trees(self, list_of_kwargs, batched=True, n_processes=1):
+		"""
+		Read several histograms from trees
+
+		list_of_kwargs: list of dicts, each containing the arguments of histogram_from_tree
+
+		In batched mode, inputs reading from the same trees (files, folders and friends) are filled
+		in a single loop over the events, provided the histograms can be filled without
+		ROOT.TTree.Draw specific options.
+
+		With n_processes > 1, inputs (or batches of inputs) are read in parallel processes.
+
+		Both is only done for inputs with binnings known beforehand. All other inputs are read
+		one by one by histogram_from_tree in this process, since they determine the binnings
+		of the following inputs.
+
+		Returns a list of (tree, root_histogram, tmp_files) in the order of the inputs.
+		Trees are not returned for inputs read in parallel processes.
+		"""
+		results = [None] * len(list_of_kwargs)
+
+		groups = collections.OrderedDict()
+		for index, kwargs in enumerate(list_of_kwargs):
+			tree_draw_kwargs, binning_identifier = self.prepare_histogram_from_tree(**kwargs)
+
+			if not isinstance(tree_draw_kwargs["root_histogram"], ROOT.TH1):
+				# auto-determined binnings are needed by the following inputs
+				tree, root_histogram, tmp_files = RootTools.tree_draw(**tree_draw_kwargs)
+				results[index] = (tree, self.finish_histogram_from_tree(root_histogram, binning_identifier, tree_draw_kwargs), tmp_files)
+				continue
+
+			root_histogram = RootTools.tree_draw_cache.load(**tree_draw_kwargs)
+			if not root_histogram is None:
+				results[index] = (None, self.finish_histogram_from_tree(root_histogram, binning_identifier, tree_draw_kwargs), [])
+				continue
+
+			group_key = index
+			if batched and RootTools.multiple_tree_draw_possible(tree_draw_kwargs):
+				group_key = tuple([str(tree_draw_kwargs[key]) for key in ["root_file_names", "path_to_trees", "friend_files", "friend_folders", "friend_aliases"]])
+			groups.setdefault(group_key, []).append((index, kwargs, tree_draw_kwargs, binning_identifier))
+
+		if (n_processes > 1) and (len(groups) > 1):
+			binning_state = {
+				"binning_determined" : self.binning_determined,
+				"x_bin_edges" : self.x_bin_edges,
+				"y_bin_edges" : self.y_bin_edges,
+				"z_bin_edges" : self.z_bin_edges,
+			}
+			tasks = [(binning_state, [kwargs for index, kwargs, tree_draw_kwargs, binning_identifier in group], batched) for group in groups.values()]
+			for group, task_result in zip(groups.values(), tools.parallelize(_histograms_from_trees_in_process, tasks, n_processes=n_processes, description="Reading ROOT inputs")):
+				if task_result is None:
+					log.critical("Reading inputs from trees in parallel processes failed!")
+					sys.exit(1)
+				temporary_file_name, list_of_tmp_files = task_result
+				root_histograms = RootTools.read_objects_from_temporary_file(temporary_file_name)
+				for (index, kwargs, tree_draw_kwargs, binning_identifier), root_histogram, tmp_files in zip(group, root_histograms, list_of_tmp_files):
+					root_histogram.SetName(tree_draw_kwargs["name"])
+					results[index] = (None, self.finish_histogram_from_tree(root_histogram, binning_identifier, tree_draw_kwargs), tmp_files)
+		else:
+			for group in groups.values():
+				if len(group) == 1:
+					index, kwargs, tree_draw_kwargs, binning_identifier = group[0]
+					tree, root_histogram, tmp_files = RootTools.tree_draw(**tree_draw_kwargs)
+					results[index] = (tree, self.finish_histogram_from_tree(root_histogram, binning_identifier, tree_draw_kwargs), tmp_files)
+				else:
+					tree = RootTools.tree_draw_multiple([tree_draw_kwargs for index, kwargs, tree_draw_kwargs, binning_identifier in group])
+					for index, kwargs, tree_draw_kwargs, binning_identifier in group:
+						root_histogram = tree_draw_kwargs["root_histogram"]
+						RootTools.tree_draw_cache.store(root_histogram, **tree_draw_kwargs)
+						results[index] = (tree, self.finish_histogram_from_tree(root_histogram, binning_identifier, tree_draw_kwargs), [])
+
+		return results
+
+	@staticmethod
+	def histograms_from_files(list_of_kwargs, n_processes=1):
+		"""
+		Read several histograms from files
+
+		list_of_kwargs: list of dicts, each containing the arguments of histogram_from_file
+
+		With n_processes > 1, the inputs are read in parallel processes.
+		Returns a list of histograms in the order of the inputs.
+		"""
+		if (n_processes > 1) and (len(list_of_kwargs) > 1):
+			root_histograms = []
+			for task_result in tools.parallelize(_histograms_from_files_in_process, [[kwargs] for kwargs in list_of_kwargs], n_processes=n_processes, description="Reading ROOT inputs"):
+				if task_result is None:
+					log.critical("Reading inputs from files in parallel processes failed!")
+					sys.exit(1)
+				root_histograms.extend(RootTools.read_objects_from_temporary_file(task_result))
+			return root_histograms
+		else:
+			return [RootTools.histogram_from_file(**kwargs) for kwargs in list_of_kwargs]
+
+	@staticmethod
+	def write_objects_to_temporary_file(root_objects):
+		"""
+		Write ROOT objects into a temporary file in order to pass them to another process
+
+		Returns the name of the temporary file.
+		"""
+		file_descriptor, temporary_file_name = tempfile.mkstemp(prefix="clipl_objects_", suffix=".root")
+		os.close(file_descriptor)
+		with TFileContextManager(temporary_file_name, "RECREATE") as root_file:
+			root_file.cd()
+			for index, root_object in enumerate(root_objects):
+				root_object.Write("object_%d" % index, ROOT.TObject.kWriteDelete)
+				if isinstance(root_object, ROOT.TH1):
+					root_object.SetDirectory(0)
+		return temporary_file_name
+
+	@staticmethod
+	def read_objects_from_temporary_file(temporary_file_name):
+		"""
+		Read and remove a temporary file written by write_objects_to_temporary_file
+
+		Returns the list of ROOT objects.
+		"""
+		root_objects = []
+		with TFileContextManager(temporary_file_name, "READ") as root_file:
+			for index in xrange(root_file.GetNkeys()):
+				root_object = root_file.Get("object_%d" % index)
+				if isinstance(root_object, ROOT.TH1):
+					root_object.SetDirectory(0)
+				root_objects.append(root_object)
+		os.remove(temporary_file_name)
+		return root_objects
+
+	@staticmethod
+	def multiple_tree_draw_possible(tree_draw_kwargs):
+		"""
+		Check whether an input prepared by prepare_histogram_from_tree can be filled by tree_draw_multiple
+		"""
+		if not isinstance(tree_draw_kwargs["root_histogram"], ROOT.TH1):
+			return False
+		if tree_draw_kwargs["scan"]:
+			return False
+		option = tree_draw_kwargs["option"].lower()
+		if ("proxy" in option) or ("tgraph" in option):
+			return False
+		# only profile error options are supported, they are already applied when the histogram is created
+		return (option.replace("prof", "").strip() in ["", "s", "i", "g"])
+
+	@staticmethod
+	@profiling.profiled("draw multiple", "InputRoot")
+	def tree_draw_multiple(list_of_tree_draw_kwargs):
+		"""
+		Fill the (pre-created) histograms of several inputs reading from the same trees in one loop over the events
+
+		list_of_tree_draw_kwargs: list of dicts with the arguments of tree_draw, see multiple_tree_draw_possible
+
+		The histograms are filled in place. Inputs, for which the expressions cannot be compiled,
+		are read separately using tree_draw. Returns the TChain.
+		"""
+		RootTools.load_compile_macro(os.path.join(os.path.dirname(os.path.abspath(__file__)), "multihistogramfiller.C"))
+
+		first_kwargs = list_of_tree_draw_kwargs[0]
+		read_options = first_kwargs.get("read_options") or {}
+		read_statistics = RootTools.get_read_statistics()
+		tree, friend_trees = RootTools.build_chain(
+				first_kwargs["root_file_names"], first_kwargs["path_to_trees"],
+				first_kwargs["friend_files"], first_kwargs["friend_folders"], first_kwargs["friend_aliases"],
+				name="chain_{0}".format(hashlib.md5("".join([tree_draw_kwargs["name"] for tree_draw_kwargs in list_of_tree_draw_kwargs])).hexdigest()),
+				index_dir=read_options.get("metadata_index_dir", None)
+		)
+
+		list_of_filler_kwargs = list_of_tree_draw_kwargs
+		if first_kwargs.get("fill_engine", "draw") == "numpy":
+			filled = columnarfill.fill_histograms(tree, [(tree_draw_kwargs["root_histogram"], tree_draw_kwargs["variable_expression"], tree_draw_kwargs["weight_selection"]) for tree_draw_kwargs in list_of_tree_draw_kwargs])
+			list_of_filler_kwargs = [tree_draw_kwargs for tree_draw_kwargs, columnar_filled in zip(list_of_tree_draw_kwargs, filled) if not columnar_filled]
+
+		filler = ROOT.MultiHistogramFiller(tree)
+		for tree_draw_kwargs in list_of_filler_kwargs:
+			expressions = (columnarfill.split_variable_expression(tree_draw_kwargs["variable_expression"]) + ["", ""])[:3]
+			log.debug("MultiHistogramFiller.Add(\"" + tree_draw_kwargs["name"] + "\", \"" + "\", \"".join(expressions) + "\", \"" + tree_draw_kwargs["weight_selection"] + "\")")
+			if not filler.Add(tree_draw_kwargs["root_histogram"], expressions[0], expressions[1], expressions[2], tree_draw_kwargs["weight_selection"]):
+				log.warning("Cannot fill histogram \"%s\" together with other inputs, read it separately." % tree_draw_kwargs["name"])
+				tree_draw_kwargs["root_histogram"] = RootTools.tree_draw(**tree_draw_kwargs)[1]
+
+		if len(list_of_filler_kwargs) > 0:
+			branches_pruned = RootTools.prepare_reading(tree, tools.flattenList([columnarfill.split_variable_expression(tree_draw_kwargs["variable_expression"]) + [tree_draw_kwargs["weight_selection"]] for tree_draw_kwargs in list_of_filler_kwargs]), read_options)
+
+			log.debug("Filling %d histograms in one loop over the trees %s in files %s ..." % (len(list_of_filler_kwargs), str(first_kwargs["path_to_trees"]), str(first_kwargs["root_file_names"])))
+			filler.Fill()
+
+			if branches_pruned:
+				RootTools.enable_all_branches(tree)
+		RootTools.check_chain_after_reading(tree, friend_trees, index_dir=read_options.get("metadata_index_dir", None))
+		RootTools.log_read_statistics(read_statistics, first_kwargs["root_file_names"], read_options)
+
+		for tree_draw_kwargs in list_of_tree_draw_kwargs:
+			# see tree_draw
+			tree_draw_kwargs["root_histogram"].GetSumOfWeights()
+		return tree
 
 	@staticmethod
 	def prepare_proxy_command(s):
@@ -333,12 +651,27 @@ class RootTools(object):
 		return 'return ' + s if 'return' not in s else s
 
 	@staticmethod
-	@rootcache.RootFileCache(os.path.expandvars(os.path.join("$HP_WORK_BASE_COMMON", "caches")))
-	def tree_draw(root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, root_histogram, variable_expression, name, binning, weight_selection, option, proxy_prefix="", scan=None, redo_cache=False):
+	@profiling.profiled("build chain", "InputRoot")
+	def build_chain(root_file_names, path_to_trees, friend_files=None, friend_folders=None, friend_aliases=None, name=None, index_dir=None):
+		"""
+		Build up a TChain reading all trees from all files including the friend trees
 
-		hash_name = hashlib.md5("".join(map(str, [root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, root_histogram, variable_expression, name, binning, weight_selection, option, proxy_prefix, scan, redo_cache]))).hexdigest()
+		The numbers of entries of local files are taken from the metadata index (see add_to_chain),
+		such that the files are only opened once the loop over the events reaches them. The chain is
+		built again in case files have changed since they have been indexed (see validate_chain).
+		Returns (tree, friend_trees). The friend trees need to be kept alive as long as the tree is used.
+		"""
+		tree, friend_trees = RootTools._build_chain(root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, name=name, index_dir=index_dir)
+		if not RootTools.validate_chain(tree, friend_trees, index_dir=index_dir):
+			log.warning("Build the chain again with the current numbers of entries.")
+			tree, friend_trees = RootTools._build_chain(root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, name=name, index_dir=index_dir)
+			if not RootTools.validate_chain(tree, friend_trees, index_dir=index_dir):
+				log.critical("Input files are changing while building the chain! Please rerun.")
+				sys.exit(1)
+		return tree, friend_trees
 
-		# prepare TChain
+	@staticmethod
+	def _build_chain(root_file_names, path_to_trees, friend_files=None, friend_folders=None, friend_aliases=None, name=None, index_dir=None):
 		if isinstance(root_file_names, basestring):
 			root_file_names = [root_file_names]
 		if isinstance(path_to_trees, basestring):
@@ -349,7 +682,7 @@ class RootTools(object):
 			for path_to_tree in path_to_trees:
 				complete_path_to_tree = os.path.join(root_file_name, path_to_tree)
 				log.debug("Reading from ntuple %s ..." % complete_path_to_tree)
-				n_trees_added = tree.Add(complete_path_to_tree, -1)
+				n_trees_added = RootTools.add_to_chain(tree, root_file_name, path_to_tree, index_dir=index_dir)
 				if n_trees_added == 0:
 					log.error("Input %s does not contain any trees!" % complete_path_to_tree)
 		tree.SetDirectory(0)
@@ -364,67 +697,391 @@ class RootTools(object):
 				for path_to_tree, friend_alias in zip(friend_folders, friend_aliases):
 					complete_path_to_tree = os.path.join(root_file_name, path_to_tree)
 					log.debug("Reading friend from ntuple %s ..." % complete_path_to_tree)
-					n_trees_added = friend_trees[-1].Add(complete_path_to_tree, -1)
+					n_trees_added = RootTools.add_to_chain(friend_trees[-1], root_file_name, path_to_tree, index_dir=index_dir)
 					if n_trees_added == 0:
 						log.error("Input %s does not contain any trees!" % complete_path_to_tree)
 			log.debug("ROOT.TTree.AddFriend(" + str(friend_trees[-1]) + ", \"" + (friend_alias if friend_alias else "") + "\")")
 			tree.AddFriend(friend_trees[-1], (friend_alias if friend_alias else ""))
 			friend_trees[-1].SetDirectory(0)
 
-		tree.SetName(hash_name)
+		if not name is None:
+			tree.SetName(name)
+		return tree, friend_trees
+
+	@staticmethod
+	def add_to_chain(chain, root_file_name, path_to_tree, index_dir=None):
+		"""
+		Add the trees of a (local, possibly wildcarded) file to a TChain with their numbers of entries
+
+		ROOT.TChain.Add(name, -1) opens every file to count its entries. For local files, the counts are
+		taken from the metadata index instead and the files are opened when the loop reaches them.
+		Files not yet indexed are opened once to index them. The counts are validated before and after
+		reading by validate_chain. Remote files are added as before. Returns the number of trees added.
+		"""
+		if "://" in root_file_name:
+			return chain.Add(os.path.join(root_file_name, path_to_tree), -1)
+
+		n_trees_added = 0
+		for file_name in (sorted(glob.glob(root_file_name)) if glob.has_magic(root_file_name) else [root_file_name]):
+			metadata = rootfileindex.get_metadata(file_name, index_dir=index_dir)
+			tree = None if metadata is None else metadata.tree(path_to_tree)
+			if tree is None:
+				# let ROOT report files that cannot be read or do not contain the tree
+				n_trees_added += chain.Add(os.path.join(file_name, path_to_tree), -1)
+			else:
+				# files with empty trees are opened anyway, since ROOT interprets 0 entries as unknown
+				n_trees_added += chain.Add(os.path.join(file_name, path_to_tree), tree["entries"])
+		return n_trees_added
+
+	@staticmethod
+	def validate_chain(tree, friend_trees=None, index_dir=None):
+		"""
+		Compare the numbers of entries of the chain elements with the ones of the current files
+
+		Before reading, the chain elements have the indexed numbers of entries (see add_to_chain). ROOT
+		updates them when loading the files during the loop. The index is keyed by the sizes and
+		modification times of the files, such that changed files are indexed again. Mismatches occur
+		in case files have been changed after building the chain. The affected index entries are removed.
+		Returns False in case of mismatches.
+		"""
+		valid = True
+		for chain in [tree] + (friend_trees or []):
+			for element in chain.GetListOfFiles():
+				file_name = element.GetTitle()
+				if "://" in file_name:
+					continue
+				metadata = rootfileindex.get_metadata(file_name, index_dir=index_dir)
+				tree_metadata = None if metadata is None else metadata.tree(element.GetName())
+				if tree_metadata is None:
+					continue
+				if element.GetEntries() != tree_metadata["entries"]:
+					log.warning("Tree \"%s\" in file \"%s\" contains %d entries, but %d entries are expected in the chain! The file has been changed." % (element.GetName(), file_name, tree_metadata["entries"], element.GetEntries()))
+					rootfileindex.get_root_file_index(index_dir).invalidate(file_name)
+					valid = False
+		return valid
+
+	@staticmethod
+	def check_chain_after_reading(tree, friend_trees=None, index_dir=None):
+		"""
+		Abort in case files have been changed while reading from the chain, such that the result is neither used nor cached
+		"""
+		if not RootTools.validate_chain(tree, friend_trees, index_dir=index_dir):
+			log.critical("Input files have been changed while reading them! Please rerun.")
+			sys.exit(1)
+
+	@staticmethod
+	def used_branches(tree, expressions):
+		"""
+		Determine the branches needed for evaluating the expressions on the tree (including its friends)
+
+		The expressions are compiled as ROOT.TTreeFormula objects. Returns a dict of the (chained) trees
+		and the names of their used branches or None in case the used branches cannot be determined reliably.
+		"""
+		if tree.LoadTree(0) < 0:
+			return None
+
+		trees = [tree] + [friend_element.GetTree() for friend_element in (tree.GetListOfFriends() or [])]
+		# leaves referenced via aliases are not accessible via the main formula
+		if any([current_tree.GetListOfAliases() and (current_tree.GetListOfAliases().GetEntries() > 0) for current_tree in trees]):
+			return None
+
+		branch_names = collections.OrderedDict([(current_tree, []) for current_tree in trees])
+		for expression in expressions:
+			if (expression is None) or (str(expression).strip() == ""):
+				continue
+			# leaves used only in sub-formulas of special functions (e.g. Sum$, Alt$, Length$, MinIf$)
+			# are not accessible via the main formula
+			if "$(" in str(expression):
+				return None
+
+			formula = ROOT.TTreeFormula("branch_usage", str(expression), tree)
+			try:
+				if formula.GetNdim() <= 0:
+					return None
+
+				for code in xrange(formula.GetNcodes()):
+					leaf = formula.GetLeaf(code)
+					if not leaf:
+						continue
+
+					owning_tree = [current_tree for current_tree in trees if leaf.GetBranch().GetTree().IsEqual(current_tree.GetTree())]
+					if len(owning_tree) == 0:
+						return None
+
+					names = [leaf.GetBranch().GetName()]
+					if leaf.GetLeafCount():
+						names.append(leaf.GetLeafCount().GetBranch().GetName())
+					mother = leaf.GetBranch().GetMother()
+					if mother.GetName() != leaf.GetBranch().GetName():
+						# sub-branches of split objects may need their mother and sibling branches
+						names.extend([mother.GetName(), mother.GetName()+"*"])
+					branch_names[owning_tree[0]].extend([name for name in names if not name in branch_names[owning_tree[0]]])
+			finally:
+				# the formula is owned by Python and is deleted together with the last reference to it
+				del formula
+		return branch_names
+
+	@staticmethod
+	def prune_branches(tree, expressions, cache_size=None):
+		"""
+		Disable all branches not needed for evaluating the expressions and set up TTreeCaches for the remaining ones
+
+		cache_size: size of the TTreeCaches in bytes, by default it is estimated from the compressed sizes
+		of the used branches per cluster (between 1 MB and 256 MB)
+
+		Returns True in case branches have been disabled, see enable_all_branches.
+		"""
+		branch_names = RootTools.used_branches(tree, expressions)
+		if branch_names is None:
+			log.debug("Used branches cannot be determined, read all branches.")
+			return False
+
+		for current_tree, names in branch_names.iteritems():
+			current_tree.SetBranchStatus("*", 0)
+			for name in names:
+				current_tree.SetBranchStatus(name, 1)
+			if len(names) == 0:
+				continue
+
+			current_cache_size = cache_size
+			if current_cache_size is None:
+				first_tree = current_tree.GetTree()
+				zip_bytes_per_entry = sum([first_tree.GetBranch(name).GetZipBytes("*") for name in names if (not name.endswith("*")) and first_tree.GetBranch(name)]) / float(max(first_tree.GetEntries(), 1))
+				entries_per_cluster = first_tree.GetAutoFlush() if first_tree.GetAutoFlush() > 0 else first_tree.GetEntries()
+				current_cache_size = int(min(max(2.0 * zip_bytes_per_entry * entries_per_cluster, 1024**2), 256 * 1024**2))
+
+			current_tree.SetCacheSize(current_cache_size)
+			for name in names:
+				current_tree.AddBranchToCache(name, True)
+			current_tree.StopCacheLearningPhase()
+			log.debug("Reading branches %s with a TTreeCache of %d bytes." % (str(names), current_cache_size))
+		return True
+
+	@staticmethod
+	def prepare_reading(tree, expressions, read_options):
+		"""
+		Configure the reading from the tree according to the read_options (see tree_draw)
+
+		Returns True in case branches have been disabled, see enable_all_branches.
+		"""
+		if not read_options.get("cache_learn_entries", None) is None:
+			ROOT.TTreeCache.SetLearnEntries(read_options["cache_learn_entries"])
+		if not read_options.get("prefetching", None) is None:
+			ROOT.gEnv.SetValue("TFile.AsyncPrefetching", int(read_options["prefetching"]))
+
+		if read_options.get("prune_branches", False):
+			if RootTools.prune_branches(tree, expressions, cache_size=read_options.get("cache_size", None)):
+				return True
+
+		if not read_options.get("cache_size", None) is None:
+			for current_tree in [tree] + [friend_element.GetTree() for friend_element in (tree.GetListOfFriends() or [])]:
+				current_tree.SetCacheSize(read_options["cache_size"])
+		return False
+
+	@staticmethod
+	def get_read_statistics():
+		return (ROOT.TFile.GetFileBytesRead(), ROOT.TFile.GetFileReadCalls(), time.time())
+
+	@staticmethod
+	def log_read_statistics(start_statistics, root_file_names, read_options):
+		"""
+		Log the number of bytes read, the number of read calls and the time elapsed since start_statistics (see get_read_statistics)
+		"""
+		bytes_read, read_calls, seconds = [end - start for start, end in zip(start_statistics, RootTools.get_read_statistics())]
+		message = "Read %.1f MB in %d read calls within %.1f s (%.1f MB/s) from %s." % (
+				bytes_read / 1024.0**2, read_calls, seconds,
+				bytes_read / 1024.0**2 / max(seconds, 1e-6),
+				", ".join(root_file_names) if isinstance(root_file_names, (list, tuple)) else root_file_names
+		)
+		if read_options.get("print_statistics", False):
+			log.info(message)
+		else:
+			log.debug(message)
+
+	@staticmethod
+	def enable_all_branches(tree):
+		"""
+		Enable all branches of the tree and its friends again, e.g. for later usage of kept trees
+		"""
+		tree.SetBranchStatus("*", 1)
+		for friend_element in (tree.GetListOfFriends() or []):
+			friend_element.GetTree().SetBranchStatus("*", 1)
+
+	@staticmethod
+	def prepare_proxy(tree, variable_expression, weight_selection, proxy_prefix, proxy_name, directory=None):
+		"""
+		Generate a proxy selector (ROOT.TTree.MakeProxy) filling the histogram, whose name is passed as option to ROOT.TTree.Process
+
+		proxy_name: unique name used for the generated class and functions (replaces "HASH_NAME" in the expressions)
+		directory: directory for the generated files, by default the current working directory
+
+		The files are addressed by absolute paths, since changing the working directory would affect all threads.
+		Returns the absolute path to the header of the proxy class.
+		"""
+		proxy_class_name = "proxy_class_"+proxy_name
+		proxy_macro_name = "proxy_macro_"+proxy_name
+		proxy_cutmacro_name = "proxy_cutmacro_"+proxy_name
+
+		directory = os.path.abspath(directory or os.getcwd())
+		proxy_class_filename = os.path.join(directory, proxy_class_name+".h")
+		proxy_macro_filename = os.path.join(directory, proxy_macro_name+".C")
+		proxy_cutmacro_filename = os.path.join(directory, proxy_cutmacro_name+".C")
+
+		# write macros with variable and cut expression containing the plotting information
+		variable_expression = RootTools.prepare_proxy_command(variable_expression)
+		weight_selection = RootTools.prepare_proxy_command(weight_selection)
+		with open(proxy_macro_filename, "w") as proxy_macro_file:
+			proxy_macro_file.write("double {function}() {{ {content}; }}".format(
+					function=proxy_macro_name,
+					content=variable_expression.replace("HASH_NAME", proxy_name)
+			))
+		with open(proxy_cutmacro_filename, "w") as proxy_cutmacro_file:
+			proxy_cutmacro_file.write("double {function}() {{ {content}; }}".format(
+					function=proxy_cutmacro_name,
+					content=weight_selection.replace("HASH_NAME", proxy_name)
+			))
+
+		# create tree proxy, the class name is the base name of the header
+		tree.MakeProxy(os.path.splitext(proxy_class_filename)[0], proxy_macro_filename, proxy_cutmacro_filename)
+
+		# fix histogram name used in the proxy class
+		# TODO: only do this when ROOT.TTree.Project is called afterwards, not for ROOT.TTree.Draw, when the histogram cannot be renamed before the plotting?
+		proxy_class_content = None
+		with open(proxy_class_filename) as proxy_class_file:
+			proxy_class_content = proxy_class_file.read().rstrip("\n")
+		proxy_class_content = proxy_class_content.replace(
+				"if (htemp == 0)", "if (true)"
+		).replace(
+				"htemp = fDirector.CreateHistogram(GetOption());", "htemp = (TH1*)gDirectory->Get(GetOption());"
+		).replace(
+				"htemp->SetTitle", "//htemp->SetTitle"
+		).replace(
+				"using namespace ROOT", proxy_prefix.replace("\\n", "\n")+"\nusing namespace ROOT"
+		).replace(
+				"htemp->Fill("+proxy_macro_name+"())", "htemp->Fill("+proxy_macro_name+"(), "+proxy_cutmacro_name+"())"
+		).replace(
+				"HASH_NAME", proxy_name
+		)
+		with open(proxy_class_filename, "w") as proxy_class_file:
+			proxy_class_file.write(proxy_class_content)
+
+		return proxy_class_filename
+
+	# to be increased when the code generated by prepare_proxy changes
+	proxy_cache_version = 1
+
+	@staticmethod
+	def cached_proxy(tree, variable_expression, weight_selection, proxy_prefix, cache_dir):
+		"""
+		Return the header of a compiled proxy selector from a persistent cache (see prepare_proxy)
+
+		The proxies are identified by the expressions, the proxy prefix, the branch layout of the trees
+		(including friends) and the ROOT version. Missing proxies are generated and compiled while
+		holding a lock, such that parallel processes wait for and reuse the result. The library is
+		loaded while holding the lock, such that the selector can be created from the loaded class
+		without compiling it again (see proxy_selector).
+
+		Returns None in case the proxy cannot be provided.
+		"""
+		if tree.LoadTree(0) < 0:
+			return None
+
+		layout = []
+		for current_tree, alias in [(tree.GetTree(), "")] + [(friend_element.GetTree().GetTree(), friend_element.GetName()) for friend_element in (tree.GetListOfFriends() or [])]:
+			layout.append("friend:"+alias)
+			layout.extend(["{name}:{type}:{length}".format(name=RootTools.full_leaf_name(leaf), type=leaf.GetTypeName(), length=leaf.GetLenStatic()) for leaf in current_tree.GetListOfLeaves()])
+		proxy_key = hashlib.md5("\n".join([
+				str(RootTools.proxy_cache_version), ROOT.gROOT.GetVersion(), str(ROOT.gROOT.GetGitCommit()),
+				variable_expression, str(weight_selection), proxy_prefix
+		] + layout)).hexdigest()
+
+		proxy_dir = os.path.join(cache_dir, proxy_key)
+		proxy_class_filename = os.path.join(proxy_dir, "proxy_class_"+proxy_key+".h")
+		proxy_library = os.path.join(proxy_dir, "proxy_class_"+proxy_key+"_h."+ROOT.gSystem.GetSoExt())
+		try:
+			if not os.path.exists(proxy_dir):
+				try:
+					os.makedirs(proxy_dir)
+				except OSError:
+					if not os.path.isdir(proxy_dir):
+						raise
+
+			with open(os.path.join(proxy_dir, "lock"), "a") as lock_file:
+				fcntl.lockf(lock_file, fcntl.LOCK_EX)
+				try:
+					if os.path.exists(proxy_library):
+						log.debug("Use compiled proxy \"%s\"." % proxy_library)
+						if ROOT.gSystem.Load(proxy_library) < 0:
+							log.warning("Loading of proxy \"%s\" failed." % proxy_library)
+							return None
+					else:
+						log.info("Compiling proxy for \"%s\" with weight \"%s\" in \"%s\" ..." % (variable_expression, weight_selection, proxy_dir))
+						RootTools.prepare_proxy(tree, variable_expression, weight_selection, proxy_prefix, proxy_key, directory=proxy_dir)
+						if not ROOT.gSystem.CompileMacro(proxy_class_filename, "k"):
+							log.warning("Compilation of proxy \"%s\" failed." % proxy_class_filename)
+							return None
+				finally:
+					fcntl.lockf(lock_file, fcntl.LOCK_UN)
+		except (IOError, OSError), e:
+			log.warning("Cannot use proxy cache in \"%s\": %s" % (cache_dir, str(e)))
+			return None
+
+		return proxy_class_filename
+
+	@staticmethod
+	def proxy_selector(proxy_class_filename):
+		"""
+		Return an instance of a proxy selector, whose library has been loaded by cached_proxy
+		"""
+		return getattr(ROOT, os.path.splitext(os.path.basename(proxy_class_filename))[0])()
+
+	tree_draw_cache = rootcache.RootFileCache(os.path.expandvars(os.path.join("$HP_WORK_BASE_COMMON", "caches")))
+
+	@staticmethod
+	@tree_draw_cache
+	@profiling.profiled("draw", "InputRoot")
+	def tree_draw(root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, root_histogram, variable_expression, name, binning, weight_selection, option, proxy_prefix="", scan=None, redo_cache=False, fill_engine="draw", read_options=None):
+		"""
+		Read a histogram or graph from trees using ROOT.TTree.Draw/Project (or proxies or the columnar fill engine)
+
+		read_options: dict with options not affecting the result
+		              prune_branches: disable branches not used in the expressions and set up a TTreeCache for the used ones
+		              cache_size: size of the TTreeCache in bytes
+		              cache_learn_entries: number of entries for the learning phase of the TTreeCache
+		              prefetching: enable/disable the asynchronous prefetching
+		              print_statistics: log the read statistics on info level instead of debug level
+		              proxy_cache_dir: directory for caching compiled proxies
+		              metadata_index_dir: directory of the metadata index providing the numbers of entries for building the chains
+		"""
+		read_options = read_options or {}
+		read_statistics = RootTools.get_read_statistics()
+
+		hash_name = hashlib.md5("".join(map(str, [root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, root_histogram, variable_expression, name, binning, weight_selection, option, proxy_prefix, scan, redo_cache]))).hexdigest()
+
+		# prepare TChain
+		tree, friend_trees = RootTools.build_chain(root_file_names, path_to_trees, friend_files, friend_folders, friend_aliases, name=hash_name, index_dir=read_options.get("metadata_index_dir", None))
+
+		# vectorised filling of pre-created histograms, falls back to ROOT.TTree.Draw if not possible
+		if (fill_engine == "numpy") and isinstance(root_histogram, ROOT.TH1) and (option.strip() == "") and (not scan):
+			if columnarfill.fill_histograms(tree, [(root_histogram, variable_expression, weight_selection)])[0]:
+				root_histogram.GetSumOfWeights()
+				RootTools.check_chain_after_reading(tree, friend_trees, index_dir=read_options.get("metadata_index_dir", None))
+				RootTools.log_read_statistics(read_statistics, root_file_names, read_options)
+				return tree, root_histogram, []
 
 		# treat functions/macros that need to be compiled before drawing
 		tmp_proxy_files = []
+		proxy_class_filename = None
 		if "proxy" in option:
-			proxy_class_name = "proxy_class_"+hash_name
-			proxy_macro_name = "proxy_macro_"+hash_name
-			proxy_cutmacro_name = "proxy_cutmacro_"+hash_name
-
-			proxy_class_filename = proxy_class_name+".h"
-			proxy_macro_filename = proxy_macro_name+".C"
-			proxy_cutmacro_filename = proxy_cutmacro_name+".C"
-
-			tmp_proxy_files.append(proxy_class_filename)
-			tmp_proxy_files.append(proxy_macro_filename)
-			tmp_proxy_files.append(proxy_cutmacro_filename)
-
-			# write macros with variable and cut expression containing the plotting information
-			variable_expression = RootTools.prepare_proxy_command(variable_expression)
-			weight_selection = RootTools.prepare_proxy_command(weight_selection)
-			with open(proxy_macro_filename, "w") as proxy_macro_file:
-				proxy_macro_file.write("double {function}() {{ {content}; }}".format(
-						function=proxy_macro_name,
-						content=variable_expression.replace("HASH_NAME", hash_name)
-				))
-			with open(proxy_cutmacro_filename, "w") as proxy_cutmacro_file:
-				proxy_cutmacro_file.write("double {function}() {{ {content}; }}".format(
-						function=proxy_cutmacro_name,
-						content=weight_selection.replace("HASH_NAME", hash_name)
-				))
-
-			# create tree proxy
-			tree.MakeProxy(proxy_class_name, proxy_macro_filename, proxy_cutmacro_filename)
-
-			# fix histogram name used in the proxy class
-			# TODO: only do this when ROOT.TTree.Project is called afterwards, not for ROOT.TTree.Draw, when the histogram cannot be renamed before the plotting?
-			proxy_class_content = None
-			with open(proxy_class_filename) as proxy_class_file:
-				proxy_class_content = proxy_class_file.read().rstrip("\n")
-			proxy_class_content = proxy_class_content.replace(
-					"if (htemp == 0)", "if (true)"
-			).replace(
-					"htemp = fDirector.CreateHistogram(GetOption());", "htemp = (TH1*)gDirectory->Get(\"{name}\");".format(name=name)
-			).replace(
-					"htemp->SetTitle", "//htemp->SetTitle"
-			).replace(
-					"using namespace ROOT", proxy_prefix.replace("\\n", "\n")+"\nusing namespace ROOT"
-			).replace(
-					"htemp->Fill("+proxy_macro_name+"())", "htemp->Fill("+proxy_macro_name+"(), "+proxy_cutmacro_name+"())"
-			).replace(
-					"HASH_NAME", hash_name
-			)
-			with open(proxy_class_filename, "w") as proxy_class_file:
-				proxy_class_file.write(proxy_class_content)
+			if read_options.get("proxy_cache_dir", None):
+				proxy_class_filename = RootTools.cached_proxy(tree, variable_expression, weight_selection, proxy_prefix, read_options["proxy_cache_dir"])
+			if proxy_class_filename is None:
+				proxy_class_filename = RootTools.prepare_proxy(tree, variable_expression, weight_selection, proxy_prefix, hash_name)
+				tmp_proxy_files.extend([proxy_class_filename] + [os.path.join(os.path.dirname(proxy_class_filename), prefix+hash_name+".C") for prefix in ["proxy_macro_", "proxy_cutmacro_"]])
+
+		branches_pruned = False
+		if (not "proxy" in option) and (not scan):
+			branches_pruned = RootTools.prepare_reading(tree, columnarfill.split_variable_expression(variable_expression) + [weight_selection], read_options)
 
 		if scan:
 			# https://root.cern.ch/doc/master/classTTreePlayer.html#aa0149b416e4b812a8762ec1e389ba2db
@@ -470,8 +1127,14 @@ class RootTools(object):
 						root_histogram.GetSumOfWeights()
 		else:
 			if "proxy" in option:
-				log.debug("ROOT.TTree.Process(\""+proxy_class_filename+"+\")") # ROOT.TSelector.GetSelector(\""+proxy_class_filename+"+\"))")
-				result = tree.Process(proxy_class_filename+"+") # ROOT.TSelector.GetSelector(proxy_class_filename+"+"))
+				# the name of the histogram to be filled is passed as option to the selector
+				if len(tmp_proxy_files) == 0:
+					# the cached proxy has been compiled and loaded while holding its lock
+					log.debug("ROOT.TTree.Process(" + os.path.splitext(os.path.basename(proxy_class_filename))[0] + "(), \""+name+"\")")
+					result = tree.Process(RootTools.proxy_selector(proxy_class_filename), name)
+				else:
+					log.debug("ROOT.TTree.Process(\""+proxy_class_filename+"+\", \""+name+"\")") # ROOT.TSelector.GetSelector(\""+proxy_class_filename+"+\"))")
+					result = tree.Process(proxy_class_filename+"+", name) # ROOT.TSelector.GetSelector(proxy_class_filename+"+"))
 				if result < 0:
 					ROOT.gDirectory.Delete(name+";*")
 					log.error("Reading input based on proxy failed. Proxy files will be kept for debugging.")
@@ -481,6 +1144,11 @@ class RootTools(object):
 				tree.Project(name, variable_expression, str(weight_selection), option + " GOFF")
 			root_histogram = ROOT.gDirectory.Get(name)
 
+		if branches_pruned:
+			RootTools.enable_all_branches(tree)
+		RootTools.check_chain_after_reading(tree, friend_trees, index_dir=read_options.get("metadata_index_dir", None))
+		RootTools.log_read_statistics(read_statistics, root_file_names, read_options)
+
 		tmp_files = []
 		for tmp_proxy_file in tmp_proxy_files:
 			tmp_files += glob.glob(os.path.splitext(tmp_proxy_file)[0] + "*")
@@ -582,60 +1250,25 @@ class RootTools(object):
 			tmp_root_histogram.RebinZ(simpleRebinning[2])
 
 		# complex rebinning (non-constant bin widths)
-		rebinned_root_histogram = tmp_root_histogram.Clone(name)
 		if any(complexRebinning.values()):
 
-			# create exmpty histogram with correct final binning
-			rebinned_root_histogram.Reset()
-
-			complexRebinning = { axisNumber : rebinning if rebinning else RootTools.get_binning(rebinned_root_histogram, axisNumber)
-				                 for axisNumber, rebinning in complexRebinning.items() }
-
-			rebinned_root_histogram.GetXaxis().Set(len(complexRebinning[0])-1, complexRebinning[0])
-			rebinned_root_histogram.GetYaxis().Set(len(complexRebinning[1])-1, complexRebinning[1])
-			rebinned_root_histogram.GetZaxis().Set(len(complexRebinning[2])-1, complexRebinning[2])
-
-			# use THnSparse to correctly sum up histograms with different binnings
-			sparse_rebinned_root_histogram = ROOT.THnSparse.CreateSparse(name+"sparse", "", rebinned_root_histogram)
-			for axisNumber, rebinning in complexRebinning.items():
-				if axisNumber < rebinned_root_histogram.GetDimension():
-					sparse_rebinned_root_histogram.GetAxis(axisNumber).Set(len(rebinning)-1, rebinning)
-
-			sparse_tmp_root_histogram = ROOT.THnSparse.CreateSparse(name+"sparsetmp", "", tmp_root_histogram)
-			binning = RootTools.get_binning(tmp_root_histogram, 0)
-			if not RootTools.rebinning_possible(binning, complexRebinning[0]):
-				log.warning("Rebinning in X leads to splitting/adding bins! Make sure you know what you are doing!")
-				log.debug("Old binning in X: " + RootTools.binning_formatted(binning))
-				log.debug("New binning in X: " + RootTools.binning_formatted(complexRebinning[0]))
-			sparse_tmp_root_histogram.GetAxis(0).Set(len(binning)-1, binning)
-			if tmp_root_histogram.GetDimension() > 1:
-				binning = RootTools.get_binning(tmp_root_histogram, 1)
-				if not RootTools.rebinning_possible(binning, complexRebinning[1]):
-					log.warning("Rebinning in Y leads to splitting/adding bins! Make sure you know what you are doing!")
-					log.debug("Old binning in Y: " + RootTools.binning_formatted(binning))
-					log.debug("New binning in Y: " + RootTools.binning_formatted(complexRebinning[1]))
-				sparse_tmp_root_histogram.GetAxis(1).Set(len(binning)-1, binning)
-			if tmp_root_histogram.GetDimension() > 2:
-				binning = RootTools.get_binning(tmp_root_histogram, 2)
-				if not RootTools.rebinning_possible(binning, complexRebinning[2]):
-					log.warning("Rebinning in Z leads to splitting/adding bins! Make sure you know what you are doing!")
-					log.debug("Old binning in Z: " + RootTools.binning_formatted(binning))
-					log.debug("New binning in Z: " + RootTools.binning_formatted(complexRebinning[2]))
-				sparse_tmp_root_histogram.GetAxis(2).Set(len(binning)-1, binning)
-
-			# retrieve rebinned histogram
-			sparse_rebinned_root_histogram.RebinnedAdd(sparse_tmp_root_histogram)
-			if rebinned_root_histogram.GetDimension() > 2:
-				rebinned_root_histogram = sparse_rebinned_root_histogram.Projection(0, 1, 2, "EO")
-			elif rebinned_root_histogram.GetDimension() > 1:
-				# non-intuitive swapping of the arguments: see https://root.cern.ch/root/html/THnSparse.html#THnSparse:Projection@1
-				rebinned_root_histogram = sparse_rebinned_root_histogram.Projection(1, 0, "EO")
-			else:
-				rebinned_root_histogram = sparse_rebinned_root_histogram.Projection(0, "EO")
+			complexRebinning = { axisNumber : axisRebinning if axisRebinning else RootTools.get_binning(tmp_root_histogram, axisNumber)
+				                 for axisNumber, axisRebinning in complexRebinning.items() }
 
-			rebinned_root_histogram.GetXaxis().Set(len(complexRebinning[0])-1, complexRebinning[0])
-			rebinned_root_histogram.GetYaxis().Set(len(complexRebinning[1])-1, complexRebinning[1])
-			rebinned_root_histogram.GetZaxis().Set(len(complexRebinning[2])-1, complexRebinning[2])
+			for axisNumber, axisName in enumerate(["X", "Y", "Z"][:tmp_root_histogram.GetDimension()]):
+				binning = RootTools.get_binning(tmp_root_histogram, axisNumber)
+				if not RootTools.rebinning_possible(binning, complexRebinning[axisNumber]):
+					log.warning("Rebinning in %s leads to splitting/adding bins! Make sure you know what you are doing!" % axisName)
+					log.debug("Old binning in %s: " % axisName + RootTools.binning_formatted(binning))
+					log.debug("New binning in %s: " % axisName + RootTools.binning_formatted(complexRebinning[axisNumber]))
+
+			if rebinning.supported(tmp_root_histogram):
+				# vectorised summation of the bin contents (see rebinning)
+				rebinned_root_histogram = rebinning.rebin(tmp_root_histogram, [complexRebinning[axisNumber] for axisNumber in xrange(3)], name)
+			else:
+				rebinned_root_histogram = RootTools._rebin_root_histogram_sparse(tmp_root_histogram, complexRebinning, name)
+		else:
+			rebinned_root_histogram = tmp_root_histogram.Clone(name)
 
 		# projections in case of only one bin for certain axes
 		# TODO: this code might need a config option to be switched off by default
@@ -667,6 +1300,45 @@ class RootTools(object):
 		return rebinned_root_histogram
 
 
+	@staticmethod
+	def _rebin_root_histogram_sparse(tmp_root_histogram, complexRebinning, name):
+		"""
+		Rebin to non-constant bin widths using THnSparse (e.g. for profiles)
+		"""
+		# create exmpty histogram with correct final binning
+		rebinned_root_histogram = tmp_root_histogram.Clone(name)
+		rebinned_root_histogram.Reset()
+
+		rebinned_root_histogram.GetXaxis().Set(len(complexRebinning[0])-1, complexRebinning[0])
+		rebinned_root_histogram.GetYaxis().Set(len(complexRebinning[1])-1, complexRebinning[1])
+		rebinned_root_histogram.GetZaxis().Set(len(complexRebinning[2])-1, complexRebinning[2])
+
+		# use THnSparse to correctly sum up histograms with different binnings
+		sparse_rebinned_root_histogram = ROOT.THnSparse.CreateSparse(name+"sparse", "", rebinned_root_histogram)
+		for axisNumber, axisRebinning in complexRebinning.items():
+			if axisNumber < rebinned_root_histogram.GetDimension():
+				sparse_rebinned_root_histogram.GetAxis(axisNumber).Set(len(axisRebinning)-1, axisRebinning)
+
+		sparse_tmp_root_histogram = ROOT.THnSparse.CreateSparse(name+"sparsetmp", "", tmp_root_histogram)
+		for axisNumber in xrange(tmp_root_histogram.GetDimension()):
+			binning = RootTools.get_binning(tmp_root_histogram, axisNumber)
+			sparse_tmp_root_histogram.GetAxis(axisNumber).Set(len(binning)-1, binning)
+
+		# retrieve rebinned histogram
+		sparse_rebinned_root_histogram.RebinnedAdd(sparse_tmp_root_histogram)
+		if rebinned_root_histogram.GetDimension() > 2:
+			rebinned_root_histogram = sparse_rebinned_root_histogram.Projection(0, 1, 2, "EO")
+		elif rebinned_root_histogram.GetDimension() > 1:
+			# non-intuitive swapping of the arguments: see https://root.cern.ch/root/html/THnSparse.html#THnSparse:Projection@1
+			rebinned_root_histogram = sparse_rebinned_root_histogram.Projection(1, 0, "EO")
+		else:
+			rebinned_root_histogram = sparse_rebinned_root_histogram.Projection(0, "EO")
+
+		rebinned_root_histogram.GetXaxis().Set(len(complexRebinning[0])-1, complexRebinning[0])
+		rebinned_root_histogram.GetYaxis().Set(len(complexRebinning[1])-1, complexRebinning[1])
+		rebinned_root_histogram.GetZaxis().Set(len(complexRebinning[2])-1, complexRebinning[2])
+		return rebinned_root_histogram
+
 	@staticmethod
 	def get_binning(root_histogram, axisNumber=0):
 		"""
@@ -698,12 +1370,7 @@ class RootTools(object):
 
 	@staticmethod
 	def rebinning_possible(src_bin_edges, dst_bin_edges):
-		if len(dst_bin_edges) > len(src_bin_edges):
-			return False
-
-		str_src_bin_edges = [str(bin_edge) for bin_edge in src_bin_edges]
-		str_dst_bin_edges = [str(bin_edge) for bin_edge in dst_bin_edges]
-		return set(str_dst_bin_edges).issubset(set(str_src_bin_edges))
+		return rebinning.rebinning_possible(src_bin_edges, dst_bin_edges)
 
 	@staticmethod
 	def add_root_histograms(*root_histograms, **kwargs):
@@ -1039,3 +1706,54 @@ class RootTools(object):
 	def get_root_version():
 		return [int(version) for version in re.findall("\d+", ROOT.gROOT.GetVersion())]
 
+
+def _histograms_from_trees_in_process(arguments):
+	"""
+	Worker function for RootTools.histograms_from_trees
+
+	Returns (temporary_file_name, list_of_tmp_files) or None in case of failures.
+	"""
+	binning_state, list_of_kwargs, batched = arguments
+	try:
+		root_tools = RootTools()
+		root_tools.binning_determined = binning_state["binning_determined"]
+		root_tools.x_bin_edges = binning_state["x_bin_edges"]
+		root_tools.y_bin_edges = binning_state["y_bin_edges"]
+		root_tools.z_bin_edges = binning_state["z_bin_edges"]
+		results = root_tools.histograms_from_trees(list_of_kwargs, batched=batched, n_processes=1)
+		return (RootTools.write_objects_to_temporary_file([root_histogram for tree, root_histogram, tmp_files in results]),
+		        [tmp_files for tree, root_histogram, tmp_files in results])
+	except SystemExit:
+		return None
+	except Exception:
+		log.error(traceback.format_exc())
+		return None
+
+
+def _merge_histograms_from_files_in_process(elements):
+	"""
+	Worker function for RootTools.histogram_from_file
+
+	Returns the name of a temporary file containing the partial sum or None in case of failures.
+	"""
+	try:
+		return RootTools.write_objects_to_temporary_file([RootTools.merge_histograms_from_files(elements)])
+	except SystemExit:
+		return None
+	except Exception:
+		log.error(traceback.format_exc())
+		return None
+
+def _histograms_from_files_in_process(list_of_kwargs):
+	"""
+	Worker function for RootTools.histograms_from_files
+
+	Returns the name of a temporary file containing the histograms or None in case of failures.
+	"""
+	try:
+		return RootTools.write_objects_to_temporary_file([RootTools.histogram_from_file(**kwargs) for kwargs in list_of_kwargs])
+	except SystemExit:
+		return None
+	except Exception:
+		log.error(traceback.format_exc())
+		return None
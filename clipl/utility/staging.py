@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent staging of remote input files into a shared local cache
+
+Remote files (dcap://, root://, srm://) are downloaded by a bounded pool of threads with
+retries. The local copies are kept in a cache directory keyed by the remote path, such that
+they can be shared between plots, processes and users. Remote files are assumed not to change,
+existing copies are used without querying the remote storage. Downloads are started as early
+as possible (stage) and callers only wait for the files they actually need (local_path/local_paths).
+
+The threads are stopped before worker processes are forked (see executor.register_before_fork).
+"""
+
+import logging
+import clipl.utility.logger as logger
+log = logging.getLogger(__name__)
+
+import collections
+import fcntl
+import hashlib
+import multiprocessing.pool
+import os
+import re
+import shlex
+import tempfile
+import threading
+import time
+
+import clipl.utility.dcachetools as dcachetools
+import clipl.utility.executor as executor
+import clipl.utility.tools as tools
+
+
+REMOTE_IDENTIFIERS = ["dcap://", "root://", "srm://"]
+
+
+def is_remote(path):
+	return isinstance(path, basestring) and any([path.strip().startswith(remote_identifier) for remote_identifier in REMOTE_IDENTIFIERS])
+
+
+def remote_paths(json_dict):
+	"""
+	Return the list of remote files referenced in the (nested) values of a dict or list
+	"""
+	paths = []
+	if isinstance(json_dict, dict):
+		for value in json_dict.values():
+			paths.extend(remote_paths(value))
+	elif isinstance(json_dict, collections.Iterable) and not isinstance(json_dict, basestring):
+		for item in json_dict:
+			paths.extend(remote_paths(item))
+	elif is_remote(json_dict):
+		# remote inputs can be given as space-separated lists
+		paths.extend([path for path in json_dict.split() if is_remote(path)])
+	return paths
+
+
+class StagingPool(object):
+	def __init__(self, cache_dir, n_threads=4, n_retries=3, offset=30, bandwidth=100):
+		self.cache_dir = cache_dir
+		self.n_threads = n_threads
+		self.n_retries = n_retries
+		self.offset = offset
+		self.bandwidth = bandwidth
+
+		self._thread_pool = None
+		self._results = {}
+		# remote files, whose size could not be determined (e.g. not existing)
+		self.unavailable = set()
+		self._lock = threading.Lock()
+		self.statistics = collections.Counter()
+
+	def _get_thread_pool(self):
+		if self._thread_pool is None:
+			self._thread_pool = multiprocessing.pool.ThreadPool(processes=self.n_threads)
+		return self._thread_pool
+
+	def stop_threads(self):
+		"""
+		Wait for the running downloads and stop the threads, which are started again by the next download
+		"""
+		with self._lock:
+			thread_pool = self._thread_pool
+			self._thread_pool = None
+		if not thread_pool is None:
+			thread_pool.close()
+			thread_pool.join()
+
+	def stage(self, remote):
+		"""
+		Start the download of a remote file in the background (if not yet started)
+		"""
+		remote = remote.strip()
+		with self._lock:
+			if not remote in self._results:
+				self._results[remote] = self._get_thread_pool().apply_async(self._stage, (remote,))
+		return self._results[remote]
+
+	def stage_json(self, json_dict):
+		"""
+		Start the download of all remote files referenced in the (nested) values of a dict or list
+		"""
+		for path in remote_paths(json_dict):
+			self.stage(path)
+
+	def local_path(self, path):
+		"""
+		Return the local copy of a remote file (waiting for its download) or the path itself
+		in case it is not remote or cannot be staged
+		"""
+		if not is_remote(path):
+			return path
+		if len(path.split()) > 1:
+			return " ".join([self.local_path(single_path) for single_path in path.split()])
+		local_path = self.stage(path).get()
+		return path if local_path is None else local_path
+
+	def local_paths(self, paths):
+		if isinstance(paths, basestring):
+			return self.local_path(paths)
+		for path in paths:
+			if is_remote(path):
+				self.stage(path)
+		return [self.local_path(path) for path in paths]
+
+	def replace_json(self, json_dict):
+		"""
+		Return a copy of a (nested) dict or list with all remote files replaced by their local copies
+		"""
+		self.stage_json(json_dict)
+		return self._replace_json(json_dict)
+
+	def _replace_json(self, json_dict):
+		if isinstance(json_dict, dict):
+			return json_dict.__class__([(key, self._replace_json(value)) for key, value in json_dict.items()])
+		elif isinstance(json_dict, collections.Iterable) and not isinstance(json_dict, basestring):
+			return [self._replace_json(item) for item in json_dict]
+		elif is_remote(json_dict):
+			return " ".join([self.local_path(path) for path in json_dict.split()])
+		return json_dict
+
+	def get_statistics_string(self):
+		return "Staged {n_files} files ({n_cached} already cached, {n_failed} failed), downloaded {size:.1f} MB in {seconds:.1f} s ({rate:.1f} MB/s per download).".format(
+				n_files=self.statistics["files"],
+				n_cached=self.statistics["cached"],
+				n_failed=self.statistics["failed"],
+				size=self.statistics["bytes"] / 1024.0**2,
+				seconds=self.statistics["seconds"],
+				rate=self.statistics["bytes"] / 1024.0**2 / max(self.statistics["seconds"], 1e-6)
+		)
+
+	def _count(self, **kwargs):
+		with self._lock:
+			self.statistics.update(kwargs)
+
+	@staticmethod
+	def _remote_size(remote, offset):
+		stdout, stderr = tools.subprocessCall(shlex.split("gfal-stat --timeout {timeout} {remote}".format(timeout=str(offset), remote=remote)))
+		size = re.search("Size\:\s*(?P<size>\d*)", stdout)
+		return int(size.group("size")) if size and size.group("size") else None
+
+	def _stage(self, remote):
+		try:
+			# complete copies are renamed to local_path, such that existing copies can be used right away
+			local_path = os.path.join(
+					self.cache_dir,
+					hashlib.md5(remote).hexdigest(),
+					os.path.basename(remote)
+			)
+			if os.path.exists(local_path):
+				log.debug("Use staged copy \"{local}\" of \"{remote}\".".format(local=local_path, remote=remote))
+				self._count(files=1, cached=1)
+				return local_path
+
+			gfal_remote = dcachetools.xrd2srm(remote)
+			size = StagingPool._remote_size(gfal_remote, self.offset)
+			if size is None:
+				log.error("Could not get file size of \"{remote}\"! It is read remotely.".format(remote=remote))
+				with self._lock:
+					self.unavailable.add(remote)
+				self._count(files=1, failed=1)
+				return None
+
+			local_dir = os.path.dirname(local_path)
+			if not os.path.exists(local_dir):
+				try:
+					os.makedirs(local_dir)
+				except OSError:
+					if not os.path.isdir(local_dir):
+						raise
+
+			# only one process downloads a file at a time, others wait and reuse the copy
+			with open(local_path + ".lock", "a") as lock_file:
+				fcntl.lockf(lock_file, fcntl.LOCK_EX)
+				try:
+					if os.path.exists(local_path):
+						log.debug("Use staged copy \"{local}\" of \"{remote}\".".format(local=local_path, remote=remote))
+						self._count(files=1, cached=1)
+						return local_path
+
+					for attempt in xrange(self.n_retries):
+						tmp_file_descriptor, tmp_local_path = tempfile.mkstemp(prefix=".tmp_", suffix=os.path.splitext(local_path)[1], dir=local_dir)
+						os.close(tmp_file_descriptor)
+						start_time = time.time()
+						success = tools.download_remote_file(remote=gfal_remote, local=tmp_local_path, offset=self.offset, bandwidth=self.bandwidth)
+						seconds = time.time() - start_time
+						if success and (os.path.getsize(tmp_local_path) == size):
+							os.rename(tmp_local_path, local_path)
+							self._count(files=1, bytes=size, seconds=seconds)
+							log.debug("Staged \"{remote}\" ({size:.1f} MB in {seconds:.1f} s).".format(remote=remote, size=size/1024.0**2, seconds=seconds))
+							return local_path
+
+						if os.path.exists(tmp_local_path):
+							os.remove(tmp_local_path)
+						log.warning("Download of \"{remote}\" failed (attempt {attempt}/{n_retries}).".format(remote=remote, attempt=attempt+1, n_retries=self.n_retries))
+						time.sleep(2**attempt)
+				finally:
+					fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+			log.error("Could not stage \"{remote}\"! It is read remotely.".format(remote=remote))
+			self._count(files=1, failed=1)
+			return None
+		except Exception, e:
+			log.error("Could not stage \"{remote}\": {error}".format(remote=remote, error=e))
+			self._count(files=1, failed=1)
+			return None
+
+
+_staging_pools = {}
+
+def get_staging_pool(cache_dir, n_threads=4, n_retries=3):
+	"""
+	Return the staging pool of this process for the given cache directory
+
+	Pools are shared between all plots created in the same process. Child processes
+	(e.g. of multiprocessing pools) get their own pools, since threads are not inherited.
+	"""
+	key = (os.getpid(), os.path.abspath(cache_dir))
+	if not key in _staging_pools:
+		_staging_pools[key] = StagingPool(cache_dir, n_threads=n_threads, n_retries=n_retries)
+	staging_pool = _staging_pools[key]
+	staging_pool.n_retries = n_retries
+	return staging_pool
+
+def get_statistics_strings():
+	return [staging_pool.get_statistics_string() for (pid, cache_dir), staging_pool in _staging_pools.iteritems() if (pid == os.getpid()) and (staging_pool.statistics["files"] > 0)]
+
+def stop_threads():
+	"""
+	Stop the threads of all staging pools of this process, e.g. before forking
+	"""
+	for (pid, cache_dir), staging_pool in _staging_pools.items():
+		if pid == os.getpid():
+			staging_pool.stop_threads()
+
+executor.register_before_fork(stop_threads)
@@ -11,10 +11,140 @@ Created by Samvel Khalatyan, Feb 16, 2012
 Copyright 2011, All rights reserved
 """	
 
+import collections
+import os
 import ROOT
 import sys
 
 
+READ_MODES = ["READ", "READONLY"]
+
+
+class TFilePool(object):
+	"""
+	LRU pool of ROOT files opened in read-only mode
+
+	Files are kept open after being used, such that reading several objects from the same file
+	does not require opening it again. At most max_open_files files are kept open. Files that
+	have been changed on disk since they were opened are reopened. The keys of the directories
+	are cached for fast lookups of objects (see get_object).
+
+	Objects that are not read via get_object are deleted together with their file, at the
+	latest when it is evicted from the pool. Therefore, only callers reading many objects
+	from the same file should opt in (see TFileContextManager).
+	"""
+	def __init__(self, max_open_files=64):
+		self.max_open_files = max_open_files
+		self._files = collections.OrderedDict()
+		self._keys = {}
+		self.statistics = collections.Counter()
+
+	@staticmethod
+	def _file_state(filename):
+		if "://" in filename:
+			return None
+		try:
+			stat = os.stat(filename)
+		except OSError:
+			return None
+		return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+	def open(self, filename):
+		"""
+		Return an open file from the pool or open and add it
+		Returns None in case the file cannot be opened.
+		"""
+		file_state = TFilePool._file_state(filename)
+		if filename in self._files:
+			root_file, cached_file_state = self._files.pop(filename)
+			if (cached_file_state == file_state) and root_file.IsOpen():
+				self._files[filename] = (root_file, cached_file_state)
+				self.statistics["reused"] += 1
+				return root_file
+			self._close(filename, root_file)
+
+		root_file = ROOT.TFile.Open(filename, "READ")
+		if root_file is None or (not root_file) or root_file.IsZombie():
+			return None
+		self.statistics["opened"] += 1
+		self._files[filename] = (root_file, file_state)
+
+		while len(self._files) > max(self.max_open_files, 1):
+			lru_filename, (lru_root_file, lru_file_state) = self._files.popitem(last=False)
+			self._close(lru_filename, lru_root_file)
+		return root_file
+
+	def close(self, filename):
+		"""
+		Close a file, e.g. before it is opened in write mode
+		"""
+		if filename in self._files:
+			root_file, file_state = self._files.pop(filename)
+			self._close(filename, root_file)
+
+	def close_all(self):
+		for filename in self._files.keys():
+			self.close(filename)
+
+	def _close(self, filename, root_file):
+		for key in [key for key in self._keys.keys() if key[0] == filename]:
+			del self._keys[key]
+		if root_file.IsOpen():
+			root_file.Close()
+
+	def get_object(self, root_file, path):
+		"""
+		Read an object from a file using a cache of the keys of its directories
+
+		Returns None in case the object does not exist. The objects are detached from the
+		file and owned by Python, such that they do not pile up in the directories of the
+		pooled files. Trees and directories stay attached to the file.
+		"""
+		directory_path, name = os.path.split(str(path).strip("/"))
+		cache_key = (root_file.GetName(), directory_path)
+		if not cache_key in self._keys:
+			directory = root_file.GetDirectory(directory_path) if directory_path != "" else root_file
+			keys = {}
+			if directory:
+				# the keys are ordered by decreasing cycle numbers, take the highest cycle
+				for key in directory.GetListOfKeys():
+					keys.setdefault(key.GetName(), key)
+			self._keys[cache_key] = keys
+
+		key = self._keys[cache_key].get(name, None)
+		if key is None:
+			# fall back to ROOT.TDirectory.Get for paths with cycle numbers and objects in memory
+			root_object = root_file.Get(str(path))
+			return None if (root_object is None) or (root_object == None) else TFilePool._detach(root_object)
+		return TFilePool._detach(key.ReadObj())
+
+	@staticmethod
+	def _detach(root_object):
+		if isinstance(root_object, ROOT.TTree) or isinstance(root_object, ROOT.TDirectory):
+			return root_object
+		if isinstance(root_object, ROOT.TH1):
+			root_object.SetDirectory(0)
+		ROOT.SetOwnership(root_object, True)
+		return root_object
+
+
+_tfile_pools = {}
+
+def get_tfile_pool():
+	"""
+	Return the file pool of this process
+
+	Child processes get their own pools, since file handles cannot be shared between processes.
+	"""
+	pid = os.getpid()
+	if not pid in _tfile_pools:
+		_tfile_pools[pid] = TFilePool()
+	return _tfile_pools[pid]
+
+def set_max_open_files(max_open_files):
+	get_tfile_pool().max_open_files = max_open_files
+
+
 class TFileContextManager(object):
 	"""
 	Minimal file-object interface for ROOT TFile
@@ -28,11 +158,24 @@ class TFileContextManager(object):
 	...     plot = tfile.Get("Hello")
 	
 	This will safely open and close the file, regardless of errors.
+	
+	With pooled set to True, files opened in read-only mode are borrowed from the TFilePool
+	of the process and are kept open after leaving the context. Objects should then only be
+	read via TFilePool.get_object, since all other objects are deleted at an unpredictable
+	point, when the file is evicted from the pool.
 	"""
-	def __init__(self, filename, mode = "readonly"):
+	def __init__(self, filename, mode = "readonly", pooled = False):
 		self._filename = filename
 		self._mode = mode
-		self._file = ROOT.TFile.Open(self._filename, self._mode)
+		self._pooled = pooled and (mode.upper() in READ_MODES)
+		if self._pooled:
+			self._file = get_tfile_pool().open(self._filename)
+			if self._file:
+				self._file.cd()
+		else:
+			# make sure that no handle of the pool is left open for files to be written
+			get_tfile_pool().close(self._filename)
+			self._file = ROOT.TFile.Open(self._filename, self._mode)
 		# ROOT may have silently failed opening the file
 		# NOTE: didn't find what pyroot *actually* may return, this can probably be cut down - MF@030516
 		if self._file is None or (not self._file) or self._file.IsZombie():
@@ -56,7 +199,12 @@ class TFileContextManager(object):
 	def close(self):
 		"""Close ROOT file"""
 		if self._file is not None:
-			self._file.Close()
+			if self._pooled:
+				# return the file to the pool and leave it in the same way as ROOT.TFile.Close does
+				if ROOT.gDirectory.GetFile() and (ROOT.gDirectory.GetFile().GetName() == self._file.GetName()):
+					ROOT.gROOT.cd()
+			else:
+				self._file.Close()
 			self._file = None
 
 	def __del__(self):
@@ -16,9 +16,8 @@ import termios
 import textwrap
 import shlex
 import subprocess
-import time
-import ROOT
 
+import clipl.utility.executor as executor
 import clipl.utility.progressiterator as pi
 
 from difflib import SequenceMatcher
@@ -192,33 +191,47 @@ def get_indented_text(prefix, message, width=None):
 			)
 	return '\n'.join(['\n'.join(tmp_wrapped_texts)])
 
-def parallelize(function, arguments_list, n_processes=1, description=None):
+def parallelize(function, arguments_list, n_processes=1, description=None, timeout=None, max_tasks_per_process=None, max_rss=None, callback=None, ignore_failures=False):
+	"""
+	Call function(arguments) for all arguments (in n_processes parallel processes) and return the list of results
+
+	The parallel processes are recycled after max_tasks_per_process tasks or in case their memory usage
+	exceeds max_rss (MB) and tasks taking longer than timeout (seconds) are stopped (see executor.ProcessExecutor).
+	The callback is called with (event, task index, executor) in addition to updating the progress bar.
+	Failed tasks abort the program or get None as result in case ignore_failures is True.
+	"""
+	if (n_processes > 1) and multiprocessing.current_process().daemon:
+		# e.g. inputs read in parallel within plots that are already created in parallel
+		log.debug("Daemonic processes are not allowed to have children. Run \"{function}\" sequentially.".format(function=str(function)))
+		n_processes = 1
+	
 	if n_processes <= 1:
 		results = []
 		for arguments in pi.ProgressIterator(arguments_list, description=(description if description else "calling "+str(function))):
 			results.append(function(arguments))
 		return results
 	else:
-		pool = multiprocessing.Pool(processes=max(1, min(n_processes, len(arguments_list))))
-		results = pool.map_async(function, arguments_list, chunksize=1)
 		n_tasks = len(arguments_list)
-		left = n_tasks-1
 		progress_iterator = pi.ProgressIterator(range(n_tasks), description=(description if description else "calling "+str(function)))
 		progress_iterator.next()
-		while (True):
-			ready = results.ready()
-			remaining = results._number_left
-			if ready or (remaining < left):
-				for i in range(left-remaining):
-					progress_iterator.next()
-				left = remaining
-			if ready:
-				break
-			time.sleep(1.0)
-		returnvalue = results.get(9999999)
-		pool.close() # necessary to actually terminate the processes
-		pool.join()  # without these two lines, they happen to live until the whole program terminates
-		return returnvalue
+		
+		def progress(event, index, process_executor):
+			if (event in [executor.FINISHED_EVENT, executor.FAILED_EVENT, executor.TIMEOUT_EVENT, executor.CANCELLED_EVENT]) and (progress_iterator.current_index < n_tasks):
+				progress_iterator.next()
+			if not callback is None:
+				callback(event, index, process_executor)
+		
+		results = [None] * n_tasks
+		with executor.ProcessExecutor(n_processes, max_tasks_per_worker=max_tasks_per_process, max_rss=max_rss, timeout=timeout, callback=progress) as process_executor:
+			for task_result in process_executor.imap_unordered(function, arguments_list):
+				if task_result.error is None:
+					results[task_result.index] = task_result.result
+				elif ignore_failures:
+					log.error("Calling \"{function}\" failed for task {index}: {error}".format(function=str(function), index=task_result.index, error=task_result.error))
+				else:
+					log.critical("Calling \"{function}\" failed for task {index}: {error}".format(function=str(function), index=task_result.index, error=task_result.error))
+					sys.exit(1)
+		return results
 
 
 def hadd2(arguments):
@@ -386,7 +399,9 @@ def download_remote_file(remote, local, offset=30, bandwidth=100):
 		return False
 
 def pvalue2sigma(pvalue):
+	import ROOT
 	return ROOT.Math.normal_quantile_c(pvalue/2, 1.0)
 
 def sigma2pvalue(sigma):
+	import ROOT
 	return 2*ROOT.Math.normal_cdf_c(sigma)